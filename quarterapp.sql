@@ -9,16 +9,42 @@ CREATE TABLE `activities` (
     `title` VARCHAR(32) NOT NULL DEFAULT '',
     `color` VARCHAR(32) NOT NULL DEFAULT '',
     `state` TINYINT(1) NOT NULL DEFAULT '1',
-    PRIMARY KEY (`id`)
+    PRIMARY KEY (`id`),
+    KEY `user` (`user`, `state`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
 
 CREATE TABLE `sheets` (
     `id` INT(11) UNSIGNED NOT NULL AUTO_INCREMENT,
     `user` INT(11) NOT NULL,
     `date` DATE NOT NULL,
-    `quarters` TEXT NOT NULL,
+    `quarters` BLOB NOT NULL,
     PRIMARY KEY (`id`),
-    UNIQUE KEY `date` (`date`, `user`)
+    UNIQUE KEY `user_date` (`user`, `date`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+CREATE TABLE `sheet_totals` (
+    `user` INT(11) NOT NULL,
+    `date` DATE NOT NULL,
+    `activity` INT(11) NOT NULL,
+    `quarters` SMALLINT UNSIGNED NOT NULL,
+    PRIMARY KEY (`user`, `date`, `activity`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+CREATE TABLE `monthly_totals` (
+    `user` INT(11) NOT NULL,
+    `year` SMALLINT NOT NULL,
+    `month` TINYINT NOT NULL,
+    `activity` INT(11) NOT NULL,
+    `quarters` INT(11) NOT NULL,
+    PRIMARY KEY (`user`, `year`, `month`, `activity`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+CREATE TABLE `yearly_totals` (
+    `user` INT(11) NOT NULL,
+    `year` SMALLINT NOT NULL,
+    `activity` INT(11) NOT NULL,
+    `quarters` INT(11) NOT NULL,
+    PRIMARY KEY (`user`, `year`, `activity`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
 
 CREATE TABLE `settings` (
@@ -32,13 +58,17 @@ CREATE TABLE `settings` (
 CREATE TABLE `users` (
     `id` int(11) UNSIGNED NOT NULL AUTO_INCREMENT,
     `username` VARCHAR(256) NOT NULL DEFAULT '',
-    `password` VARCHAR(90) NOT NULL DEFAULT '',
+    `password` VARCHAR(255) NOT NULL DEFAULT '',
     `salt` VARCHAR(256) NOT NULL DEFAULT '',
     `type` TINYINT NOT NULL DEFAULT '0',
     `state`  TINYINT NOT NULL DEFAULT '0',
     `last_login` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     `reset_code` VARCHAR(64),
-    PRIMARY KEY (`id`)
+    `data_version` INT(11) UNSIGNED NOT NULL DEFAULT '0',
+    `data_modified` INT(11) UNSIGNED NOT NULL DEFAULT '0',
+    PRIMARY KEY (`id`),
+    KEY `username` (`username`(255)),
+    KEY `reset_code` (`reset_code`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
 
 CREATE TABLE `signups` (
@@ -47,13 +77,39 @@ CREATE TABLE `signups` (
     `activation_code` VARCHAR(64) NOT NULL DEFAULT '',
     `ip` VARCHAR(39) NOT NULL DEFAULT '',
     `signup_time` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    PRIMARY KEY (`id`)
+    PRIMARY KEY (`id`),
+    UNIQUE KEY `username` (`username`(255)),
+    KEY `activation_code` (`activation_code`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+CREATE TABLE `versions` (
+    `name` VARCHAR(64) NOT NULL,
+    `version` BIGINT UNSIGNED NOT NULL DEFAULT '0',
+    PRIMARY KEY (`name`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+CREATE TABLE `schema_version` (
+    `version` INT(11) UNSIGNED NOT NULL,
+    `description` VARCHAR(128) NOT NULL DEFAULT '',
+    `applied` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (`version`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
 
+#
+# This script creates the latest schema, mark all migrations as applied
+INSERT INTO quarterapp.schema_version (`version`, `description`) VALUES(1, "Indexes for user, login, activation and per user sheet lookups");
+INSERT INTO quarterapp.schema_version (`version`, `description`) VALUES(2, "Binary encoded sheet quarters");
+INSERT INTO quarterapp.schema_version (`version`, `description`) VALUES(3, "Version counters for cheap change checks");
+INSERT INTO quarterapp.schema_version (`version`, `description`) VALUES(4, "Per user data version for conditional requests");
+INSERT INTO quarterapp.schema_version (`version`, `description`) VALUES(5, "Room for salted password hashes");
+INSERT INTO quarterapp.schema_version (`version`, `description`) VALUES(6, "Time per activity and day");
+INSERT INTO quarterapp.schema_version (`version`, `description`) VALUES(7, "Time per activity and month or year");
+
 #
 # Insert default settings
 INSERT INTO quarterapp.settings (`name`, `value`) VALUES("allow-signups", "1");
 INSERT INTO quarterapp.settings (`name`, `value`) VALUES("allow-activations", "1");
+INSERT INTO quarterapp.versions (`name`, `version`) VALUES("settings", 0);
 
 #
 # Insert default administrator account
@@ -18,6 +18,7 @@ import logging
 import sys
 import os
 
+import tornado.gen
 import tornado.web
 import tornado.escape
 from tornado.options import options
@@ -30,7 +31,7 @@ from quarter_utils import *
 
 class LogoutHandler(BaseHandler):
     def get(self):
-        self.clear_cookie("user")
+        self.set_current_user(None)
         self.redirect(u"/")
 
 class SignupHandler(BaseHandler):
@@ -53,14 +54,14 @@ class SignupHandler(BaseHandler):
         error = False
         if len(username) == 0:
             error = "empty"
-        if not username_unique(self.application.db, username):
+        if not username_unique(self.db, username):
             error = "not_unique"
 
         if not error:
             try:
                 code = activation_code()
                 if send_signup_email(username, code):
-                    signup_user(self.application.db, username, code, self.request.remote_ip)
+                    signup_user(self.db, username, code, self.request.remote_ip)
                     self.render(u"public/signup_instructions.html",
                         options = options,
                         logged_in = self.logged_in())
@@ -99,6 +100,7 @@ class ActivationHandler(BaseHandler):
         else:
             raise tornado.web.HTTPError(404)
 
+    @tornado.gen.coroutine
     def post(self):
         if not self.enabled("allow-activations"):
             raise tornado.web.HTTPError(500)
@@ -120,9 +122,11 @@ class ActivationHandler(BaseHandler):
                 code = None,
                 logged_in = self.logged_in())
         else:
-            salt = username_for_activation_code(self.application.db, code)
-            salted_password = hash_password(password, salt)
-            if activate_user(self.application.db, code, salted_password, salt):
+            # Hashed before the lookups, no pooled connection is held while it runs
+            salted_password = yield self.application.passwords.hash(password)
+            salt = yield self.async_db.username_for_activation_code(code)
+            activated = yield self.async_db.activate_user(code, salted_password, salt)
+            if activated:
                 # TODO Do login
                 self.redirect(u"/sheet")
             else:
@@ -151,7 +155,7 @@ class ForgotPasswordHandler(BaseHandler):
                 logged_in = self.logged_in())
         else:
             reset_code = activation_code()
-            if set_user_reset_code(self.application.db, username, reset_code):
+            if set_user_reset_code(self.db, username, reset_code):
                 send_reset_email(username, reset_code)
                 self.redirect(u"/reset")
             else:
@@ -172,6 +176,7 @@ class ResetPasswordHandler(BaseHandler):
             code = code,
             logged_in = self.logged_in())
 
+    @tornado.gen.coroutine
     def post(self):
         code = self.get_argument("code", "")
         password = self.get_argument("password", "")
@@ -192,9 +197,10 @@ class ResetPasswordHandler(BaseHandler):
                 code = code,
                 logged_in = self.logged_in())
         else:
-            salt = username_for_activation_code(self.application.db, code)
-            salted_password = hash_password(password, salt)
-            if reset_password(self.application.db, code, salted_password):
+            salted_password = yield self.application.passwords.hash(password)
+            username = reset_password(self.db, code, salted_password)
+            if username:
+                self.application.sessions.revoke(username)
                 # TODO Do login
                 self.redirect(u"/sheet")
             else:
@@ -214,12 +220,12 @@ class LoginHandler(AuthenticatedHandler):
             allow_signups = allow_signups,
             logged_in = self.logged_in())
 
+    @tornado.gen.coroutine
     def post(self):
         username = self.get_argument("username", "")
         password = self.get_argument("password", "")
-        hashed_password = hash_password(password, username)
 
-        user = authenticate_user(self.application.db, username, hashed_password)
+        user = yield self.authenticate(username, password)
         if user:
             logging.warn("User authenticated")
             self.set_current_user(user)
@@ -244,6 +250,7 @@ class ChangePasswordHandler(AuthenticatedHandler):
             logged_in = self.logged_in())
 
     @authenticated_user
+    @tornado.gen.coroutine
     def post(self):
         current_password = self.get_argument("current-password", "")
         new_password = self.get_argument("new-password", "")
@@ -258,8 +265,7 @@ class ChangePasswordHandler(AuthenticatedHandler):
         if not new_password == verify_password:
             error = "not_matching"
 
-        current_hash = hash_password(current_password, username)
-        authenticated = authenticate_user(self.application.db, username, current_hash)
+        authenticated = yield self.authenticate(username, current_password)
 
         if not authenticated:
             error = "not_valid"
@@ -270,8 +276,11 @@ class ChangePasswordHandler(AuthenticatedHandler):
                 error = error,
                 logged_in = self.logged_in())
         else:
-            hashed_password = hash_password(new_password, username)
-            change_password(self.application.db, username, hashed_password)
+            hashed_password = yield self.application.passwords.hash(new_password)
+            change_password(self.db, username, hashed_password)
+            # Log out everywhere else, keeping this browser logged in with a new session
+            self.application.sessions.revoke(username)
+            self.set_current_user(self.current_user)
             self.render(u"app/password.html",
                 options = options,
                 error = "success",
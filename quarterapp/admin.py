@@ -20,11 +20,13 @@ import sys
 import os
 import json
 
+import tornado.gen
 import tornado.web
 import tornado.escape
 from tornado.options import options
 from tornado.web import HTTPError
 
+import query_stats
 from basehandlers import *
 from storage import *
 from quarter_errors import *
@@ -49,7 +51,6 @@ class AdminUsersHandler(AuthenticatedHandler):
     """
     Handler for user listing and searching
     """
-    @authenticated_admin
     def generate_pagination(self, total, current, max_per_page, max_links, query_filter = None):
         """
         Generate a list of pagination links based on the following input.
@@ -100,6 +101,7 @@ class AdminUsersHandler(AuthenticatedHandler):
         return pagination
 
     @authenticated_admin
+    @tornado.gen.coroutine
     def get(self):
         start = self.get_argument("start", "")
         count = self.get_argument("count", "")
@@ -124,13 +126,13 @@ class AdminUsersHandler(AuthenticatedHandler):
         if not error:
             try:
                 if query_filter:
-                    user_count = get_filtered_user_count(self.application.db, query_filter)
+                    user_count, users = yield [self.async_db.get_filtered_user_count(query_filter),
+                        self.async_db.get_filtered_users(query_filter, start, count)]
                     pagination_links = self.generate_pagination(user_count, start, count, DEFAULT_PAGINATION_PAGES, query_filter = query_filter)
-                    users = get_filtered_users(self.application.db, query_filter, start, count)
                 else:
-                    user_count = get_user_count(self.application.db)
+                    user_count, users = yield [self.async_db.get_user_count(),
+                        self.async_db.get_users(start, count)]
                     pagination_links = self.generate_pagination(user_count, start, count, DEFAULT_PAGINATION_PAGES)
-                    users = get_users(self.application.db, start, count)
 
                 self.render(u"admin/users.html", options = options, users = users, pagination = pagination_links, error = False, query_filter = query_filter)
             except:
@@ -140,8 +142,9 @@ class AdminUsersHandler(AuthenticatedHandler):
             self.render(u"admin/users.html", options = options, users = [], pagination = [], error = False, query_filter = query_filter)
 
     @authenticated_admin
+    @tornado.gen.coroutine
     def post(self):
-        self.get()
+        yield self.get()
 
 class AdminNewUserHandler(AuthenticatedHandler):
     """
@@ -152,6 +155,7 @@ class AdminNewUserHandler(AuthenticatedHandler):
         self.render(u"admin/new-user.html", options = options, completed = False, error = False)
 
     @authenticated_admin
+    @tornado.gen.coroutine
     def post(self):
         username = self.get_argument("username", "")
         password = self.get_argument("password", "")
@@ -167,14 +171,15 @@ class AdminNewUserHandler(AuthenticatedHandler):
             error = True
         if not password == verify_password:
             error = True
-        if not username_unique(self.application.db, username):
+        unique = yield self.async_db.username_unique(username)
+        if not unique:
             error = True
 
         if not error:
             try:
                 salt = username
-                salted_password = hash_password(password, salt)
-                add_user(self.application.db, username, salted_password, salt, ut)
+                salted_password = yield self.application.passwords.hash(password)
+                yield self.async_db.add_user(username, salted_password, salt, ut)
                 self.render(u"admin/new-user.html", options = options, completed = True, error = False)
             except:
                 self.render(u"admin/new-user.html", options = options, completed = False, error = True)
@@ -186,13 +191,14 @@ class AdminStatisticsHandler(AuthenticatedHandler):
     Handler for rendering the statistics view
     """
     @authenticated_admin
+    @tornado.gen.coroutine
     def get(self):
-        user_count = get_user_count(self.application.db)
-        signup_count = get_signup_count(self.application.db)
-        quarter_count = 0
+        user_count, signup_count, quarter_count = yield [self.async_db.get_user_count(),
+            self.async_db.get_signup_count(), self.async_db.get_quarter_count()]
 
         self.render(u"admin/statistics.html",
-            options = options, user_count = user_count, signup_count = signup_count, quarter_count = quarter_count)
+            options = options, user_count = user_count, signup_count = signup_count, quarter_count = quarter_count,
+            queries = query_stats.stats.histograms())
 
 #
 # Admin API handlers
@@ -219,11 +225,12 @@ class SettingsHandler(AuthenticatedHandler):
             self.respond_with_error(ERROR_RETRIEVE_SETTING)
 
     @authenticated_admin
+    @tornado.gen.coroutine
     def post(self, key):
         try:
             if key:
                 value = self.get_argument("value", "")
-                self.application.quarter_settings.put_value(key, value)
+                yield self.async_db.submit(self.application.quarter_settings.put_value, key, value)
                 self.write({"key" : key, "value" : value})
                 self.finish()
             else:
@@ -234,10 +241,12 @@ class SettingsHandler(AuthenticatedHandler):
 
 class AdminDisableUser(AuthenticatedHandler):
     @authenticated_admin
+    @tornado.gen.coroutine
     def post(self, username):
         if len(username) > 0:
             try:
-                disable_user(self.application.db, username)
+                yield self.async_db.disable_user(username)
+                self.application.sessions.revoke(username)
                 self.write_success()
             except:
                 logging.error("Could not disble user: %s", sys.exc_info())
@@ -248,10 +257,11 @@ class AdminDisableUser(AuthenticatedHandler):
         
 class AdminEnableUser(AuthenticatedHandler):
     @authenticated_admin
+    @tornado.gen.coroutine
     def post(self, username):
         if len(username) > 0:
             try:
-                enable_user(self.application.db, username)
+                yield self.async_db.enable_user(username)
                 self.write_success()
             except:
                 logging.error("Could not enable user: %s", sys.exc_info())
@@ -262,10 +272,12 @@ class AdminEnableUser(AuthenticatedHandler):
 
 class AdminDeleteUser(AuthenticatedHandler):
     @authenticated_admin
+    @tornado.gen.coroutine
     def post(self, username):
         if len(username) > 0:
             try:
-                delete_user(self.application.db, username)
+                yield self.async_db.delete_user(username)
+                self.application.sessions.revoke(username)
                 self.write_success()
             except:
                 logging.error("Could not delete user: %s", sys.exc_info())
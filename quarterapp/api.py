@@ -19,8 +19,8 @@ import sys
 import os
 import json
 import string
-from collections import Counter
 
+import tornado.gen
 import tornado.web
 import tornado.escape
 from tornado.options import options
@@ -30,6 +30,10 @@ from basehandlers import *
 from storage import *
 from quarter_errors import *
 from quarter_utils import *
+from codec import NO_ACTIVITY, QUARTERS_PER_DAY, parse, activity_id
+from domain import summarize
+from reports import period_totals, within_limit, GRANULARITIES, LAST_REPORT_DATE, MAX_REPORT_DAYS
+from report_jobs import ReportJob, MAX_JOB_DAYS
 
 class ActivityApiHandler(AuthenticatedHandler):
     """
@@ -41,12 +45,14 @@ class ActivityApiHandler(AuthenticatedHandler):
         Get the complete list of activities
         """
         user_id  = self.get_current_user_id()
+        if self.not_modified(get_data_version(self.db, user_id)):
+            return
 
-        activities = get_activities(self.application.db, user_id)
+        activities = get_activities(self.db, user_id)
         if not activities:
             activities = []
         
-        self.write( { "activities" : activities } )
+        self.json( { "activities" : activities } )
         self.finish()
 
     @authenticated_user
@@ -69,7 +75,7 @@ class ActivityApiHandler(AuthenticatedHandler):
         if len(errors) > 0:
             self.respond_with_errors(errors)
         else:
-            activity = add_activity(self.application.db, user_id, Activity(title=title, color=Color(color)))
+            activity = add_activity(self.db, user_id, Activity(title=title, color=Color(color)))
             self.json( { "activity" : activity } )
             self.finish()
 
@@ -102,7 +108,7 @@ class ActivityApiHandler(AuthenticatedHandler):
             self.respond_with_errors(errors)
         else:
             activity = Activity(id=activity_id, title=title, color=Color(color), state=state)
-            update_activity(self.application.db, user_id, activity)
+            update_activity(self.db, user_id, activity)
             self.json( { "activity" : activity } )
             self.finish()
 
@@ -121,7 +127,7 @@ class ActivityApiHandler(AuthenticatedHandler):
             if len(errors) > 0:
                 self.respond_with_errors(errors)
             else:
-                delete_activity(self.application.db, user_id, Activity(id=activity_id))
+                delete_activity(self.db, user_id, Activity(id=activity_id))
                 self.write_success()
         except:
             logging.warn("Could not delete activity: %s", sys.exc_info())
@@ -130,33 +136,52 @@ class ActivityApiHandler(AuthenticatedHandler):
 class BaseSheetHandler(AuthenticatedHandler):
     def _default_sheet(self):
         quarters = []
-        for i in range(0, 96):
-            quarters.append({ "id" : -1, "color" : "#fff", "border-color" : "#ccc"})
+        for i in range(0, QUARTERS_PER_DAY):
+            quarters.append({ "id" : NO_ACTIVITY, "color" : "#fff", "border-color" : "#ccc"})
         return quarters
 
     def _sheet_summary(self, quarters, activity_dict):
-        summary_list = []
-        summary_dict = Counter(quarters)
-        summary_total = 0
-        for activity_id in summary_dict:
-            if activity_id == "-1":
-                continue
+        return _summary(summarize(quarters), activity_dict)
 
-            activity_color = "#ccc"
-            activity_title = "Unknown"
+def _summary(counts, activity_dict):
+    """
+    Describe the time spent on each activity
 
-            if long(activity_id) in activity_dict:
-                activity_color = activity_dict[long(activity_id)].color.hex()
-                activity_title = activity_dict[long(activity_id)].title
+    @param counts A list of (activity id, number of quarters) tuples
+    @param activity_dict The user's activities keyed on id
+    @return A tuple of the list of activity summaries and the total number of hours
+    """
+    summary_list = []
+    summary_total = 0
+    for activity_id, count in counts:
+        activity_color = "#ccc"
+        activity_title = "Unknown"
 
-            activity_summary = float(summary_dict[activity_id] / 4.0)
-            summary_total += activity_summary
-            summary_list.append({ "id" : activity_id, "color" : activity_color,
-                "title" : activity_title, "sum" : "%.2f" % activity_summary})
-        return summary_list, "%.2f" % summary_total
+        if activity_id in activity_dict:
+            activity_color = activity_dict[activity_id].color.hex()
+            activity_title = activity_dict[activity_id].title
+
+        activity_summary = count / 4.0
+        summary_total += activity_summary
+        summary_list.append({ "id" : activity_id, "color" : activity_color,
+            "title" : activity_title, "sum" : "%.2f" % activity_summary})
+    return summary_list, "%.2f" % summary_total
+
+def _json_activity_id(value):
+    """
+    Get a quarter's activity id from a JSON list of quarters
+
+    @param value The decoded JSON value
+    @return The id, raises TypeError unless it is an integer and ValueError if it is out of range
+    """
+    # int() would also accept 1.7, true and "3"
+    if isinstance(value, bool) or not isinstance(value, (int, long)):
+        raise TypeError("Activity id %r is not an integer" % (value,))
+    return activity_id(value)
 
 class SheetApiHandler(BaseSheetHandler):
     @authenticated_user
+    @tornado.gen.coroutine
     def put(self, date):
         """
         Update a sheet with the quarters passed and return a map containing
@@ -169,17 +194,22 @@ class SheetApiHandler(BaseSheetHandler):
 
         if not valid_date(date):
             self.respond_with_error(ERROR_INVALID_SHEET_DATE)
+            return
 
         quarters = self.get_argument("quarters", "")
 
         if quarters:
-            quarters_array = quarters.split(',')
-
-            if len(quarters_array) == 96:
-                update_sheet(self.application.db, user_id, date, quarters)
+            try:
+                quarters_array = parse(quarters)
+            except ValueError:
+                self.respond_with_error(ERROR_INVALID_QUARTERS)
+                return
 
-                activities = get_activities(self.application.db, user_id)
-                activity_dict = ActivityDict(activities)
+            if len(quarters_array) == QUARTERS_PER_DAY:
+                # The activities are normally cached, so saving runs a single query
+                result, activity_dict = yield [
+                    self.async_db.update_sheet(user_id, date, quarters_array),
+                    self.async_db.get_activity_dict(user_id)]
                 summary, total = self._sheet_summary(quarters_array, activity_dict)
                 self.write({ "summary" : summary, "total" : total })
                 self.finish()
@@ -188,3 +218,190 @@ class SheetApiHandler(BaseSheetHandler):
         else:
             logging.warn("Could not extract quarters from PUT request")
             self.respond_with_error(ERROR_NO_QUARTERS)
+
+class SheetsApiHandler(BaseSheetHandler):
+    """
+    Bulk update of time sheets, used when back-filling or syncing many days at once.
+    """
+    MAX_SHEETS = 366
+
+    @authenticated_user
+    @tornado.gen.coroutine
+    def put(self):
+        """
+        Update several sheets at once. The request body is a JSON object mapping dates to
+        quarters, either as a list of activity ids or as a comma-separated string:
+
+            { "sheets" : { "2013-05-01" : [-1, -1, 3, ...], "2013-05-02" : "-1,-1,3,..." } }
+
+        All sheets are validated before any is written and then saved in a single
+        transaction.
+
+        @return a JSON map containing the summary and total of each date
+        """
+        user_id  = self.get_current_user_id()
+
+        try:
+            sheets = json.loads(self.request.body)["sheets"]
+            if not isinstance(sheets, dict) or not sheets:
+                raise ValueError("No sheets")
+        except (ValueError, KeyError, TypeError):
+            self.respond_with_error(ERROR_NO_SHEETS)
+            return
+
+        if len(sheets) > self.MAX_SHEETS:
+            self.respond_with_error(ERROR_TOO_MANY_SHEETS)
+            return
+
+        errors = []
+        parsed = {}
+        for date, quarters in sheets.iteritems():
+            # Keys are unicode, normalized so that any digits parsed end up as ASCII
+            date = extract_date(date)
+            if not date:
+                errors.append(ERROR_INVALID_SHEET_DATE)
+                continue
+            date = date.isoformat()
+            try:
+                if isinstance(quarters, basestring):
+                    quarters = parse(quarters)
+                else:
+                    quarters = [_json_activity_id(q) for q in quarters]
+            except (ValueError, TypeError):
+                errors.append(ERROR_INVALID_QUARTERS)
+                continue
+            if len(quarters) != QUARTERS_PER_DAY:
+                errors.append(ERROR_NOT_96_QUARTERS)
+                continue
+            parsed[date] = quarters
+
+        if errors:
+            self.respond_with_errors(errors)
+            return
+
+        saved, activity_dict = yield [
+            self.async_db.update_sheets(user_id, parsed),
+            self.async_db.get_activity_dict(user_id)]
+        result = {}
+        for date, quarters in parsed.iteritems():
+            summary, total = self._sheet_summary(quarters, activity_dict)
+            result[date] = { "summary" : summary, "total" : total }
+        self.write({ "sheets" : result })
+        self.finish()
+
+class BaseReportHandler(AuthenticatedHandler):
+    def _report_arguments(self, limits = MAX_REPORT_DAYS):
+        """
+        Get the report interval and granularity from the start, end and granularity
+        arguments, responding with an error if any is invalid
+
+        @param limits The longest interval in days per granularity
+        @return A tuple of the start date, end date and granularity, or None
+        """
+        start_date = extract_date(self.get_argument("start", ""))
+        end_date = extract_date(self.get_argument("end", ""))
+        granularity = self.get_argument("granularity", "week")
+
+        if not start_date or not end_date:
+            self.respond_with_error(ERROR_INVALID_REPORT_DATE)
+        elif end_date < start_date:
+            self.respond_with_error(ERROR_REPORT_DATE_ORDER)
+        elif end_date > LAST_REPORT_DATE:
+            self.respond_with_error(ERROR_REPORT_TOO_LATE)
+        elif granularity not in GRANULARITIES:
+            self.respond_with_error(ERROR_INVALID_GRANULARITY)
+        elif not within_limit(start_date, end_date, granularity, limits):
+            self.respond_with_error(ERROR_REPORT_TOO_LONG)
+        else:
+            return start_date, end_date, granularity
+        return None
+
+    def _period_summaries(self, periods, activity_dict):
+        result = []
+        for period, counts in periods:
+            summary, total = _summary(counts, activity_dict)
+            result.append({ "period" : period, "summary" : summary, "total" : total })
+        return result
+
+class ReportApiHandler(BaseReportHandler):
+    @authenticated_user
+    @tornado.gen.coroutine
+    def get(self):
+        """
+        Get the time spent on each activity per day, week, month or year within the
+        interval given by the start and end arguments (YYYY-MM-DD). The interval is widened
+        to whole periods, the granularity argument defaults to week.
+
+        @return a JSON map with the summary and total of each period
+        """
+        user_id  = self.get_current_user_id()
+        arguments = self._report_arguments()
+        if not arguments:
+            return
+        start_date, end_date, granularity = arguments
+
+        data_version = yield self.async_db.get_data_version(user_id)
+        if self.not_modified(data_version, start_date, end_date, granularity):
+            return
+
+        periods, activity_dict = yield [
+            self.async_db.run(period_totals, user_id, start_date, end_date, granularity),
+            self.async_db.get_activity_dict(user_id)]
+        self.write({ "periods" : self._period_summaries(periods, activity_dict) })
+        self.finish()
+
+class ReportJobsHandler(BaseReportHandler):
+    """
+    Reports summed up in the background, for intervals too long to wait for. A report is
+    submitted using POST, taking the same arguments as the report API but allowing longer
+    intervals (see MAX_JOB_DAYS), and the returned job is then polled using GET until done.
+    """
+    @authenticated_user
+    @tornado.gen.coroutine
+    def post(self):
+        """
+        Submit a report, an identical report already submitted is not summed up again
+
+        @return a JSON map with the job's id and progress, see get
+        """
+        user_id  = self.get_current_user_id()
+        arguments = self._report_arguments(MAX_JOB_DAYS)
+        if not arguments:
+            return
+
+        version, modified = yield self.async_db.get_data_version(user_id)
+        job = self.application.report_jobs.submit(user_id, *(arguments + (version,)))
+        if not job:
+            self.respond_with_error(ERROR_TOO_MANY_REPORT_JOBS)
+            return
+
+        self.set_status(202)
+        self.set_header("Location", "/report/jobs/%s" % job.id)
+        self.write(self._job_status(job))
+        self.finish()
+
+    @authenticated_user
+    @tornado.gen.coroutine
+    def get(self, job_id = None):
+        """
+        Get the progress of a report, and the summary and total of each period once done
+
+        @param job_id The id returned when the report was submitted
+        @return a JSON map with the job's id, state and number of chunks done out of the
+            total, plus the periods when the state is done
+        """
+        job = self.application.report_jobs.get(job_id)
+        if not job or job.user_id != self.get_current_user_id():
+            self.respond_with_error(ERROR_NO_REPORT_JOB)
+            return
+
+        status = self._job_status(job)
+        if job.state == ReportJob.Done:
+            activity_dict = yield self.async_db.get_activity_dict(job.user_id)
+            status["periods"] = self._period_summaries(job.periods, activity_dict)
+        self.write(status)
+        self.finish()
+
+    def _job_status(self, job):
+        return { "job" : job.id, "state" : job.state, "done" : job.done, "total" : job.total(),
+            "progress" : "%.2f" % job.progress() }
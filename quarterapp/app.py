@@ -16,9 +16,10 @@
 
 import datetime
 import logging
-from collections import Counter
 
+import tornado.gen
 import tornado.web
+from tornado.iostream import StreamClosedError
 from tornado.options import options
 from tornado.web import HTTPError
 
@@ -28,15 +29,21 @@ from storage import *
 from quarter_errors import *
 from quarter_utils import *
 from domain import Activity, Color, Timesheet, Week
+from reports import build_weeks, report_chunks, period_totals, within_limit, GRANULARITIES, LAST_REPORT_DATE
+
+# Where the weeks, or other periods, are inserted in app/report.html
+REPORT_WEEKS_MARKER = "<!-- weeks -->"
+# Written in place of the rest of a report that could not be built
+REPORT_FAILED = u'<div class="error-message">The report could not be completed, please try again</div>'
 
 class ActivityHandler(AuthenticatedHandler):
     @authenticated_user
     def get(self):
         user_id  = self.get_current_user_id()
         
-        activities = get_activities(self.application.db, user_id)
-        enabled_activities = get_enabled_activities(self.application.db, user_id)
-        disabled_activities = get_disabled_activities(self.application.db, user_id)
+        activities = get_activities(self.db, user_id)
+        enabled_activities = get_enabled_activities(self.db, user_id)
+        disabled_activities = get_disabled_activities(self.db, user_id)
 
         self.render(u"app/activities.html",
             options = options,
@@ -46,6 +53,7 @@ class ActivityHandler(AuthenticatedHandler):
 
 class SheetHandler(BaseSheetHandler):
     @authenticated_user
+    @tornado.gen.coroutine
     def get(self, sheet_date = None):
         user_id  = self.get_current_user_id()
         date_obj = None
@@ -61,26 +69,29 @@ class SheetHandler(BaseSheetHandler):
         tomorrow = date_obj + datetime.timedelta(days = 1)
         weekday = date_obj.strftime("%A")
 
-        activities = get_activities(self.application.db, user_id)
-        enabled_activities = get_enabled_activities(self.application.db, user_id)
-        activity_dict = ActivityDict(activities)
+        data_version = yield self.async_db.get_data_version(user_id)
+        if self.not_modified(data_version, date_obj, today):
+            return
 
-        sheet = get_sheet(self.application.db, user_id, date_obj)
+        activities, sheet = yield [
+            self.async_db.get_activities(user_id),
+            self.async_db.get_sheet(user_id, date_obj)]
+        enabled_activities = [a for a in activities if a.enabled()]
+        activity_dict = ActivityDict(activities)
 
         quarters = []
         summary = []
         summary_total = "%.2f" %  0
         if sheet:
-            ids = sheet.split(',')
-            for i in ids:
-                if int(i) > -1:
-                    color = activity_dict[int(i)].color.hex()
-                    border_color = activity_dict[int(i)].color.luminance_color(-0.2).hex() # darken color
+            for i in sheet:
+                if i in activity_dict:
+                    color = activity_dict[i].color.hex()
+                    border_color = activity_dict[i].color.luminance_color(-0.2).hex() # darken color
                     quarters.append({ "id" : i, "color" : color, "border-color" : border_color})
                 else:
                     quarters.append({ "id" : i, "color" : "#fff", "border-color" : "#ccc"})
             
-            summary, summary_total = self._sheet_summary(ids, activity_dict)
+            summary, summary_total = self._sheet_summary(sheet, activity_dict)
         else:
             quarters = self._default_sheet()
         
@@ -101,7 +112,7 @@ class ProfileHandler(AuthenticatedHandler):
     @authenticated_user
     def get(self):
         user_id  = self.get_current_user_id()
-        sheet_count = get_sheet_count(self.application.db, user_id)
+        sheet_count = get_sheet_count(self.db, user_id)
         
         self.render(u"app/profile.html",
             options = options,
@@ -110,6 +121,7 @@ class ProfileHandler(AuthenticatedHandler):
 
 class DeleteAccountHandler(AuthenticatedHandler):
     @authenticated_user
+    @tornado.gen.coroutine
     def post(self):
         password = self.get_argument("password", "")
         username = self.current_user["username"]
@@ -119,19 +131,19 @@ class DeleteAccountHandler(AuthenticatedHandler):
         if len(password) == 0:
             error = "not_valid"
 
-        hashed_password = hash_password(password, username)
-        authenticated = authenticate_user(self.application.db, username, hashed_password)
+        authenticated = yield self.authenticate(username, password)
         if not authenticated:
             error = "not_valid"
 
         if error:
-            sheet_count = get_sheet_count(self.application.db, user_id)
+            sheet_count = get_sheet_count(self.db, user_id)
             self.render(u"app/profile.html",
                 options = options,
                 sheet_count = sheet_count,
                 error = error)
         else:
-            delete_user(self.application.db, username)
+            delete_user(self.db, username)
+            self.application.sessions.revoke(username)
             self.set_current_user(None)
             self.redirect(u"/")
 
@@ -142,12 +154,16 @@ class ReportHandler(AuthenticatedHandler):
             options = options,
             start = None,
             end = None,
-            error = None,
-            weeks = None)
+            granularity = "week",
+            granularities = GRANULARITIES,
+            error = None)
 
+    @authenticated_user
+    @tornado.gen.coroutine
     def post(self):
         start = self.get_argument("start-date", "")
         end = self.get_argument("end-date", "")
+        granularity = self.get_argument("granularity", "week")
         user_id  = self.get_current_user_id()
 
         start_date = extract_date(start)
@@ -160,32 +176,63 @@ class ReportHandler(AuthenticatedHandler):
             error = "end_date_not_valid"
         elif start_date >= end_date:
             error = "end_date_not_later"
-
-        weeks = []
-        start_week = start_date.isocalendar()[1]
-        end_week = end_date.isocalendar()[1]
-        for i in range(start_week, end_week+1):
-            year = start_date.year
-
-            if end_week < start_week: # Report from dec -> jan
-                year = end_date.year
-
-            week = Week(year, i)
-            for blank_sheet in week:
-                quarters = get_sheet(self.application.db, user_id, blank_sheet.date_as_string())
-                sheet = Timesheet(blank_sheet.date, quarters.split(",") if quarters else [])
-                week.update_sheet(sheet)
-            
-            weeks.append(week)
-
-        # Get the activities so we can get correct name in view
-        activities = get_activities(self.application.db, user_id)
-        activity_dict = ActivityDict(activities)
-
-        self.render(u"app/report.html",
+        elif end_date > LAST_REPORT_DATE:
+            error = "end_date_too_late"
+        elif granularity not in GRANULARITIES:
+            error = "granularity_not_valid"
+        elif granularity != "week" and not within_limit(start_date, end_date, granularity):
+            # Weeks are streamed a few at a time, other periods are summed up at once
+            error = "interval_too_long"
+
+        page = self.render_string(u"app/report.html",
             options = options,
             start = start,
             end = end,
-            error = error,
-            weeks = weeks,
-            activities = activity_dict)
+            granularity = granularity,
+            granularities = GRANULARITIES,
+            error = error)
+        if error:
+            self.finish(page)
+            return
+
+        # Send the page up to the report, then each week as soon as it is built
+        head, tail = page.split(REPORT_WEEKS_MARKER, 1)
+        self.write(head)
+        yield self.flush()
+
+        try:
+            yield self._write_report(user_id, start_date, end_date, granularity)
+        except StreamClosedError:
+            return
+        except Exception:
+            # The response is already started, end the page rather than the connection
+            logging.exception("Could not build report for user %s", user_id)
+            self.write(REPORT_FAILED)
+        self.finish(tail)
+
+    @tornado.gen.coroutine
+    def _write_report(self, user_id, start_date, end_date, granularity):
+        """
+        Write the report tables, flushing each week as soon as it is built
+
+        @param user_id The user to report on
+        @param start_date The first date of the report
+        @param end_date The last date of the report
+        @param granularity The period to sum the quarters up per
+        """
+        # Get the activities so we can get correct name in view
+        activity_dict = yield self.async_db.get_activity_dict(user_id)
+        if granularity != "week":
+            periods = yield self.async_db.run(period_totals, user_id, start_date, end_date, granularity)
+            self.write(self.render_string(u"app/report-periods.html",
+                periods = periods,
+                activities = activity_dict))
+            return
+
+        for chunk_start, chunk_end in report_chunks(start_date, end_date):
+            weeks = yield self.async_db.run(build_weeks, user_id, chunk_start, chunk_end)
+            for week in weeks:
+                self.write(self.render_string(u"app/report-week.html",
+                    week = week,
+                    activities = activity_dict))
+                yield self.flush()
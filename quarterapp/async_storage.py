@@ -0,0 +1,113 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import functools
+import logging
+import types
+
+from concurrent.futures import ThreadPoolExecutor
+
+import storage
+
+class AsyncStorage(object):
+    """
+    Non-blocking access to the storage functions. Each call is run on a bounded pool of
+    worker threads using a connection checked out from the connection pool, and returns
+    a Future that can be yielded from a Tornado coroutine.
+
+    Every public function in the storage module is available as a method taking the same
+    arguments, except for the database connection:
+
+        sheet = yield self.async_db.get_sheet(user_id, date)
+
+    @param pool The ConnectionPool to check out connections from
+    @param max_workers The maximum number of queries in flight at once
+    """
+    request_queries = None
+
+    def __init__(self, pool, max_workers):
+        self.pool = pool
+        self.executor = ThreadPoolExecutor(max_workers)
+
+    def bind(self, request_queries):
+        """
+        Get a view sharing this instance's workers that counts the queries it runs on the
+        given RequestQueries
+
+        @param request_queries The RequestQueries of the request
+        @return An AsyncStorage
+        """
+        bound = AsyncStorage.__new__(AsyncStorage)
+        bound.pool = self.pool
+        bound.executor = self.executor
+        bound.request_queries = request_queries
+        return bound
+
+    def run(self, fn, *args, **kwargs):
+        """
+        Run the given storage function on the worker pool
+
+        @param fn The function to run, will be given a database connection as first argument
+        @return A Future resolving to the function's return value
+        """
+        return self.executor.submit(self._call, fn, args, kwargs)
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Run any blocking callable on the worker pool
+
+        @param fn The callable to run
+        @return A Future resolving to the callable's return value
+        """
+        return self.executor.submit(fn, *args, **kwargs)
+
+    def background(self, fn):
+        """
+        Wrap a blocking callable so that calling the wrapper runs it on the worker pool and
+        returns at once, for periodic tasks that must not stall the IOLoop. Errors raised
+        are logged.
+
+        @param fn The callable to run, without arguments
+        @return The wrapper
+        """
+        def run():
+            self.executor.submit(fn).add_done_callback(_log_failure)
+        return run
+
+    def shutdown(self):
+        """
+        Stop accepting new calls and wait for the ones in flight
+        """
+        self.executor.shutdown(wait = True)
+
+    def _call(self, fn, args, kwargs):
+        with self.pool.connection() as db:
+            db.request_queries = self.request_queries
+            try:
+                return fn(db, *args, **kwargs)
+            finally:
+                db.request_queries = None
+
+    def __getattr__(self, name):
+        fn = getattr(storage, name, None)
+        if name.startswith("_") or not isinstance(fn, types.FunctionType) or fn.__module__ != storage.__name__:
+            raise AttributeError(name)
+        return functools.partial(self.run, fn)
+
+def _log_failure(future):
+    error = future.exception()
+    if error is not None:
+        logging.error("Background task failed: %s", error)
@@ -14,23 +14,30 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import email.utils
 import logging
 import math
+import time
 import sys
 import os
 import json
 import functools
 
+import tornado.gen
 import tornado.web
 from tornado import escape
 from tornado.options import options
 from tornado.escape import utf8
 
 from storage import *
+from query_stats import RequestQueries
 from quarter_errors import *
 from settings import *
 from domain import *
 
+# Part of every ETag, changes when the application is restarted as templates may have changed
+ETAG_PREFIX = "%x" % int(time.time())
+
 class QuarterEncoder(json.JSONEncoder):
     """
     JSON encoder for error objects
@@ -59,20 +66,77 @@ def authenticated_user(method):
 def authenticated_admin(method):
     """
     Decorate methods with this to require that user is admin, if not, render 404 (to avoid exposing admin part)
+
+    The decorated method becomes a coroutine, it may itself be a coroutine.
     """
     @functools.wraps(method)
+    @tornado.gen.coroutine
     def wrapper(self, *args, **kwargs):
         if not self.current_user:
             raise tornado.web.HTTPError(404)
-        elif not is_admin(self.application.db, self.current_user["username"]):
+        role = yield self.async_db.get_user_role(self.current_user["id"])
+        if not role or role[0] != User.Administrator:
             raise tornado.web.HTTPError(404)
-        return method(self, *args, **kwargs)
+        result = method(self, *args, **kwargs)
+        if result is not None:
+            yield result
     return wrapper
 
 class BaseHandler(tornado.web.RequestHandler):
     """
     Base handler for any handler in quarterapp, contains some utility functions
     """
+    _db = None
+    _async_db = None
+    _queries = None
+
+    @property
+    def queries(self):
+        """
+        The number of queries and their total time run on behalf of this request
+        """
+        if self._queries is None:
+            self._queries = RequestQueries()
+        return self._queries
+
+    @property
+    def db(self):
+        """
+        The database connection used by this request. The connection is checked out from the
+        application's connection pool on first use and returned when the request is finished.
+        """
+        if self._db is None:
+            self._db = self.application.db_pool.checkout()
+            self._db.request_queries = self.queries
+        return self._db
+
+    @property
+    def async_db(self):
+        """
+        The non-blocking storage API, see AsyncStorage
+        """
+        if self._async_db is None:
+            self._async_db = self.application.async_db.bind(self.queries)
+        return self._async_db
+
+    @tornado.gen.coroutine
+    def prepare(self):
+        # A session not cached in this process is read from the session database on the
+        # storage workers, so that current_user never blocks the IOLoop
+        sessions = self.application.sessions
+        token = self._session_token()
+        if not sessions.cached(token):
+            self.current_user = yield self.async_db.submit(sessions.get, token)
+
+    def on_finish(self):
+        if self._db is not None:
+            self._db.request_queries = None
+            self.application.db_pool.checkin(self._db)
+            self._db = None
+        if self._queries is not None:
+            logging.debug("%s %s ran %d queries in %.1f ms (%d rows)", self.request.method,
+                self.request.uri, self._queries.count, self._queries.elapsed, self._queries.rows)
+
     def json(self, chunk):
         chunk = QuarterEncoder().encode(chunk).replace("'", "\"")
         chunk = utf8(chunk)
@@ -132,11 +196,39 @@ class BaseHandler(tornado.web.RequestHandler):
 
         @return True if logged in, else False
         """
-        user = self.get_secure_cookie("user")
+        return self.current_user is not None
+
+    def get_current_user(self):
+        """
+        Look up the session of the request's cookie, use current_user instead as it only
+        does this once per request
+        """
+        return self.application.sessions.get(self._session_token())
+
+    def set_current_user(self, user):
+        """
+        Start a new session for the given user, or end the current session
+
+        @param user The user object to log in, None to log out
+        """
+        sessions = self.application.sessions
+        sessions.delete(self._session_token())
         if user:
-            return True
+            self.set_secure_cookie("user", sessions.create(user),
+                expires_days = sessions.ttl / 86400.0)
         else:
-            return False
+            self.clear_cookie("user")
+        self.current_user = user
+
+    def _session_token(self):
+        # The cookie is valid as long as the session, not Tornado's default of 31 days
+        return self.get_secure_cookie("user", max_age_days = self.application.sessions.ttl / 86400.0)
+
+    def get_current_user_id(self):
+        user = self.current_user
+        if user:
+            return user["id"]
+        return None
 
     def setting_value(self, key):
         """
@@ -150,23 +242,54 @@ class AuthenticatedHandler(BaseHandler):
     """
     Base class for any handler that needs user to be authenticated
     """
-    def get_current_user(self):
-        user_json = self.get_secure_cookie("user")
-        if not user_json:
-            return None
-        return tornado.escape.json_decode(user_json)
+    def not_modified(self, data_version, *keys):
+        """
+        Set the ETag and Last-Modified headers of a response built from the current user's
+        data and respond with 304 Not Modified if the client already has it. Call before
+        building the response, if True is returned the request is finished.
 
-    def set_current_user(self, user):
-        if user:
-            self.set_secure_cookie("user", tornado.escape.json_encode(user))
-        else:
-            self.clear_cookie("user")
+        @param data_version The user's data version, as returned by get_data_version
+        @param keys Anything else the response depends on, e.g. the date shown
+        @return True if the client's copy is current, else False
+        """
+        version, modified = data_version
+        etag = '"%s"' % "-".join(str(part) for part in
+            (ETAG_PREFIX, self.application.quarter_settings.version, self.get_current_user_id(), version) + keys)
+        self.set_header("Etag", etag)
+        self.set_header("Cache-Control", "private, no-cache")
+        if modified:
+            self.set_header("Last-Modified", email.utils.formatdate(modified, usegmt = True))
+
+        tags = [tag.strip() for tag in self.request.headers.get("If-None-Match", "").split(",")]
+        if etag in tags or "W/" + etag in tags or "*" in tags:
+            self.set_status(304)
+            self.finish()
+            return True
+        return False
+
+    @tornado.gen.coroutine
+    def authenticate(self, username, password):
+        """
+        Verify a user's password on the password hasher's workers. A hash stored using an
+        older scheme is replaced once the password is verified.
+
+        @param username The username to authenticate
+        @param password The plain text password
+        @return A Future resolving to the user object (except the password) or None
+        """
+        credentials = yield self.async_db.get_credentials(username)
+        if not credentials or not password:
+            raise tornado.gen.Return(None)
+        user, stored, salt = credentials
+        passwords = self.application.passwords
+        matches = yield passwords.verify(password, stored, salt)
+        if not matches:
+            raise tornado.gen.Return(None)
+        if passwords.needs_upgrade(stored):
+            upgraded = yield passwords.hash(password)
+            yield self.async_db.upgrade_password(user["id"], stored, upgraded)
+        raise tornado.gen.Return(user)
 
-    def get_current_user_id(self):
-        user = self.get_current_user()
-        if user:
-            return user["id"]
-        return None
 
 class IndexHandler(BaseHandler):
     def get(self):
@@ -0,0 +1,143 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+
+from collections import OrderedDict
+
+class LRUCache(object):
+    """
+    A thread safe in-process cache, evicting the least recently used entry when full and
+    entries older than the time to live.
+
+    Values are loaded using load, which does not store a value loaded while the cache was
+    invalidated, so a reader racing a writer can not put back a stale value. None is never
+    cached by load, so a missing value is looked up again on the next call.
+
+    @param max_size The maximum number of entries
+    @param ttl Seconds an entry is kept, None to keep entries until evicted
+    """
+    def __init__(self, max_size = 1000, ttl = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default = None):
+        """
+        Get a cached value
+
+        @param key The key of the value
+        @param default Returned if the key is not cached or has expired
+        @return The cached value or default
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            if self.ttl is not None and time.time() - entry[1] > self.ttl:
+                return default
+            self._entries[key] = entry # Most recently used last
+            return entry[0]
+
+    def put(self, key, value, generation = None):
+        """
+        Cache a value, evicting the least recently used entry if full
+
+        @param key The key of the value
+        @param value The value to cache
+        @param generation If given, the value is only cached if nothing has been invalidated
+            since generation was called to get this value
+        """
+        with self._lock:
+            if generation is None or generation == self._invalidations:
+                self._put(key, value)
+
+    def generation(self):
+        """
+        Get the current invalidation count, call before loading values to put
+        """
+        return self._invalidations
+
+    def load(self, key, loader, *args):
+        """
+        Get a cached value, loading and caching it if missing
+
+        @param key The key of the value
+        @param loader Called with args to load the value if not cached
+        @return The value
+        """
+        missing = object()
+        value = self.get(key, missing)
+        if value is not missing:
+            return value
+
+        generation = self._invalidations
+        value = loader(*args)
+        if value is not None:
+            self.put(key, value, generation)
+        return value
+
+    def invalidate(self, key):
+        """
+        Remove a value from the cache
+
+        @param key The key of the value
+        """
+        with self._lock:
+            self._invalidations += 1
+            self._entries.pop(key, None)
+
+    def evict(self, predicate):
+        """
+        Remove all values whose key matches the predicate
+
+        @param predicate Called with each key, returns True for keys to remove
+        """
+        with self._lock:
+            self._invalidations += 1
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
+
+    def evict_values(self, predicate):
+        """
+        Remove all values matching the predicate
+
+        @param predicate Called with each value, returns True for values to remove
+        """
+        with self._lock:
+            self._invalidations += 1
+            for key in [key for key, entry in self._entries.iteritems() if predicate(entry[0])]:
+                del self._entries[key]
+
+    def clear(self):
+        """
+        Remove all values from the cache
+        """
+        with self._lock:
+            self._invalidations += 1
+            self._entries.clear()
+
+    def _put(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = (value, time.time())
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last = False)
@@ -0,0 +1,117 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Encoding of a day's quarters as stored in the sheets table.
+
+A day is encoded as:
+
+    version     1 byte, currently 1
+    size        1 byte, the number of distinct activities during the day
+    activities  size * 4 bytes, the distinct activity ids as little-endian unsigned ints
+    quarters    96 bytes, one per quarter, 0 for no activity or the activity's
+                position in the table above plus one
+
+A day without any activity is stored as an empty string. Sheets stored before this
+format was introduced are comma-separated strings of activity ids, they are still
+decoded. The version byte is never a digit or a minus sign so the formats cannot be
+mistaken for each other.
+"""
+
+import struct
+
+QUARTERS_PER_DAY = 96
+NO_ACTIVITY = -1
+VERSION = 1
+
+# Activity ids are summarized as signed 32 bit integers, see domain.quarter_array
+MAX_ACTIVITY_ID = 2 ** 31 - 1
+
+_HEADER = struct.Struct("<BB")
+_QUARTERS = struct.Struct("<%dB" % QUARTERS_PER_DAY)
+_VERSION_MARKER = chr(VERSION)
+
+def encode(quarters):
+    """
+    Encode a day's quarters
+
+    @param quarters The 96 activity ids of the day (as integers or strings)
+    @return The encoded day, an empty string if no quarter has an activity, raises
+        ValueError if any id is not an activity id
+    """
+    quarters = [activity_id(q) for q in quarters]
+    if len(quarters) != QUARTERS_PER_DAY:
+        raise ValueError("Expected %d quarters, not %d" % (QUARTERS_PER_DAY, len(quarters)))
+
+    table = sorted(set(quarters) - set([NO_ACTIVITY]))
+    if not table:
+        return ""
+
+    positions = dict((activity_id, i + 1) for i, activity_id in enumerate(table))
+    positions[NO_ACTIVITY] = 0
+    return (_HEADER.pack(VERSION, len(table)) +
+        struct.pack("<%dI" % len(table), *table) +
+        _QUARTERS.pack(*[positions[q] for q in quarters]))
+
+def decode(data):
+    """
+    Decode a day's quarters
+
+    @param data The encoded day, either the binary or the legacy comma-separated format
+    @return A list of 96 activity ids, or an empty list for a day without activities
+    """
+    if not data:
+        return []
+    data = str(data) # SQLite returns BLOBs as buffers
+
+    if is_legacy(data):
+        return parse(data)
+
+    size = ord(data[1])
+    table = (NO_ACTIVITY,) + struct.unpack_from("<%dI" % size, data, _HEADER.size)
+    positions = _QUARTERS.unpack_from(data, _HEADER.size + 4 * size)
+    return [table[p] for p in positions]
+
+def is_legacy(data):
+    """
+    Check if an encoded day is stored in the legacy comma-separated format
+
+    @param data The encoded day
+    @return True if the day needs to be re-encoded, else False
+    """
+    return bool(data) and str(data)[0] != _VERSION_MARKER
+
+def parse(text):
+    """
+    Parse a comma-separated string of activity ids, as sent by clients and stored
+    by earlier versions
+
+    @param text The comma-separated activity ids
+    @return A list of activity ids, raises ValueError if any id is not an activity id
+    """
+    return [activity_id(q) for q in text.split(",")]
+
+def activity_id(value):
+    """
+    Convert a quarter's activity id to an integer
+
+    @param value The id as an integer or a string
+    @return The id, raises ValueError unless it is NO_ACTIVITY or an id that can be stored
+    """
+    value = int(value)
+    if not NO_ACTIVITY <= value <= MAX_ACTIVITY_ID:
+        raise ValueError("Activity id %d out of range" % value)
+    return value
@@ -16,13 +16,47 @@
 
 from datetime import date, timedelta, datetime
 from exceptions import Exception, OverflowError
-from collections import Counter
+from array import array
 import operator
 import re
 import math
 
+from codec import NO_ACTIVITY, QUARTERS_PER_DAY
+
 color_hex_match_re = re.compile(r"^(#)([0-9a-fA-F]{3})([0-9a-fA-F]{3})?$")
 
+# The quarters of every day without activities, shared and immutable
+EMPTY_DAY = (NO_ACTIVITY,) * QUARTERS_PER_DAY
+_NO_ACTIVITIES = ()
+_NO_ACTIVITY_IDS = {}
+
+def quarter_array(quarters):
+    """
+    Get a day's quarters as an array of integer activity ids
+
+    @param quarters The quarters as an array, or a list of integers or strings
+    @return The quarters as array('i'), the given array is not copied
+    """
+    if isinstance(quarters, array):
+        return quarters
+    try:
+        return array("i", quarters)
+    except TypeError:
+        return array("i", [int(q) for q in quarters])
+
+def summarize(quarters):
+    """
+    Count the quarters spent on each activity during a day. Used for sheets shown,
+    saved and reported, so they are always summarized the same way.
+
+    @param quarters The quarters of the day, see quarter_array
+    @return A list of (activity id, number of quarters) tuples sorted on id, quarters
+        without activity are left out
+    """
+    quarters = quarter_array(quarters)
+    return [(activity_id, quarters.count(activity_id)) for activity_id in sorted(set(quarters))
+        if activity_id != NO_ACTIVITY]
+
 class BaseError(Exception):
     def __init__(self, message):
         self.message = message
@@ -53,8 +87,16 @@ class ActivityDict(dict):
 class Color(object):
     """
     Represents a CSS color but only supports HEX format
+
+    Colors are immutable and interned, creating a color with the same hex value as an
+    existing one returns the existing object without validating the value again.
     """
-    def __init__(self, hex):
+    __slots__ = ("hex_value", "_variants")
+
+    MAX_INTERNED = 10000
+    _interned = {}
+
+    def __new__(cls, hex):
         """
         Creates a color object, will raise InvalidColorError if the
         given hex value is not correct.
@@ -62,9 +104,21 @@ class Color(object):
         @param hex The hex value of this color
         @return A Color object
         """
+        color = cls._interned.get(hex)
+        if color is not None:
+            return color
+
         if not color_hex_match_re.match(hex):
             raise InvalidColorError("Not a valid HEX color code")
-        self.hex_value = hex
+        color = object.__new__(cls)
+        color.hex_value = hex
+        color._variants = {}
+        if len(cls._interned) < cls.MAX_INTERNED:
+            color = cls._interned.setdefault(hex, color)
+        return color
+
+    def __reduce__(self):
+        return (Color, (self.hex_value,))
 
     def hex(self):
         """
@@ -80,8 +134,14 @@ class Color(object):
         negative to generate a darker color.
 
         @param lum Percentage luminance to alter. 
-        @return A new Color object
+        @return A Color object, computed once per color and luminance
         """
+        variant = self._variants.get(lum)
+        if variant is None:
+            variant = self._variants[lum] = self._luminance_color(lum)
+        return variant
+
+    def _luminance_color(self, lum):
         color_code = self.hex_value.replace("#", "")
         lum = lum or 0;
         
@@ -103,19 +163,44 @@ class Color(object):
 class Week(object):
     """
     A week always contains 7 time sheets, no more no less.
+
+    Days are kept sparse, only the sheets given to update_sheet are stored. Empty sheets
+    for the other days are created when accessed, so summing up a week costs time
+    proportional to the days reported.
     """
+    __slots__ = ("year", "week", "first_date", "_days", "_aggregated")
 
     def __init__(self, year, week):
         self.year = year
         self.week = week
-        self.sheets = []
-        self._create_default_sheets()
-        
-    def _create_default_sheets(self):
-        first = self._week_start_date(self.year, self.week)
-        for i in range(7):
-            delta = timedelta(days = i)
-            self.sheets.append(Timesheet(first  + delta))
+        self.first_date = self._week_start_date(year, week)
+        self._days = [None] * 7
+        self._aggregated = None
+
+    @property
+    def sheets(self):
+        """
+        The 7 time sheets of the week, Monday first
+        """
+        return [self.sheet(weekday) for weekday in range(7)]
+
+    def sheet(self, weekday):
+        """
+        Get the time sheet of a day
+
+        @param weekday The day of the week, 0 for Monday
+        @return The Timesheet, an empty one if no sheet is reported
+        """
+        sheet = self._days[weekday]
+        if sheet is None:
+            sheet = self._days[weekday] = Timesheet(self.first_date + timedelta(days = weekday))
+        return sheet
+
+    def last_date(self):
+        """
+        Get the date of the week's Sunday
+        """
+        return self.first_date + timedelta(days = 6)
 
     def _week_start_date(self, year, week):
         # From SO http://stackoverflow.com/a/1287862
@@ -133,17 +218,15 @@ class Week(object):
 
         @return The total number of hours this week
         """
-        accumelator = 0
-        for sheet in self.sheets:
-            accumelator += sheet.total()
-        return accumelator
+        return self._aggregate()[1]
 
     def update_sheet(self, sheet):
         """
         Updates the sheet with the given sheet
         """
         # TODO Check that sheet is within range
-        self.sheets[sheet.weekday] = sheet
+        self._days[sheet.weekday] = sheet
+        self._aggregated = None
 
     def week_of_year(self):
         """
@@ -156,28 +239,25 @@ class Week(object):
         Get a sorted unique list of all the weeks activities where the
         activities amount is sumed up
         """
-        all_activities = []
-        unique_activities = []
-        for sheet in self.sheets:
-            all_activities += sheet.activities
-
-        # Filter out any duplicates and merge the amount of time spent
-        for aa in all_activities:
-            matches = list((ua for ua in unique_activities if ua.id == aa.id))
-            if len(matches) > 0:
-                # Item already exist in list of unique activities
-                # Mutable data, yay!
-                updated_activity = Activity(aa.id, aa.amount + matches[0].amount)
-                
-                unique_activities.remove(matches[0])
-                unique_activities.append(updated_activity)
-            else:
-                unique_activities.append(aa)
-
-        # Sort on id
-        unique_activities.sort(key = lambda x: int(x.id))
-        return unique_activities
+        return self._aggregate()[0]
 
+    def _aggregate(self):
+        """
+        Sum up the week's activities in a single pass over the sheets, the result is kept
+        until a sheet is updated
+        """
+        if self._aggregated is None:
+            totals = {}
+            week_total = 0
+            for sheet in self._days:
+                if sheet is None:
+                    continue
+                for activity in sheet.activities:
+                    totals[activity.id] = totals.get(activity.id, 0) + activity.amount
+                week_total += sheet.total()
+            activities = [Activity(activity_id, totals[activity_id]) for activity_id in sorted(totals)]
+            self._aggregated = (activities, week_total)
+        return self._aggregated
 
     # Built in python support
     def __iter__(self):
@@ -200,58 +280,71 @@ class Timesheet(object):
     A timesheet is the 96 quarters that constitutes a day. This class also contains
     utility functions for getting summarized info of activities spent on that day.
 
-    If no quarters is given a default list of "No work" activities will be created
+    If no quarters is given the sheet shares the immutable EMPTY_DAY quarters and has no
+    activities
 
-    The activities are always sorted ascending on id.
+    The quarters are kept as an array of integer activity ids and the activities are
+    always sorted ascending on id.
 
     Activities can be accessed by id using sheet[id]
 
     @param date The date for this weekday
-    @param quarters An array of quarters containing the activity ids (must be 96)
+    @param quarters An array of quarters containing the activity ids, as integers or strings (must be 96)
     """
+    __slots__ = ("date", "weekday", "activities", "quarters", "iterator_index", "_by_id", "_total")
     
     def __init__(self, date, quarters=[]):
         if not quarters:
             quarters = []
         
-        if len(quarters) != 0 and len(quarters) != 96:
+        if len(quarters) != 0 and len(quarters) != QUARTERS_PER_DAY:
             raise NotFullDayError("A timesheet must contain 96 quarters or none, not %d" % len(quarters))
 
         self.date = date
         self.weekday = date.weekday() # 0 based
-        self.activities = [] # Summarized list of activities
-        self.quarters = []
         self.iterator_index = 0
-        self._create_sheet(quarters)
-        self._summarize()
-        
-    def _create_sheet(self, quarters):
-        if len(quarters) == 0 or quarters == None:
-            for i in range(0, 96):
-                self.quarters.append("-1")
+        if len(quarters) == 0:
+            self.quarters = EMPTY_DAY
+            self.activities = _NO_ACTIVITIES
+            self._by_id = _NO_ACTIVITY_IDS
+            self._total = 0
         else:
-            self.quarters = quarters
+            self.quarters = quarter_array(quarters)
+            self._summarize(summarize(self.quarters))
 
-    def _summarize(self):
+    @classmethod
+    def from_totals(cls, date, totals):
         """
-        Summarize the quarters and create activities for the sums
+        Create a timesheet from the number of quarters spent on each activity, as stored
+        in the sheet totals. The order of the quarters is not known, quarters is None.
+
+        @param date The date for this weekday
+        @param totals A list of (activity id, number of quarters) tuples sorted on id
+        @return A Timesheet
         """
-        summary = Counter(self.quarters)
-        for aid in summary:
-            if aid == "-1":
-                continue
-            self.activities.append(Activity(aid, float(summary[aid] / 4.0)))
-        self.activities.sort(key = lambda x: int(x.id))
+        sheet = cls(date)
+        sheet.quarters = None
+        sheet._summarize(totals)
+        return sheet
+
+    def _summarize(self, counts):
+        """
+        Create activities for the number of quarters spent on each activity
+        """
+        self.activities = [] # Summarized list of activities
+        self._by_id = {}
+        self._total = 0
+        for activity_id, count in counts:
+            activity = Activity(activity_id, count / 4.0)
+            self.activities.append(activity)
+            self._by_id[activity_id] = activity
+            self._total += activity.amount
 
     def total(self):
         """
         Get the total number of hours worth of activities for this day
         """
-        accumelator = 0
-        for act in self.activities:
-            accumelator += act.total()
-
-        return accumelator
+        return self._total
 
     def date_as_string(self):
         """
@@ -260,9 +353,15 @@ class Timesheet(object):
         return self.date.strftime("%Y-%m-%d")
 
     def time(self, activity_id):
-        for activity in self.activities:
-            if activity.id == activity_id:
-                return activity.amount
+        """
+        Get the number of hours spent on the given activity this day
+
+        @param activity_id The id of the activity
+        @return The number of hours, 0 if none
+        """
+        activity = self._by_id.get(int(activity_id))
+        if activity:
+            return activity.amount
         return 0
 
     # Iterator protocol
@@ -274,12 +373,7 @@ class Timesheet(object):
 
     #  protocol
     def __getitem__(self, activity_id):
-        try:
-            for activity in self.activities:
-                if activity.id == activity_id:
-                    return activity
-        except KeyError:
-            raise AttributeError(name)
+        return self._by_id.get(int(activity_id))
 
 
 class Activity(object):
@@ -290,6 +384,8 @@ class Activity(object):
 
     An activity cannot be more than 24 hours (96 quarters)
     """
+    __slots__ = ("id", "amount", "color", "title", "state")
+
     # State value
     Enabled = 1
     Disabled = 0
@@ -301,6 +397,12 @@ class Activity(object):
         self.title = title
         self.state = state
 
+    def copy(self):
+        """
+        Get a copy of this activity, sharing the (immutable) color
+        """
+        return Activity(self.id, self.amount, self.color, self.title, self.state)
+
     def total(self):
         """
         Get the total number of hours for this activity
@@ -0,0 +1,244 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+
+import codec
+import storage
+
+class Migration(object):
+    """
+    A single schema change, identified by a version number. A migration consists of SQL
+    statements for each supported dialect and an optional function that is called with
+    the database connection after the statements have been executed (for data changes).
+
+    @param version The schema version this migration brings the database to
+    @param description A short description of the change
+    @param mysql List of statements to execute on MySQL
+    @param sqlite List of statements to execute on SQLite
+    @param function Optional function taking the database connection
+    """
+    def __init__(self, version, description, mysql = [], sqlite = [], function = None):
+        self.version = version
+        self.description = description
+        self.statements = { "mysql" : mysql, "sqlite" : sqlite }
+        self.function = function
+
+    def apply(self, db):
+        for sql in self.statements[db.dialect]:
+            db.execute(sql)
+        if self.function:
+            self.function(db)
+
+def _encode_legacy_sheets(db, batch_size = 500):
+    """
+    Re-encode sheets stored in the comma-separated format using the binary format
+    """
+    last_id = 0
+    while True:
+        sheets = db.query("SELECT id, quarters FROM sheets WHERE id > %(id)s ORDER BY id LIMIT %(count)s;",
+            { "id" : last_id, "count" : batch_size })
+        if not sheets:
+            break
+        for sheet in sheets:
+            if codec.is_legacy(sheet.quarters):
+                db.execute("UPDATE sheets SET quarters=%(quarters)s WHERE id=%(id)s;",
+                    { "quarters" : db.binary(codec.encode(codec.decode(sheet.quarters))), "id" : sheet.id })
+        last_id = sheets[-1].id
+
+def _add_sqlite_columns(table, columns):
+    """
+    Create a migration function adding the columns missing from a SQLite table, since
+    SQLite lacks ADD COLUMN IF NOT EXISTS
+
+    @param table The table to alter
+    @param columns List of (name, definition) tuples
+    """
+    def add_columns(db):
+        if db.dialect != "sqlite":
+            return
+        existing = [row[1] for row in db.query_tuples("PRAGMA table_info(%s);" % table)]
+        for name, definition in columns:
+            if name not in existing:
+                db.execute("ALTER TABLE %s ADD COLUMN %s %s;" % (table, name, definition))
+    return add_columns
+
+MIGRATIONS = [
+    Migration(1, "Indexes for user, login, activation and per user sheet lookups",
+        mysql = [
+            "ALTER TABLE activities ADD INDEX `user` (`user`, `state`);",
+            "ALTER TABLE sheets DROP INDEX `date`, ADD UNIQUE KEY `user_date` (`user`, `date`);",
+            "ALTER TABLE users ADD INDEX `username` (`username`(255)), ADD INDEX `reset_code` (`reset_code`);",
+            "ALTER TABLE signups ADD UNIQUE KEY `username` (`username`(255)), ADD INDEX `activation_code` (`activation_code`);"
+        ],
+        sqlite = [
+            "CREATE INDEX IF NOT EXISTS activities_user ON activities (user, state);",
+            "CREATE UNIQUE INDEX IF NOT EXISTS sheets_user_date ON sheets (user, date);",
+            "CREATE INDEX IF NOT EXISTS users_username ON users (username);",
+            "CREATE INDEX IF NOT EXISTS users_reset_code ON users (reset_code);",
+            "CREATE UNIQUE INDEX IF NOT EXISTS signups_username ON signups (username);",
+            "CREATE INDEX IF NOT EXISTS signups_activation_code ON signups (activation_code);"
+        ]),
+    Migration(2, "Binary encoded sheet quarters",
+        mysql = [
+            "ALTER TABLE sheets MODIFY `quarters` BLOB NOT NULL;"
+        ],
+        function = _encode_legacy_sheets),
+    Migration(3, "Version counters for cheap change checks",
+        mysql = [
+            """CREATE TABLE IF NOT EXISTS `versions` (
+                `name` VARCHAR(64) NOT NULL,
+                `version` BIGINT UNSIGNED NOT NULL DEFAULT '0',
+                PRIMARY KEY (`name`)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8;""",
+            "INSERT IGNORE INTO versions (`name`, `version`) VALUES('settings', 0);"
+        ],
+        sqlite = [
+            """CREATE TABLE IF NOT EXISTS `versions` (
+                `name` VARCHAR(64) PRIMARY KEY,
+                `version` INTEGER NOT NULL DEFAULT '0'
+            );""",
+            "INSERT OR IGNORE INTO versions (`name`, `version`) VALUES('settings', 0);"
+        ]),
+    Migration(4, "Per user data version for conditional requests",
+        mysql = [
+            "ALTER TABLE users ADD COLUMN `data_version` INT(11) UNSIGNED NOT NULL DEFAULT '0', "
+                "ADD COLUMN `data_modified` INT(11) UNSIGNED NOT NULL DEFAULT '0';"
+        ],
+        function = _add_sqlite_columns("users", [
+            ("data_version", "INTEGER NOT NULL DEFAULT '0'"),
+            ("data_modified", "INTEGER NOT NULL DEFAULT '0'")])),
+    Migration(5, "Room for salted password hashes",
+        mysql = [
+            "ALTER TABLE users MODIFY `password` VARCHAR(255) NOT NULL DEFAULT '';"
+        ]),
+    Migration(6, "Time per activity and day",
+        mysql = [
+            """CREATE TABLE IF NOT EXISTS `sheet_totals` (
+                `user` INT(11) NOT NULL,
+                `date` DATE NOT NULL,
+                `activity` INT(11) NOT NULL,
+                `quarters` SMALLINT UNSIGNED NOT NULL,
+                PRIMARY KEY (`user`, `date`, `activity`)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8;"""
+        ],
+        sqlite = [
+            """CREATE TABLE IF NOT EXISTS `sheet_totals` (
+                `user` INT(11) NOT NULL,
+                `date` DATE NOT NULL,
+                `activity` INT(11) NOT NULL,
+                `quarters` SMALLINT NOT NULL,
+                PRIMARY KEY (`user`, `date`, `activity`)
+            );"""
+        ],
+        function = storage.backfill_sheet_totals),
+    Migration(7, "Time per activity and month or year",
+        mysql = [
+            """CREATE TABLE IF NOT EXISTS `monthly_totals` (
+                `user` INT(11) NOT NULL,
+                `year` SMALLINT NOT NULL,
+                `month` TINYINT NOT NULL,
+                `activity` INT(11) NOT NULL,
+                `quarters` INT(11) NOT NULL,
+                PRIMARY KEY (`user`, `year`, `month`, `activity`)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8;""",
+            """CREATE TABLE IF NOT EXISTS `yearly_totals` (
+                `user` INT(11) NOT NULL,
+                `year` SMALLINT NOT NULL,
+                `activity` INT(11) NOT NULL,
+                `quarters` INT(11) NOT NULL,
+                PRIMARY KEY (`user`, `year`, `activity`)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8;"""
+        ],
+        sqlite = [
+            """CREATE TABLE IF NOT EXISTS `monthly_totals` (
+                `user` INT(11) NOT NULL,
+                `year` SMALLINT NOT NULL,
+                `month` TINYINT NOT NULL,
+                `activity` INT(11) NOT NULL,
+                `quarters` INT(11) NOT NULL,
+                PRIMARY KEY (`user`, `year`, `month`, `activity`)
+            );""",
+            """CREATE TABLE IF NOT EXISTS `yearly_totals` (
+                `user` INT(11) NOT NULL,
+                `year` SMALLINT NOT NULL,
+                `activity` INT(11) NOT NULL,
+                `quarters` INT(11) NOT NULL,
+                PRIMARY KEY (`user`, `year`, `activity`)
+            );"""
+        ],
+        function = storage.rebuild_rollups),
+]
+
+_VERSION_TABLE = {
+    "mysql" : """CREATE TABLE IF NOT EXISTS `schema_version` (
+        `version` INT(11) UNSIGNED NOT NULL,
+        `description` VARCHAR(128) NOT NULL DEFAULT '',
+        `applied` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (`version`)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8;""",
+    "sqlite" : """CREATE TABLE IF NOT EXISTS `schema_version` (
+        `version` INTEGER PRIMARY KEY,
+        `description` VARCHAR(128) NOT NULL DEFAULT '',
+        `applied` TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );"""
+}
+
+def latest_version():
+    """
+    Get the schema version of the most recent migration
+    """
+    return MIGRATIONS[-1].version
+
+def current_version(db):
+    """
+    Get the schema version of the database, the version table is created if missing
+
+    @param db The database connection to use
+    @return The version of the last applied migration, 0 if none is applied
+    """
+    db.execute(_VERSION_TABLE[db.dialect])
+    result = db.query("SELECT MAX(version) AS version FROM schema_version;")
+    if result and result[0].version:
+        return int(result[0].version)
+    return 0
+
+def pending_migrations(db):
+    """
+    Get the migrations not yet applied to the database
+
+    @param db The database connection to use
+    @return List of Migration objects, in the order they should be applied
+    """
+    version = current_version(db)
+    return [m for m in MIGRATIONS if m.version > version]
+
+def migrate(db):
+    """
+    Apply all pending migrations in order, recording each version once applied. Stops at
+    the first failing migration, leaving the database at the last successful version.
+
+    @param db The database connection to use
+    @return The schema version of the database
+    """
+    version = current_version(db)
+    for migration in [m for m in MIGRATIONS if m.version > version]:
+        logging.info("Migrating database to version %d: %s", migration.version, migration.description)
+        migration.apply(db)
+        db.execute("INSERT INTO schema_version (version, description) VALUES(%(version)s, %(description)s);",
+            { "version" : migration.version, "description" : migration.description })
+        version = migration.version
+    return version
@@ -0,0 +1,125 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import logging
+import os
+import socket
+
+import tornado.ioloop
+
+class Notifier(object):
+    """
+    Signals the other quarterapp processes running on the same host, e.g. to reload their
+    settings when changed by this process.
+
+    Each process binds a Unix datagram socket in a directory shared by all processes. A
+    topic is published by sending it to every other socket in the directory, the receiving
+    processes then run the callbacks subscribed to the topic on their IOLoop.
+
+    @param directory The directory shared by the processes
+    @param io_loop The IOLoop to run the callbacks on
+    """
+    def __init__(self, directory, io_loop = None):
+        self.directory = directory
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.path = os.path.join(directory, "%d.sock" % os.getpid())
+        self._subscribers = {}
+        self._socket = None
+
+    def start(self):
+        """
+        Start listening for topics published by other processes
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        if os.path.exists(self.path):
+            os.remove(self.path) # Left behind by an earlier process with the same pid
+
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.setblocking(0)
+        self._socket.bind(self.path)
+        self.io_loop.add_handler(self._socket.fileno(), self._on_readable, tornado.ioloop.IOLoop.READ)
+
+    def stop(self):
+        """
+        Stop listening and remove this process' socket
+        """
+        if self._socket is None:
+            return
+        self.io_loop.remove_handler(self._socket.fileno())
+        self._socket.close()
+        self._socket = None
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def subscribe(self, topic, callback):
+        """
+        Run the callback when the topic is published by another process
+
+        @param topic The topic name
+        @param callback Called without arguments
+        """
+        self._subscribers.setdefault(topic, []).append(callback)
+
+    def publish(self, topic):
+        """
+        Send the topic to all other processes, may be called from any thread. Sockets of
+        processes that are no longer running are removed.
+
+        @param topic The topic name
+        """
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sender.setblocking(0)
+        try:
+            for name in names:
+                path = os.path.join(self.directory, name)
+                if not name.endswith(".sock") or path == self.path:
+                    continue
+                try:
+                    sender.sendto(topic, path)
+                except socket.error, e:
+                    if e.errno == errno.ECONNREFUSED:
+                        logging.info("Removing socket of stopped process: %s", path)
+                        try:
+                            os.remove(path)
+                        except OSError:
+                            pass
+                    elif e.errno != errno.ENOENT:
+                        logging.warning("Could not notify %s: %s", path, e)
+        finally:
+            sender.close()
+
+    def _on_readable(self, fd, events):
+        while True:
+            try:
+                topic = self._socket.recv(1024)
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            for callback in self._subscribers.get(topic, []):
+                try:
+                    callback()
+                except Exception:
+                    logging.exception("Notification callback for %s failed", topic)
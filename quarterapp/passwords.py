@@ -0,0 +1,157 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Password hashing.
+
+Passwords are hashed using PBKDF2-HMAC-SHA256 with a random salt per password and stored as
+
+    pbkdf2_sha256$<iterations>$<salt>$<hash>
+
+Hashes stored by earlier versions are a single round of SHA-512 over the password and the
+user's salt column. They are still accepted and replaced with a PBKDF2 hash at the next
+successful login, as are hashes using fewer iterations than currently configured.
+
+Hashing is deliberately slow, the PasswordHasher runs it on a pool of workers so the
+IOLoop can serve other requests meanwhile.
+"""
+
+import base64
+import hashlib
+import hmac
+import os
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from quarter_utils import hash_password as legacy_hash
+
+ALGORITHM = "pbkdf2_sha256"
+DEFAULT_ITERATIONS = 100000
+SALT_SIZE = 16
+
+def make_hash(password, iterations = DEFAULT_ITERATIONS, salt = None):
+    """
+    Hash a password
+
+    @param password The plain text password
+    @param iterations The number of PBKDF2 iterations
+    @param salt The salt to use, a new random salt if None
+    @return The encoded hash, including the algorithm, iterations and salt
+    """
+    if salt is None:
+        salt = base64.urlsafe_b64encode(os.urandom(SALT_SIZE)).rstrip("=")
+    digest = hashlib.pbkdf2_hmac("sha256", _utf8(password), str(salt), iterations)
+    return "%s$%d$%s$%s" % (ALGORITHM, iterations, salt, base64.urlsafe_b64encode(digest))
+
+def check(password, stored, legacy_salt = None):
+    """
+    Check a password against a stored hash
+
+    @param password The plain text password
+    @param stored The stored hash, either a PBKDF2 or a legacy hash
+    @param legacy_salt The user's salt column, only used for legacy hashes
+    @return True if the password matches, else False
+    """
+    if not stored:
+        return False
+    parts = _split(stored)
+    if parts:
+        iterations, salt = parts[1:3]
+        expected = make_hash(password, iterations, salt)
+    elif legacy_salt is not None:
+        expected = legacy_hash(_utf8(password), _utf8(legacy_salt))
+    else:
+        return False
+    return hmac.compare_digest(_utf8(expected), _utf8(stored))
+
+def needs_upgrade(stored, iterations = DEFAULT_ITERATIONS):
+    """
+    Check if a stored hash should be replaced with one using the current settings
+
+    @param stored The stored hash
+    @param iterations The currently configured number of iterations
+    @return True if the hash is a legacy hash or uses another number of iterations
+    """
+    parts = _split(stored)
+    return parts is None or parts[1] != iterations
+
+def _split(stored):
+    parts = str(stored).split("$")
+    if len(parts) != 4 or parts[0] != ALGORITHM or not parts[1].isdigit():
+        return None
+    parts[1] = int(parts[1])
+    return parts
+
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+class PasswordHasher(object):
+    """
+    Runs password hashing on a pool of worker threads or processes. The methods return
+    Futures that can be yielded from a Tornado coroutine:
+
+        matches = yield self.passwords.verify(password, stored, salt)
+
+    Threads are enough as hashlib releases the GIL while hashing, processes also keep the
+    time spent encoding and comparing off the application process.
+
+    @param max_workers The maximum number of passwords hashed at once
+    @param iterations The number of PBKDF2 iterations for new hashes
+    @param backend Either "thread" or "process"
+    """
+    def __init__(self, max_workers = 2, iterations = DEFAULT_ITERATIONS, backend = "thread"):
+        if backend == "process":
+            self.executor = ProcessPoolExecutor(max_workers)
+        elif backend == "thread":
+            self.executor = ThreadPoolExecutor(max_workers)
+        else:
+            raise ValueError("Unknown password hashing backend: %s" % backend)
+        self.iterations = iterations
+
+    def hash(self, password):
+        """
+        Hash a password using a new salt
+
+        @param password The plain text password
+        @return A Future resolving to the encoded hash
+        """
+        return self.executor.submit(make_hash, password, self.iterations)
+
+    def verify(self, password, stored, legacy_salt = None):
+        """
+        Check a password against a stored hash
+
+        @param password The plain text password
+        @param stored The stored hash
+        @param legacy_salt The user's salt column, only used for legacy hashes
+        @return A Future resolving to True if the password matches, else False
+        """
+        return self.executor.submit(check, password, stored, legacy_salt)
+
+    def needs_upgrade(self, stored):
+        """
+        Check if a stored hash should be replaced, see needs_upgrade
+        """
+        return needs_upgrade(stored, self.iterations)
+
+    def shutdown(self):
+        """
+        Stop accepting new passwords and wait for the ones being hashed
+        """
+        self.executor.shutdown(wait = True)
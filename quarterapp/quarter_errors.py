@@ -47,3 +47,14 @@ ERROR_DELETE_ACTIVITY       = ApiError(504, "Could not delete activity")
 ERROR_NO_QUARTERS           = ApiError(600, "No quarters given")
 ERROR_NOT_96_QUARTERS       = ApiError(601, "Expected 96 quarters")
 ERROR_INVALID_SHEET_DATE    = ApiError(602, "Expected date in YYYY-MM-DD format")
+ERROR_INVALID_QUARTERS      = ApiError(603, "Expected quarters to be activity ids")
+ERROR_NO_SHEETS             = ApiError(604, "Expected a map of dates to quarters")
+ERROR_TOO_MANY_SHEETS       = ApiError(605, "Too many sheets in one request")
+
+ERROR_INVALID_REPORT_DATE   = ApiError(700, "Expected start and end dates in YYYY-MM-DD format")
+ERROR_REPORT_DATE_ORDER     = ApiError(701, "Expected end date not to be before the start date")
+ERROR_INVALID_GRANULARITY   = ApiError(702, "Expected granularity to be day, week, month or year")
+ERROR_NO_REPORT_JOB         = ApiError(703, "No such report job")
+ERROR_TOO_MANY_REPORT_JOBS  = ApiError(704, "Too many reports running, wait for one to finish")
+ERROR_REPORT_TOO_LONG       = ApiError(705, "Report interval too long for the granularity")
+ERROR_REPORT_TOO_LATE       = ApiError(706, "Expected end date not to be after 9998-12-31")
@@ -25,6 +25,14 @@ import tornado.options
 from tornado.options import options, define
 
 from settings import QuarterSettings
+from async_storage import AsyncStorage
+from notify import Notifier
+from passwords import PasswordHasher
+from sessions import SessionStore
+from report_jobs import ReportJobs
+import migrations
+import query_stats
+import storage
 from account import *
 from admin import *
 from api import *
@@ -37,7 +45,8 @@ def read_configuration():
     """
     define("base_url", help="Application base URL (including port but not schema")
     define("port", type=int, help="Port to listen on")
-    define("app_config_age", type=int, help="Time in minutes between application config update")
+    define("app_config_age", type=int, help="Time in minutes between checks for changed application config")
+    define("notify_directory", help="Directory for the sockets used to notify other processes of changes")
     define("cookie_secret", help="Random long hexvalue to secure cookies")
     define("mysql_host", help="MySQL hostname")
     define("mysql_port", help="MySQL port", type=int)
@@ -46,6 +55,30 @@ def read_configuration():
     define("mysql_password", help="MySQL password")
     define("backend", help="Choice of backend, sqlite or mysql")
     define("sqlite_database", help="SQLite3 database file")
+    define("db_pool_min_size", type=int, default=2, help="Number of database connections kept open")
+    define("db_pool_max_size", type=int, default=10, help="Maximum number of open database connections")
+    define("db_pool_idle_timeout", type=int, default=300, help="Seconds before an idle database connection is closed")
+    define("db_pool_timeout", type=int, default=10, help="Seconds to wait for a free database connection")
+    define("storage_workers", type=int, default=6, help="Number of storage calls run at once, keep below db_pool_max_size")
+    define("auto_migrate", type=bool, default=False, help="Apply pending database migrations at startup")
+    define("activity_cache_size", type=int, default=1000, help="Number of users whose activities are cached")
+    define("activity_cache_ttl", type=int, default=300, help="Seconds a user's activities are cached")
+    define("report_cache_size", type=int, default=10000, help="Number of report weeks cached")
+    define("report_cache_ttl", type=int, default=3600, help="Seconds a report week is cached")
+    define("report_workers", type=int, default=2, help="Number of report job chunks summed up at once")
+    define("report_jobs_per_user", type=int, default=2, help="Number of report jobs a user may run at once")
+    define("report_job_results", type=int, default=1000, help="Number of finished report jobs kept")
+    define("report_job_minutes", type=int, default=10, help="Minutes a finished report job is kept")
+    define("report_job_database", help="SQLite database to share report jobs between processes in")
+    define("role_cache_ttl", type=int, default=30, help="Seconds a user's type and state are cached")
+    define("session_cache_size", type=int, default=10000, help="Number of login sessions kept in memory")
+    define("session_days", type=int, default=30, help="Days a login session is valid")
+    define("session_database", help="SQLite database to keep login sessions in across restarts")
+    define("session_cache_seconds", type=int, default=30, help="Seconds a session read from the session database is cached")
+    define("password_backend", default="thread", help="Where passwords are hashed, thread or process")
+    define("password_workers", type=int, default=2, help="Number of passwords hashed at once")
+    define("password_iterations", type=int, default=100000, help="PBKDF2 iterations for new password hashes")
+    define("slow_query_threshold", type=int, default=200, help="Log queries slower than this many milliseconds, 0 to disable")
     define("mail_host", help="SMTP host name")
     define("mail_port", type=int, help="SMTP port number")
     define("mail_user", help="SMTP Authentication username")
@@ -62,6 +95,23 @@ def read_configuration():
         logging.warning("Configuration file not found (quarterapp.conf)!")
         exit(1)
 
+def migrate_database(pool):
+    """
+    Bring the database schema up to date
+    """
+    with pool.connection() as db:
+        version = migrations.migrate(db)
+    logging.info("Database schema is at version %d", version)
+
+def check_database(pool):
+    """
+    Warn if there are migrations that have not been applied to the database
+    """
+    with pool.connection() as db:
+        pending = migrations.pending_migrations(db)
+    if pending:
+        logging.warning("Database schema is %d migration(s) behind, run 'quarterapp migrate'", len(pending))
+
 def quarterapp_main():
     application = tornado.web.Application(
         # Application routes
@@ -101,6 +151,10 @@ def quarterapp_main():
             (r"/api/activity", ActivityApiHandler),
             (r"/api/activity/([^\/]+)", ActivityApiHandler),
             (r"/api/sheet/([^\/]+)", SheetApiHandler),
+            (r"/api/sheets", SheetsApiHandler),
+            (r"/api/report", ReportApiHandler),
+            (r"/report/jobs", ReportJobsHandler),
+            (r"/report/jobs/([^\/]+)", ReportJobsHandler),
             (r"/", IndexHandler),
             
             (r".*", Http404Handler)
@@ -124,13 +178,90 @@ def quarterapp_main():
     logging.info("Starting application...")
     main_loop = tornado.ioloop.IOLoop.instance()
 
-    application.db = DbConnection()
+    activity_cache.max_size = options.activity_cache_size
+    activity_cache.ttl = options.activity_cache_ttl
+    role_cache.ttl = options.role_cache_ttl
+    week_cache.max_size = options.report_cache_size
+    week_cache.ttl = options.report_cache_ttl
+    # Other processes change the same users' data, cached data is checked against its version
+    storage.check_data_versions = bool(options.notify_directory)
+
+    if options.slow_query_threshold > 0:
+        query_stats.stats.slow_threshold = options.slow_query_threshold
+
+    application.db_pool = ConnectionPool(min_size = options.db_pool_min_size,
+        max_size = options.db_pool_max_size,
+        idle_timeout = options.db_pool_idle_timeout,
+        timeout = options.db_pool_timeout)
+    application.db_pool.warm_up()
+
+    if options.auto_migrate:
+        migrate_database(application.db_pool)
+    else:
+        check_database(application.db_pool)
+
+    # Storage calls made from coroutine handlers run on workers each holding a connection
+    # while running, as do report jobs. Leave connections for requests using one directly.
+    storage_workers = min(options.storage_workers, options.db_pool_max_size - options.report_workers - 1)
+    if storage_workers < options.storage_workers:
+        logging.warning("Using %d storage workers, storage_workers + report_workers must be below db_pool_max_size",
+            max(1, storage_workers))
+    application.async_db = AsyncStorage(application.db_pool, max(1, storage_workers))
+
+    # Logged in users are kept server side, the cookie only holds the session token
+    application.sessions = SessionStore(max_size = options.session_cache_size,
+        ttl = options.session_days * 24 * 3600,
+        database = options.session_database,
+        cache_ttl = options.session_cache_seconds)
+    if options.notify_directory and not options.session_database:
+        logging.warning("Login sessions are not shared with the other processes, set session_database")
+
+    session_loop = tornado.ioloop.PeriodicCallback(application.sessions.purge,
+        60 * 60 * 1000, io_loop = main_loop)
+
+    session_loop.start()
+
+    # Password hashing is slow by design, keep it off the IOLoop
+    application.passwords = PasswordHasher(max_workers = options.password_workers,
+        iterations = options.password_iterations,
+        backend = options.password_backend)
+
+    # Long reports are summed up in the background, on workers of their own
+    application.report_jobs = ReportJobs(application.db_pool,
+        max_workers = options.report_workers,
+        max_results = options.report_job_results,
+        ttl = options.report_job_minutes * 60,
+        max_user_jobs = options.report_jobs_per_user,
+        database = options.report_job_database)
+    if options.notify_directory and not options.report_job_database:
+        logging.warning("Report jobs are not shared with the other processes, set report_job_database")
+
+    report_jobs_loop = tornado.ioloop.PeriodicCallback(application.async_db.background(application.report_jobs.purge),
+        60 * 60 * 1000, io_loop = main_loop)
+
+    report_jobs_loop.start()
+
+    # Setup periodic callback to close idle and replace dead database connections, pinging
+    # connections blocks so it runs on the storage workers
+    pool_loop = tornado.ioloop.PeriodicCallback(application.async_db.background(application.db_pool.maintain),
+        60 * 1000, io_loop = main_loop)
+
+    pool_loop.start()
+
+    # Setup notifications between processes sharing the database on this host
+    notifier = None
+    if options.notify_directory:
+        notifier = Notifier(options.notify_directory, io_loop = main_loop)
+        notifier.start()
 
     # Setup application settings
-    application.quarter_settings = QuarterSettings(application.db)
+    application.quarter_settings = QuarterSettings(application.db_pool, notifier)
+    refresh_settings = application.async_db.background(application.quarter_settings.refresh)
+    if notifier:
+        notifier.subscribe("settings", refresh_settings)
 
-    # Setup periodic callback to update application settings
-    config_loop = tornado.ioloop.PeriodicCallback(application.quarter_settings.update,
+    # Setup periodic callback to update application settings if changed
+    config_loop = tornado.ioloop.PeriodicCallback(refresh_settings,
         options.app_config_age * 60 * 1000, io_loop = main_loop)
 
     config_loop.start()
@@ -144,6 +275,11 @@ def quarterapp_main():
         logging.error("Could not start application: %s", sys.exc_info()[0])
         print("Could not start application!")
         exit()
+    finally:
+        if notifier:
+            notifier.stop()
+        application.report_jobs.shutdown()
+        application.sessions.close()
 
 def main():
     """Entry point"""
@@ -153,6 +289,14 @@ def main():
         settings.create_default_config('.')
         return
     read_configuration()
+    if 'migrate' in sys.argv:
+        migrate_database(ConnectionPool(min_size = 0, max_size = 1))
+        return
+    if 'backfill' in sys.argv:
+        with ConnectionPool(min_size = 0, max_size = 1).connection() as db:
+            logging.info("Rebuilt the totals of %d sheets", backfill_sheet_totals(db))
+            rebuild_rollups(db)
+        return
     quarterapp_main()
 
 
@@ -0,0 +1,165 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Timing of the database queries.
+
+Every statement run through a DbConnection is timed and recorded in a latency histogram
+keyed on the function that issued it, normally a function in the storage module. Queries
+slower than the configured threshold are logged. Queries run on behalf of a request are
+also counted on the request's RequestQueries.
+"""
+
+import bisect
+import logging
+import sys
+import threading
+
+# Upper bounds, in milliseconds, of the histogram buckets. The last bucket is unbounded.
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+class Histogram(object):
+    """
+    Latency histogram of the queries issued by a single function
+    """
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+
+    def add(self, elapsed, rows):
+        """
+        Add a query to the histogram
+
+        @param elapsed The query time in milliseconds
+        @param rows The number of rows returned or affected
+        """
+        self.buckets[bisect.bisect_left(BUCKETS, elapsed)] += 1
+        self.count += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        if rows > 0:
+            self.rows += rows
+
+    def mean(self):
+        """
+        Get the mean query time in milliseconds
+        """
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, percent):
+        """
+        Get the upper bound of the bucket holding the given percentile
+
+        @param percent The percentile, 0 - 100
+        @return The time in milliseconds, the max time if in the unbounded bucket
+        """
+        threshold = self.count * percent / 100.0
+        seen = 0
+        for i, count in enumerate(self.buckets[:-1]):
+            seen += count
+            if seen >= threshold and seen > 0:
+                return min(BUCKETS[i], self.max)
+        return self.max
+
+class QueryStats(object):
+    """
+    Collects the query histograms of the whole process
+
+    @param slow_threshold Queries taking longer than this many milliseconds are logged,
+        None to not log any
+    """
+    def __init__(self, slow_threshold = None):
+        self.slow_threshold = slow_threshold
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def record(self, caller, sql, elapsed, rows, param_count):
+        """
+        Record a query
+
+        @param caller The name of the function issuing the query
+        @param sql The statement, with placeholders
+        @param elapsed The query time in milliseconds
+        @param rows The number of rows returned or affected
+        @param param_count The number of parameters given to the statement
+        """
+        with self._lock:
+            histogram = self._histograms.get(caller)
+            if histogram is None:
+                histogram = self._histograms[caller] = Histogram()
+            histogram.add(elapsed, rows)
+
+        if self.slow_threshold is not None and elapsed >= self.slow_threshold:
+            logging.warning("Slow query in %s took %.1f ms (%d rows, %d parameters): %s",
+                caller, elapsed, rows, param_count, " ".join(sql.split()))
+
+    def histograms(self):
+        """
+        Get the recorded histograms, slowest in total first
+
+        @return List of (caller, Histogram) tuples
+        """
+        with self._lock:
+            items = self._histograms.items()
+        return sorted(items, key = lambda item: item[1].total, reverse = True)
+
+    def reset(self):
+        """
+        Forget all recorded queries
+        """
+        with self._lock:
+            self._histograms = {}
+
+class RequestQueries(object):
+    """
+    The number of queries, their total time and rows run on behalf of a single request
+    """
+    __slots__ = ("count", "elapsed", "rows", "_lock")
+
+    def __init__(self):
+        self.count = 0
+        self.elapsed = 0.0
+        self.rows = 0
+        self._lock = threading.Lock()
+
+    def add(self, elapsed, rows):
+        with self._lock:
+            self.count += 1
+            self.elapsed += elapsed
+            if rows > 0:
+                self.rows += rows
+
+def calling_function(depth = 1):
+    """
+    Get the name of the closest module level function on the call stack, skipping methods
+    such as those of DbConnection and ConnectionPool.
+
+    @param depth The number of frames to skip, 1 skips the caller
+    @return The function name prefixed by its module, e.g. storage.get_sheet
+    """
+    frame = sys._getframe(depth + 1)
+    while frame is not None:
+        code = frame.f_code
+        function = frame.f_globals.get(code.co_name)
+        if getattr(function, "func_code", None) is code:
+            return "%s.%s" % (frame.f_globals.get("__name__", "").rsplit(".", 1)[-1], code.co_name)
+        frame = frame.f_back
+    return "unknown"
+
+stats = QueryStats()
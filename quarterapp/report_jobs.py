@@ -0,0 +1,252 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import binascii
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from cache import LRUCache
+from reports import period_chunks, period_totals
+
+# The longest interval, in days, of a report job per granularity, None for no limit
+MAX_JOB_DAYS = { "day" : 10 * 366, "week" : 100 * 366, "month" : 1000 * 366, "year" : None }
+
+class ReportJob(object):
+    """
+    A report being summed up in the background, see ReportJobs
+
+    The periods are only complete once the state is Done. The future resolves to the job
+    when it is done, or fails with the error that stopped it. Jobs read from the job
+    database, run by another process, have no future.
+    """
+    Pending = "pending"
+    Running = "running"
+    Done = "done"
+    Failed = "failed"
+
+    def __init__(self, job_id, user_id, start_date, end_date, granularity, chunks):
+        self.id = job_id
+        self.user_id = user_id
+        self.start_date = start_date
+        self.end_date = end_date
+        self.granularity = granularity
+        self.chunks = chunks
+        self.done = 0
+        self.periods = []
+        self.state = ReportJob.Pending
+        self.future = Future()
+        self._total = len(chunks)
+
+    @classmethod
+    def _from_row(cls, row):
+        job_id, user_id, state, done, total, periods = row
+        job = cls.__new__(cls)
+        job.id = job_id
+        job.user_id = user_id
+        job.start_date = job.end_date = job.granularity = job.chunks = job.future = None
+        job.state = state
+        job.done = done
+        job.periods = [(period, [tuple(count) for count in counts]) for period, counts in json.loads(periods or "[]")]
+        job._total = total
+        return job
+
+    def total(self):
+        """
+        Get the number of chunks the report is summed up in
+        """
+        return self._total
+
+    def progress(self):
+        """
+        Get the share of the report summed up so far
+
+        @return A number between 0 and 1
+        """
+        if not self._total:
+            return 1.0
+        return float(self.done) / self._total
+
+class ReportJobs(object):
+    """
+    Sums up reports on a pool of worker threads of their own, so reports over long
+    intervals neither block the request nor take the workers serving other requests.
+
+    A job is split into chunks (see reports.period_chunks). Each chunk is queued on its
+    own once the previous is done, so the jobs in flight take turns on the workers and a
+    large report does not hold back smaller ones submitted after it.
+
+    Submitting a report identical to one still running or recently finished, for the same
+    version of the user's data, returns the existing job. Finished jobs are kept for
+    polling until evicted or expired.
+
+    Jobs are only known to the process running them, unless a SQLite database is given.
+    The state, progress and result of each job is then also written to the database, so
+    the processes on a host can answer polls for and share each other's jobs. A job not
+    updated for ttl seconds is taken to be lost along with the process running it.
+
+    @param pool The ConnectionPool to check out connections from
+    @param max_workers The number of chunks summed up at once
+    @param max_results The maximum number of finished jobs kept in memory
+    @param ttl Seconds a finished job is kept
+    @param max_user_jobs The maximum number of jobs running at once for each user
+    @param database Path to the SQLite database to share jobs in, or None
+    """
+    def __init__(self, pool, max_workers = 2, max_results = 1000, ttl = 600, max_user_jobs = 2,
+            database = None):
+        self.pool = pool
+        self.ttl = ttl
+        self.max_user_jobs = max_user_jobs
+        self.executor = ThreadPoolExecutor(max_workers)
+        self._finished = LRUCache(max_size = max_results, ttl = ttl)
+        self._keys = LRUCache(max_size = max_results, ttl = ttl)
+        self._running = {}
+        self._lock = threading.Lock()
+        self._db = None
+        if database:
+            self._db = sqlite3.connect(database, check_same_thread = False, isolation_level = None)
+            self._db.execute("CREATE TABLE IF NOT EXISTS report_jobs ("
+                "id VARCHAR(32) PRIMARY KEY, key TEXT NOT NULL, user INTEGER NOT NULL, state TEXT NOT NULL, "
+                "done INTEGER NOT NULL, total INTEGER NOT NULL, periods TEXT, updated INTEGER NOT NULL);")
+            self._db.execute("CREATE INDEX IF NOT EXISTS report_jobs_key ON report_jobs (key);")
+
+    def submit(self, user_id, start_date, end_date, granularity, data_version):
+        """
+        Start summing up a report, or get the identical job already submitted
+
+        @param user_id The id of the user to create the report for
+        @param start_date The first date of the report
+        @param end_date The last date of the report
+        @param granularity One of reports.GRANULARITIES
+        @param data_version The user's data version, see storage.get_data_version
+        @return The ReportJob, or None if the user already has max_user_jobs jobs running
+        """
+        key = json.dumps([user_id, start_date.isoformat(), end_date.isoformat(), granularity, data_version])
+        with self._lock:
+            job = self._get(self._keys.get(key)) or self._stored_job(key)
+            if job is not None and job.state != ReportJob.Failed:
+                return job
+            if sum(1 for job in self._running.itervalues() if job.user_id == user_id) >= self.max_user_jobs:
+                return None
+
+            job = ReportJob(binascii.hexlify(os.urandom(16)), user_id, start_date, end_date,
+                granularity, period_chunks(start_date, end_date, granularity))
+            self._running[job.id] = job
+            self._keys.put(key, job.id)
+            if self._db:
+                self._db.execute("INSERT INTO report_jobs (id, key, user, state, done, total, updated) "
+                    "VALUES(?, ?, ?, ?, 0, ?, ?);", (job.id, key, user_id, job.state, job.total(), int(time.time())))
+
+        self._queue(job)
+        return job
+
+    def get(self, job_id):
+        """
+        Get a running or finished job
+
+        @param job_id The id of the job
+        @return The ReportJob or None if there is no such job or it has expired
+        """
+        with self._lock:
+            return self._get(job_id) or self._stored_job(job_id = job_id)
+
+    def purge(self):
+        """
+        Remove expired jobs from the database
+        """
+        if self._db:
+            with self._lock:
+                self._db.execute("DELETE FROM report_jobs WHERE updated < ?;", (int(time.time()) - self.ttl,))
+
+    def shutdown(self):
+        """
+        Stop summing up reports, jobs in flight are left unfinished
+        """
+        self.executor.shutdown(wait = False)
+        if self._db:
+            with self._lock:
+                self._db.close()
+                self._db = None
+
+    def _get(self, job_id):
+        if job_id is None:
+            return None
+        return self._running.get(job_id) or self._finished.get(job_id)
+
+    def _stored_job(self, key = None, job_id = None):
+        """
+        Get the most recent job with the given key or id from the database, call holding
+        the lock
+        """
+        if not self._db or (key is None and job_id is None):
+            return None
+        column, value = ("key", key) if key is not None else ("id", job_id)
+        row = self._db.execute("SELECT id, user, state, done, total, periods, updated FROM report_jobs "
+            "WHERE %s=? ORDER BY updated DESC LIMIT 1;" % column, (value,)).fetchone()
+        if not row or row[-1] < time.time() - self.ttl:
+            return None
+        return ReportJob._from_row(row[:-1])
+
+    def _store(self, job, periods = None):
+        try:
+            with self._lock:
+                if self._db:
+                    self._db.execute("UPDATE report_jobs SET state=?, done=?, periods=?, updated=? WHERE id=?;",
+                        (job.state, job.done, periods, int(time.time()), job.id))
+        except sqlite3.Error:
+            logging.exception("Could not store report %s", job.id)
+
+    def _queue(self, job):
+        try:
+            self.executor.submit(self._run_chunk, job)
+        except RuntimeError as e: # Shut down
+            self._finish(job, ReportJob.Failed, e)
+
+    def _run_chunk(self, job):
+        job.state = ReportJob.Running
+        start_date, end_date = job.chunks[job.done]
+        try:
+            with self.pool.connection() as db:
+                periods = period_totals(db, job.user_id, start_date, end_date, job.granularity)
+        except Exception as e:
+            logging.exception("Could not sum up report %s", job.id)
+            self._finish(job, ReportJob.Failed, e)
+            return
+
+        job.periods.extend(periods)
+        job.done += 1
+        if job.done < len(job.chunks):
+            self._store(job)
+            self._queue(job)
+        else:
+            self._finish(job, ReportJob.Done)
+
+    def _finish(self, job, state, error = None):
+        with self._lock:
+            job.state = state
+            self._running.pop(job.id, None)
+            self._finished.put(job.id, job)
+        self._store(job, json.dumps(job.periods) if state == ReportJob.Done else None)
+        if error is None:
+            job.future.set_result(job)
+        else:
+            job.future.set_exception(error)
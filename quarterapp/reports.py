@@ -0,0 +1,207 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import date, timedelta
+
+import storage
+from domain import Timesheet, Week
+from quarter_utils import extract_date
+
+# Number of weeks fetched at once when a report is streamed
+CHUNK_WEEKS = 8
+
+# The last date a report may include, the ISO week of any later date ends after date.max
+LAST_REPORT_DATE = date(9998, 12, 31)
+
+# The periods a report can be summed up per, from the finest to the coarsest
+GRANULARITIES = ("day", "week", "month", "year")
+
+# The longest interval, in days, summed up at once per granularity, None for no limit
+MAX_REPORT_DAYS = { "day" : 366, "week" : 10 * 366, "month" : 100 * 366, "year" : None }
+
+def iso_weeks(start_date, end_date):
+    """
+    Iterate the ISO weeks covering the given interval, across year boundaries
+
+    @param start_date The first date of the interval
+    @param end_date The last date of the interval
+    @return A generator of (ISO year, ISO week) tuples
+    """
+    monday = start_date - timedelta(days = start_date.weekday())
+    while True:
+        yield monday.isocalendar()[:2]
+        if (end_date - monday).days < 7:
+            break # Stepping on could pass date.max
+        monday += timedelta(weeks = 1)
+
+def report_weeks(start_date, end_date):
+    """
+    Create the empty weeks covering the given report interval
+
+    @param start_date The first date of the report
+    @param end_date The last date of the report
+    @return A list of Week objects without any sheets reported
+    """
+    return [Week(year, week) for year, week in iso_weeks(start_date, end_date)]
+
+def report_chunks(start_date, end_date, weeks = CHUNK_WEEKS):
+    """
+    Split a report interval into intervals of whole weeks, to be built one at a time
+
+    @param start_date The first date of the report
+    @param end_date The last date of the report
+    @param weeks The maximum number of weeks in each interval
+    @return A generator of (first date, last date) tuples
+    """
+    monday = start_date - timedelta(days = start_date.weekday())
+    days = weeks * 7
+    while True:
+        remaining = (end_date - monday).days
+        yield monday, monday + timedelta(days = min(days - 1, remaining))
+        if remaining < days:
+            break # Stepping on could pass date.max
+        monday += timedelta(days = days)
+
+def period_chunks(start_date, end_date, granularity, weeks = CHUNK_WEEKS):
+    """
+    Split a report interval into intervals that can be summed up one at a time, without
+    any period spanning two intervals. Days and weeks are split into whole weeks, months
+    and years into years.
+
+    @param start_date The first date of the report
+    @param end_date The last date of the report
+    @param granularity One of GRANULARITIES
+    @param weeks The maximum number of weeks in each interval of days or weeks
+    @return A list of (first date, last date) tuples
+    """
+    if granularity in ("month", "year"):
+        return [(max(date(year, 1, 1), start_date), min(date(year, 12, 31), end_date))
+            for year in range(start_date.year, end_date.year + 1)]
+    return [(max(first, start_date), last) for first, last in report_chunks(start_date, end_date, weeks)]
+
+def build_weeks(db, user_id, start_date, end_date):
+    """
+    Create the weeks covering the given report interval filled with the user's time sheets.
+
+    Weeks are cached, keyed on the user and ISO week, until a sheet within the week is
+    changed, or any of the user's data by another process. The time per activity and day
+    of the weeks not cached is fetched from the pre-aggregated sheet totals using a single
+    range query, no sheet is decoded.
+
+    @param db The database connection to use
+    @param user_id The id of the authenticated user to create the report for
+    @param start_date The first date of the report
+    @param end_date The last date of the report
+    @return A list of Week objects, must not be modified as they are shared
+    """
+    weeks = report_weeks(start_date, end_date)
+    storage.check_cached_data(db, user_id)
+    missing = []
+    for i, week in enumerate(weeks):
+        cached = storage.week_cache.get(_week_key(user_id, week))
+        if cached is None:
+            missing.append(i)
+        else:
+            weeks[i] = cached
+    if not missing:
+        return weeks
+
+    first_day = weeks[missing[0]].first_date
+    last_day = weeks[missing[-1]].last_date()
+    invalidations = storage.week_cache.generation()
+    totals = storage.get_sheet_totals(db, user_id, first_day, last_day)
+
+    # Only the days with any activity are filled in, the other days are left empty
+    rebuilt = set(missing)
+    for date_string, day_totals in totals.iteritems():
+        day = extract_date(date_string)
+        i = missing[0] + (day - first_day).days // 7
+        if i in rebuilt:
+            weeks[i].update_sheet(Timesheet.from_totals(day, day_totals))
+
+    for i in missing:
+        storage.week_cache.put(_week_key(user_id, weeks[i]), weeks[i], invalidations)
+    return weeks
+
+def _week_key(user_id, week):
+    return (user_id,) + week.first_date.isocalendar()[:2]
+
+def within_limit(start_date, end_date, granularity, limits = MAX_REPORT_DAYS):
+    """
+    Check that a report interval is not longer than allowed for the granularity
+
+    @param start_date The first date of the report
+    @param end_date The last date of the report
+    @param granularity One of GRANULARITIES
+    @param limits The longest interval in days per granularity
+    @return True if the interval may be summed up, else False
+    """
+    limit = limits.get(granularity)
+    return limit is None or (end_date - start_date).days < limit
+
+def period_totals(db, user_id, start_date, end_date, granularity):
+    """
+    Sum up the time spent on each activity per day, week, month or year. The interval is
+    widened to whole periods. Days and weeks are summed from the per day totals, months
+    and years are read from the rollups maintained as sheets are saved. Callers check the
+    interval using within_limit first, as every period of it is built at once.
+
+    @param db The database connection to use
+    @param user_id The id of the authenticated user to create the report for
+    @param start_date The first date of the report
+    @param end_date The last date of the report
+    @param granularity One of GRANULARITIES
+    @return A list of (period, [(activity id, number of quarters)]) tuples, one for each
+        period in order. Periods are labeled YYYY-MM-DD, YYYY-Www, YYYY-MM or YYYY.
+    """
+    if granularity == "year":
+        periods = ["%d" % year for year in range(start_date.year, end_date.year + 1)]
+        rows = [("%d" % year, activity_id, count) for year, activity_id, count in
+            storage.get_yearly_totals(db, user_id, start_date.year, end_date.year)]
+    elif granularity == "month":
+        periods = ["%d-%02d" % (year, month) for year in range(start_date.year, end_date.year + 1)
+            for month in range(1, 13)
+            if (start_date.year, start_date.month) <= (year, month) <= (end_date.year, end_date.month)]
+        rows = [("%d-%02d" % (year, month), activity_id, count) for year, month, activity_id, count in
+            storage.get_monthly_totals(db, user_id, start_date.year, end_date.year)]
+    elif granularity in ("day", "week"):
+        if granularity == "week":
+            start_date -= timedelta(days = start_date.weekday())
+            end_date += timedelta(days = min(6 - end_date.weekday(), (date.max - end_date).days))
+        days = [start_date + timedelta(days = i) for i in range((end_date - start_date).days + 1)]
+        label = _day_label if granularity == "day" else _week_label
+        periods = []
+        for day in days:
+            if not periods or periods[-1] != label(day):
+                periods.append(label(day))
+        rows = [(label(extract_date(date_string)), activity_id, count) for date_string, day_totals in
+            storage.get_sheet_totals(db, user_id, start_date, end_date).iteritems()
+            for activity_id, count in day_totals]
+    else:
+        raise ValueError("Unknown granularity %r" % granularity)
+
+    totals = dict((period, {}) for period in periods)
+    for period, activity_id, count in rows:
+        if period in totals:
+            counts = totals[period]
+            counts[activity_id] = counts.get(activity_id, 0) + count
+    return [(period, sorted(totals[period].iteritems())) for period in periods]
+
+def _day_label(day):
+    return day.isoformat()
+
+def _week_label(day):
+    return "%d-W%02d" % day.isocalendar()[:2]
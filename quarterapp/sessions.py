@@ -0,0 +1,152 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import binascii
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from cache import LRUCache
+
+class SessionStore(object):
+    """
+    Server side sessions. The session cookie only holds a random token, the logged in
+    user is kept in an in-process cache keyed on the token.
+
+    Sessions are lost when the process is restarted or the session is evicted from the
+    cache, unless a SQLite database is given, and are then not shared between processes.
+    With a database sessions are also written to it and looked up there when not cached,
+    so they are shared by the processes on a host. Sessions are then only cached for
+    cache_ttl seconds, so a session ended by another process is not used for longer.
+    Reading the database blocks, the web handlers check cached and otherwise call get
+    on the storage workers.
+
+    @param max_size The maximum number of sessions cached
+    @param ttl Seconds a session is valid after login
+    @param database Path to the SQLite database to persist sessions in, or None
+    @param cache_ttl Seconds a session read from the database is cached
+    """
+    def __init__(self, max_size = 10000, ttl = 30 * 24 * 3600, database = None, cache_ttl = 30):
+        self.ttl = ttl
+        self.cache = LRUCache(max_size = max_size, ttl = cache_ttl if database else None)
+        self._db = None
+        self._lock = threading.Lock()
+        if database:
+            self._db = sqlite3.connect(database, check_same_thread = False, isolation_level = None)
+            self._db.execute("CREATE TABLE IF NOT EXISTS sessions ("
+                "token VARCHAR(32) PRIMARY KEY, user TEXT NOT NULL, username TEXT, expires INTEGER NOT NULL);")
+            self._add_username_column()
+            self._db.execute("CREATE INDEX IF NOT EXISTS sessions_username ON sessions (username);")
+
+    def _add_username_column(self):
+        """
+        Add the username column to sessions stored before sessions could be revoked
+        """
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(sessions);")]
+        if "username" in columns:
+            return
+        self._db.execute("ALTER TABLE sessions ADD COLUMN username TEXT;")
+        for token, user in self._db.execute("SELECT token, user FROM sessions;").fetchall():
+            self._db.execute("UPDATE sessions SET username=? WHERE token=?;",
+                (json.loads(user).get("username"), token))
+
+    def create(self, user):
+        """
+        Start a new session
+
+        @param user The user object to keep in the session
+        @return The session token
+        """
+        token = binascii.hexlify(os.urandom(16))
+        expires = int(time.time()) + self.ttl
+        self.cache.put(token, (user, expires))
+        if self._db:
+            with self._lock:
+                self._db.execute("INSERT INTO sessions (token, user, username, expires) VALUES(?, ?, ?, ?);",
+                    (token, json.dumps(user), user.get("username"), expires))
+        return token
+
+    def cached(self, token):
+        """
+        Check if get can return at once, without reading the database
+
+        @param token The session token
+        @return True if the session is cached or there is no database, else False
+        """
+        return not self._db or not token or self.cache.get(token) is not None
+
+    def get(self, token):
+        """
+        Get the user of a session
+
+        @param token The session token
+        @return The user object or None if there is no such session or it has expired
+        """
+        if not token:
+            return None
+        entry = self.cache.get(token)
+        if entry is None and self._db:
+            generation = self.cache.generation()
+            with self._lock:
+                row = self._db.execute("SELECT user, expires FROM sessions WHERE token=?;", (token,)).fetchone()
+            if row:
+                entry = (json.loads(row[0]), row[1])
+                self.cache.put(token, entry, generation)
+        if entry is None or entry[1] < time.time():
+            return None
+        return entry[0]
+
+    def delete(self, token):
+        """
+        End a session
+
+        @param token The session token
+        """
+        if not token:
+            return
+        self.cache.invalidate(token)
+        if self._db:
+            with self._lock:
+                self._db.execute("DELETE FROM sessions WHERE token=?;", (token,))
+
+    def revoke(self, username):
+        """
+        End all sessions of a user, e.g. when the password is changed or the user is
+        disabled. Other processes sharing the database stop using the sessions once no
+        longer cached.
+
+        @param username The username of the user
+        """
+        self.cache.evict_values(lambda entry: entry[0].get("username") == username)
+        if self._db:
+            with self._lock:
+                self._db.execute("DELETE FROM sessions WHERE username=?;", (username,))
+
+    def purge(self):
+        """
+        Remove expired sessions from the database
+        """
+        if self._db:
+            with self._lock:
+                self._db.execute("DELETE FROM sessions WHERE expires < ?;", (int(time.time()),))
+
+    def close(self):
+        if self._db:
+            self._db.close()
+            self._db = None
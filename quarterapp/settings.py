@@ -16,7 +16,6 @@
 
 import logging
 import storage
-import tornado.database
 
 class QuarterSettings(object):
     """
@@ -24,18 +23,23 @@ class QuarterSettings(object):
     not the running server. I.e. port numbers and such should not be kept here
     but in the application configuration file (quarterapp.conf).
 
-    These settings might be updated at runtime
+    These settings might be updated at runtime. Each change increases the settings
+    version in the database, so refresh only reloads the settings when changed, and
+    other processes are notified to reload if a Notifier is given.
     """
 
-    def __init__(self, db):
+    def __init__(self, db, notifier = None):
         """
         Constructs the application settings and try to update the settings
         from database
 
-        @param db The Tornado database object used to access the database
+        @param db The database connection (or pool) used to access the database
+        @param notifier Optional Notifier used to tell other processes about changes
         """
         self.db = db
+        self.notifier = notifier
         self.settings = {}
+        self.version = None
         self.update()
 
     def update(self):
@@ -44,13 +48,30 @@ class QuarterSettings(object):
         old settings remain active
         """
         logging.info("Updating settings")
+        # Read the version first, a change made meanwhile is then picked up by next refresh
+        version = storage.get_settings_version(self.db)
         settings = storage.get_settings(self.db)
         if settings:
+            # Replaced as a whole, requests on the IOLoop never see a partial update
+            updated = dict(self.settings)
             for row in settings:
-                self.settings[row.name] = row.value
+                updated[row.name] = row.value
+            self.settings = updated
+            self.version = version
         else:
             logging.warn("Could not find any settings in database - everything setup ok?")
 
+    def refresh(self):
+        """
+        Update the settings from the database if changed since the last update. Blocks on
+        the database, run it off the IOLoop (see AsyncStorage.background).
+        """
+        try:
+            if storage.get_settings_version(self.db) != self.version:
+                self.update()
+        except Exception:
+            logging.exception("Could not refresh settings")
+
     def get_value(self, key):
         """
         Get the setting value for the given key, if no setting exist for this key
@@ -72,7 +93,12 @@ class QuarterSettings(object):
         """
         if self.settings.has_key(key):
             storage.put_setting(self.db, key, value)
-            self.settings[key] = value
+            # Swapped like in update, the admin handlers may call this from a storage worker
+            updated = dict(self.settings)
+            updated[key] = value
+            self.settings = updated
+            if self.notifier:
+                self.notifier.publish("settings")
         else:
             logging.warning("Trying to update a settings key that does not exists! (%s)", key)
             raise Exception("Trying to update a settings key that does not exists!")
@@ -15,87 +15,557 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import sqlite3
+import sys
 import re
+import time
+import logging
+import threading
 import MySQLdb
 
-from functools import wraps
+from collections import deque
+from contextlib import contextmanager
 from tornado.options import options
-from domain import User, Color, Activity
+from domain import User, Color, Activity, ActivityDict, summarize
+from cache import LRUCache
+from quarter_utils import extract_date
+import codec
+import query_stats
 
 _SQLITE_RE = re.compile(r'%\((\w+)\)s')
 
-def hack_sql(fn):
-    """Hack MySQL driver SQL into SQLite3 driver SQL. 
-    WISHLIST: Should have zero impact when using MySQL."""
-    @wraps(fn)
-    def hack_sql(db, sql, *args, **kwargs): 
-        if isinstance(db, sqlite3.Connection):
-            sql = _SQLITE_RE.sub(r':\1', sql.replace('%s', '?'))
-        return fn(db, sql, *args, **kwargs)
-    return hack_sql
-
-class Data(dict):
+# Number of compiled statements SQLite keeps per connection
+_SQLITE_STATEMENT_CACHE = 256
+
+# Statements translated from the MySQL driver syntax, per dialect
+_statements = { "sqlite" : {} }
+
+# Each user's activities, keyed on user id, see _cached_activities
+activity_cache = LRUCache(max_size = 1000, ttl = 300)
+
+# Each user's type and state keyed on user id and user ids keyed on username, see get_user_role
+role_cache = LRUCache(max_size = 1000, ttl = 30)
+user_id_cache = LRUCache(max_size = 1000, ttl = 300)
+
+# Report weeks keyed on (user id, ISO year, ISO week), see reports.build_weeks
+week_cache = LRUCache(max_size = 10000, ttl = 3600)
+
+# Set when other processes change the same users' data, the data version each user's
+# cached activities and weeks are current at is then kept, see check_cached_data
+check_data_versions = False
+data_versions = LRUCache(max_size = 10000)
+
+def translate_sql(sql, dialect):
+    """
+    Translate MySQL driver SQL (%s and %(name)s placeholders) into the given dialect.
+    Each statement is only translated once, the result is cached for following calls.
+    MySQL statements are returned as is.
+
+    @param sql The statement using MySQL driver placeholders
+    @param dialect The target dialect, "mysql" or "sqlite"
+    @return The statement for the given dialect
+    """
+    if dialect == "mysql":
+        return sql
+    statements = _statements[dialect]
+    try:
+        return statements[sql]
+    except KeyError:
+        return statements.setdefault(sql, _SQLITE_RE.sub(r':\1', sql.replace('%s', '?')))
+
+_upserts = {}
+
+def upsert_sql(table, keys, columns, dialect, increment = False):
+    """
+    Build a statement inserting a row, or updating the given columns of the row if one
+    with the same keys already exists. The keys must be covered by a unique index.
+    Statements are built once and cached.
+
+    @param table The table to insert into
+    @param keys Tuple of the unique key columns
+    @param columns Tuple of the columns to update when the row exists
+    @param dialect The target dialect, "mysql" or "sqlite"
+    @param increment True to add the values to the existing row's columns instead of
+        replacing them
+    @return The statement, using MySQL driver placeholders named after the columns
+    """
+    cache_key = (table, keys, columns, dialect, increment)
+    try:
+        return _upserts[cache_key]
+    except KeyError:
+        pass
+
+    names = keys + columns
+    sql = "INSERT INTO %s (%s) VALUES(%s)" % (table, ", ".join(names),
+        ", ".join("%%(%s)s" % name for name in names))
+    update = "%s=%s+%s" if increment else "%s=%.0s%s"
+    if dialect == "mysql":
+        sql += " ON DUPLICATE KEY UPDATE %s;" % ", ".join(update % (c, c, "VALUES(%s)" % c) for c in columns)
+    else:
+        sql += " ON CONFLICT (%s) DO UPDATE SET %s;" % (", ".join(keys),
+            ", ".join(update % (c, c, "excluded.%s" % c) for c in columns))
+    return _upserts.setdefault(cache_key, sql)
+
+class Row(tuple):
+    """
+    A row returned by DbConnection.query. Rows are plain tuples, the columns can also be
+    accessed by name either as attributes (row.id) or as items (row["id"]).
+
+    A Row subclass is created once for each distinct set of columns, holding the mapping
+    from column name to index, so the rows themselves carry nothing but their values.
+    """
+    __slots__ = ()
+    _fields = ()
+    _index = {}
+
     def __getattr__(self, name):
         try:
-            return self[name]
+            return tuple.__getitem__(self, self._index[name])
         except KeyError:
             raise AttributeError(name)
 
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            return tuple.__getitem__(self, self._index[key])
+        return tuple.__getitem__(self, key)
+
+    def _asdict(self):
+        """
+        Get the row as a dict keyed on column name
+        """
+        return dict(zip(self._fields, self))
+
+_row_classes = {}
+
+def row_class(columns):
+    """
+    Get the Row class for the given columns, created on first use
+
+    @param columns Tuple of column names
+    @return A Row subclass
+    """
+    try:
+        return _row_classes[columns]
+    except KeyError:
+        cls = type("Row", (Row,), {
+            "__slots__" : (),
+            "_fields" : columns,
+            "_index" : dict((name, i) for i, name in enumerate(columns)) })
+        return _row_classes.setdefault(columns, cls)
+
+class PoolTimeoutError(Exception):
+    """
+    Raised when no database connection could be checked out from the pool in time
+    """
+    pass
+
 class DbConnection(object):
-    def _init__(self):
-        self.db = None
-        self.connect()
+    """
+    A single database connection, wrapping either a MySQLdb or a SQLite3 connection.
+
+    Statements are always written using the MySQL driver syntax, on SQLite they are
+    translated once and then reused, letting SQLite's statement cache skip re-compiling
+    them as well.
+
+    @param connection An already opened driver connection to wrap, if None a new connection
+        is opened using the application options
+    """
+    def __init__(self, connection = None):
+        self.last_used = time.time()
+        self.request_queries = None # RequestQueries of the request using the connection
+        if connection:
+            self._use(connection)
+        else:
+            self.connect()
 
     def connect(self):
         if options.backend == 'sqlite':
-            import sqlite3
-            application.db = sqlite3.connect(options.sqlite_database)
+            # Connections are handed between threads by the pool, but never used concurrently
+            connection = sqlite3.connect(options.sqlite_database, check_same_thread = False,
+                cached_statements = _SQLITE_STATEMENT_CACHE)
             logging.info("Using SQLite3 as database")
         else:
-            self.db  = MySQLdb.connect(host=options.mysql_host,
+            connection = MySQLdb.connect(host=options.mysql_host,
                 port=options.mysql_port,
                 db=options.mysql_database,
                 user=options.mysql_user,
                 passwd=options.mysql_password, 
                 charset="utf8")
-            self.db.autocommit(True)
+            connection.autocommit(True)
+        self._use(connection)
+
+    def _use(self, connection):
+        self.db = connection
+        self._in_transaction = False
+        if isinstance(connection, sqlite3.Connection):
+            connection.isolation_level = None # Autocommit same as for MySQL, see transaction()
+            self.dialect = "sqlite"
+            self._statements = _statements["sqlite"]
+        else:
+            self.dialect = "mysql"
+            self._statements = None
 
-    @hack_sql
-    def query(self, sql, *params):
+    def ping(self):
+        """
+        Check that the connection is still usable
+
+        @return True if the connection is alive, else False
+        """
         try:
-            cursor = self.db.cursor()
-            cursor.execute(sql, *params)
-        except (AttributeError, MySQLdb.OperationalError):
-            self.connect()
-            cursor = self.db.cursor()
-            cursor.execute(sql, *params)
+            if self.dialect == "sqlite":
+                self.db.execute("SELECT 1;")
+            else:
+                self.db.ping()
+            return True
+        except Exception:
+            return False
 
-        cols = [c[0] for c in cursor.description]
-        return [Data(zip(cols, row)) for row in cursor.fetchall()]
+    def close(self):
+        """
+        Close the underlying driver connection, errors are ignored
+        """
+        try:
+            if self.db:
+                self.db.close()
+        except Exception:
+            pass
+        self.db = None
+
+    def binary(self, value):
+        """
+        Wrap a byte string so the driver stores it as binary data
+
+        @param value The byte string
+        @return The value wrapped in the driver's Binary type
+        """
+        if self.dialect == "sqlite":
+            return sqlite3.Binary(value)
+        return MySQLdb.Binary(value)
+
+    def query(self, sql, *params):
+        cursor, rows = self._execute(sql, params, fetch = True)
+        cls = row_class(tuple(c[0] for c in cursor.description))
+        return map(cls, rows)
+
+    def query_tuples(self, sql, *params):
+        """
+        Like query but return the rows as the driver's plain tuples, for callers that
+        unpack the columns by position
+        """
+        return self._execute(sql, params, fetch = True)[1]
 
-    @hack_sql
     def query_rowcount(self, sql, params):
+        return self._execute(sql, (params,))[0].rowcount
+
+    def execute(self, sql, *params):
+        return self._execute(sql, params)[0].lastrowid
+
+    def executemany(self, sql, params_list):
+        """
+        Execute the statement once for each set of parameters in a single driver call,
+        MySQLdb sends an INSERT as one multi-row statement.
+
+        @param sql The statement to execute
+        @param params_list List of parameters, one for each execution
+        @return The total number of affected rows
+        """
+        return self._execute(sql, (params_list,), "executemany")[0].rowcount
+
+    def upsert(self, table, keys, columns, params, increment = False):
+        """
+        Insert a row or update the existing row with the same keys, as one atomic statement
+
+        @param table The table to insert into
+        @param keys Tuple of the unique key columns
+        @param columns Tuple of the columns to update when the row exists
+        @param params Dict of values for both the keys and the columns
+        @param increment True to add the values to an existing row's columns
+        """
+        self._execute(upsert_sql(table, keys, columns, self.dialect, increment), (params,))
+
+    def upsert_many(self, table, keys, columns, params_list, increment = False):
+        """
+        Like upsert but for many rows in a single driver call
+        """
+        self._execute(upsert_sql(table, keys, columns, self.dialect, increment), (params_list,), "executemany")
+
+    @contextmanager
+    def transaction(self):
+        """
+        Context manager running the enclosed statements in a single transaction, committed
+        when the block exits and rolled back if it raises. Within another transaction the
+        statements become part of the enclosing transaction.
+        """
+        if self._in_transaction:
+            yield self
+            return
+        self._execute("BEGIN;", ())
+        self._in_transaction = True
+        try:
+            yield self
+        except:
+            self._in_transaction = False
+            exc_info = sys.exc_info()
+            try:
+                self.db.cursor().execute("ROLLBACK;")
+            except Exception:
+                logging.warning("Could not roll back transaction: %s", sys.exc_info()[1])
+            raise exc_info[0], exc_info[1], exc_info[2]
+        else:
+            self._in_transaction = False
+            self._execute("COMMIT;", ())
+
+    def _execute(self, sql, params, method = "execute", fetch = False):
+        """
+        Run a statement, timing it and recording it in the query statistics
+
+        @return Tuple of the cursor and the fetched rows (None unless fetch is True)
+        """
+        started = time.time()
+        statement = sql
+        if self._statements is not None:
+            try:
+                sql = self._statements[sql]
+            except KeyError:
+                sql = translate_sql(sql, self.dialect)
         try:
             cursor = self.db.cursor()
-            cursor.execute(sql, params)
+            getattr(cursor, method)(sql, *params)
         except (AttributeError, MySQLdb.OperationalError):
+            if self._in_transaction: # Reconnecting would silently drop the transaction
+                raise
             self.connect()
             cursor = self.db.cursor()
-            cursor.execute(sql, params)
+            getattr(cursor, method)(sql, *params)
+
+        if fetch:
+            rows = cursor.fetchall()
+            row_count = len(rows)
+        else:
+            rows = None
+            row_count = cursor.rowcount
+        self._record(statement, params, (time.time() - started) * 1000, row_count)
+        return cursor, rows
+
+    def _record(self, sql, params, elapsed, row_count):
+        if len(params) == 1 and isinstance(params[0], (dict, list, tuple)):
+            param_count = len(params[0])
+        else:
+            param_count = len(params)
+        query_stats.stats.record(query_stats.calling_function(2), sql, elapsed, row_count, param_count)
+        if self.request_queries is not None:
+            self.request_queries.add(elapsed, row_count)
+
+class ConnectionPool(object):
+    """
+    A thread safe pool of database connections.
+
+    Connections are checked out for the duration of a request (or a single storage call) and
+    returned afterwards. Idle connections are health checked on checkout and periodically by
+    maintain(), which also closes connections that has been idle for too long.
+
+    The pool also exposes query, query_rowcount and execute so it can be passed to any
+    storage function directly, each call will then check out a connection of its own.
+
+    @param min_size The number of connections to keep open at all times
+    @param max_size The maximum number of open connections
+    @param idle_timeout Seconds a connection above min_size may stay idle before being closed
+    @param timeout Seconds to wait for a free connection before PoolTimeoutError is raised
+    @param ping_interval Connections idle for longer than this (in seconds) are pinged on checkout
+    @param connection_factory Callable creating new DbConnection objects
+    """
+    def __init__(self, min_size = 1, max_size = 10, idle_timeout = 300, timeout = 10,
+            ping_interval = 30, connection_factory = DbConnection):
+        self.min_size = max(0, int(min_size))
+        self.max_size = max(1, int(max_size), self.min_size)
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self.connection_factory = connection_factory
+        self._idle = deque()
+        self._size = 0
+        self._condition = threading.Condition()
+
+    def size(self):
+        """
+        Get the number of open connections, both idle and checked out
+        """
+        return self._size
+
+    def idle(self):
+        """
+        Get the number of idle connections
+        """
+        return len(self._idle)
+
+    def warm_up(self):
+        """
+        Open connections until the pool holds at least min_size connections
+        """
+        while True:
+            with self._condition:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            self.checkin(self._open())
+
+    def checkout(self, timeout = None):
+        """
+        Check out a healthy connection from the pool, opening a new one if none is idle and
+        the pool is not full. The connection must be returned using checkin.
+
+        @param timeout Seconds to wait for a free connection (default is the pool timeout)
+        @return A DbConnection
+        """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
+
+        with self._condition:
+            while True:
+                if self._idle:
+                    connection = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    connection = None
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolTimeoutError("No database connection available within %s seconds" % timeout)
+                self._condition.wait(remaining)
+
+        if connection is None:
+            return self._open()
+
+        if time.time() - connection.last_used > self.ping_interval and not connection.ping():
+            logging.warning("Replacing dead database connection")
+            connection.close()
+            return self._open()
+        return connection
+
+    def checkin(self, connection):
+        """
+        Return a connection previously checked out from the pool
+
+        @param connection The connection to return
+        """
+        connection.last_used = time.time()
+        with self._condition:
+            self._idle.append(connection)
+            self._condition.notify()
+
+    def discard(self, connection):
+        """
+        Close a checked out connection instead of returning it to the pool, use for broken
+        connections.
+
+        @param connection The connection to discard
+        """
+        connection.close()
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager that checks out a connection and returns it when done
+        """
+        connection = self.checkout()
+        try:
+            yield connection
+        finally:
+            self.checkin(connection)
+
+    def maintain(self):
+        """
+        Close connections idle for longer than idle_timeout (keeping min_size), replace idle
+        connections that no longer responds and top the pool up to min_size again.
+        """
+        now = time.time()
+        with self._condition:
+            candidates = list(self._idle)
+            self._idle.clear()
+
+        keep = [] # Most recently used first
+        for connection in reversed(candidates):
+            expired = now - connection.last_used > self.idle_timeout
+            if expired and len(keep) >= self.min_size:
+                self.discard(connection)
+            elif not connection.ping():
+                logging.warning("Closing dead database connection")
+                self.discard(connection)
+            else:
+                keep.append(connection)
+
+        with self._condition:
+            # Put back in front of any connection returned meanwhile, keeping the
+            # most recently used connections at the end where checkout takes them
+            self._idle.extendleft(keep)
+            self._condition.notify_all()
+
+        self.warm_up()
+
+    def close(self):
+        """
+        Close all idle connections
+        """
+        with self._condition:
+            candidates = list(self._idle)
+            self._idle.clear()
+        for connection in candidates:
+            self.discard(connection)
 
-        return cursor.rowcount
+    def query(self, sql, *params):
+        with self.connection() as connection:
+            return connection.query(sql, *params)
+
+    def query_tuples(self, sql, *params):
+        with self.connection() as connection:
+            return connection.query_tuples(sql, *params)
+
+    def query_rowcount(self, sql, params):
+        with self.connection() as connection:
+            return connection.query_rowcount(sql, params)
 
-    @hack_sql
     def execute(self, sql, *params):
+        with self.connection() as connection:
+            return connection.execute(sql, *params)
+
+    def executemany(self, sql, params_list):
+        with self.connection() as connection:
+            return connection.executemany(sql, params_list)
+
+    def upsert(self, table, keys, columns, params, increment = False):
+        with self.connection() as connection:
+            return connection.upsert(table, keys, columns, params, increment)
+
+    def upsert_many(self, table, keys, columns, params_list, increment = False):
+        with self.connection() as connection:
+            return connection.upsert_many(table, keys, columns, params_list, increment)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Context manager checking out a connection and running the enclosed statements in a
+        transaction on it, the connection is given as target.
+        """
+        with self.connection() as connection:
+            with connection.transaction():
+                yield connection
+
+    def binary(self, value):
+        with self.connection() as connection:
+            return connection.binary(value)
+
+    def _open(self):
         try:
-            cursor = self.db.cursor()
-            cursor.execute(sql, *params)
-        except (AttributeError, MySQLdb.OperationalError):
-            self.connect()
-            cursor = self.db.cursor()
-            cursor.execute(sql, *params)
-
-        return cursor.lastrowid
+            return self.connection_factory()
+        except:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
 
 def get_settings(db):
     """
@@ -128,7 +598,22 @@ def put_setting(db, name, value):
     @param value The setting's value
     @return True on success, else False
     """
-    return db.execute("UPDATE settings SET value=%(value)s WHERE name=%(name)s ;", { "value" : value, "name" : name }) == 1
+    with db.transaction() as connection:
+        updated = connection.query_rowcount("UPDATE settings SET value=%(value)s WHERE name=%(name)s ;", { "value" : value, "name" : name })
+        connection.execute("UPDATE versions SET version=version+1 WHERE name=%(name)s;", { "name" : "settings" })
+    return updated == 1
+
+def get_settings_version(db):
+    """
+    Get the settings version, increased each time a setting is changed
+
+    @param db The database connection
+    @return The version number
+    """
+    result = db.query_tuples("SELECT version FROM versions WHERE name=%(name)s;", { "name" : "settings" })
+    if result:
+        return int(result[0][0])
+    return 0
 
 def get_signup_count(db):
     """
@@ -242,6 +727,46 @@ def username_unique(db, username):
 
     return len(users) < 1
 
+def _load_user_id(db, username):
+    users = db.query_tuples("SELECT id FROM users WHERE username=%(username)s;", { "username" : username })
+    if users:
+        return users[0][0]
+    return None
+
+def _load_user_role(db, user_id):
+    users = db.query_tuples("SELECT type, state FROM users WHERE id=%(id)s;", { "id" : user_id })
+    if users:
+        return int(users[0][0]), int(users[0][1])
+    return None
+
+def get_user_role(db, user_id):
+    """
+    Get the type and state of the given user. Roles are cached for a short while, any
+    change to a user's type or state must call invalidate_user.
+
+    @param db The database connection to use
+    @param user_id The id of the user
+    @return A tuple of the user's type and state, or None if there is no such user
+    """
+    return role_cache.load(user_id, _load_user_role, db, user_id)
+
+def invalidate_user(user_id, username = None):
+    """
+    Remove the given user from the role caches
+
+    @param user_id The id of the user
+    @param username The user's username, to also forget the username's user id
+    """
+    role_cache.invalidate(user_id)
+    if username is not None:
+        user_id_cache.invalidate(username)
+
+def _user_role(db, username):
+    user_id = user_id_cache.load(username, _load_user_id, db, username)
+    if user_id is None:
+        return None
+    return get_user_role(db, user_id)
+
 def is_admin(db, username):
     """
     Check if the given user is an administrator or not.
@@ -250,8 +775,8 @@ def is_admin(db, username):
     @param username The username to check
     @return True if the user is an administrator, else False
     """
-    users = db.query("SELECT username FROM users WHERE username=%(username)s AND type=%(type)s;", { "username" : username, "type" : "1" })
-    return len(users) == 1    
+    role = _user_role(db, username)
+    return role is not None and role[0] == User.Administrator
 
 def enabled_user(db, username):
     """
@@ -261,11 +786,58 @@ def enabled_user(db, username):
     @param username The user to check
     @return True if the user is enabled, else False (user is disabled)
     """
-    users = db.query("SELECT state FROM users WHERE username=%(username)s;", { "username" : username })
-    if len(users) > 0:
-        return users[0].state == User.Enabled
-    return False
+    role = _user_role(db, username)
+    return role is not None and role[1] == User.Enabled
+
+def get_data_version(db, user_id):
+    """
+    Get the version of the user's activities and sheets, increased on every change
 
+    @param db The database connection to use
+    @param user_id The id of the user
+    @return A tuple of the version and the time of the last change in seconds since epoch,
+        (0, 0) if there is no such user
+    """
+    result = db.query_tuples("SELECT data_version, data_modified FROM users WHERE id=%(id)s;", { "id" : user_id })
+    if result:
+        return int(result[0][0]), int(result[0][1])
+    return 0, 0
+
+def _data_changed(db, user_id):
+    # Must run after the change, a reader could otherwise see the old data with the new version
+    db.execute("UPDATE users SET data_version=data_version+1, data_modified=%(now)s WHERE id=%(id)s;",
+        { "id" : user_id, "now" : int(time.time()) })
+    if check_data_versions:
+        return get_data_version(db, user_id)[0]
+    return None
+
+def _cached_data_changed(user_id, version):
+    """
+    Keep the user's cached data current after a change made by this process, call once the
+    change is committed and the cache entries it affects are invalidated
+
+    @param version The data version after the change, as returned by _data_changed
+    """
+    if version is not None and data_versions.get(user_id) == version - 1:
+        data_versions.put(user_id, version)
+
+def check_cached_data(db, user_id):
+    """
+    Remove the user's cached activities and report weeks if another process changed the
+    user's data since they were cached, call before reading either cache. Only checked
+    when check_data_versions is set, the caches are otherwise kept current by the changes
+    made by this process.
+
+    @param db The database connection to use
+    @param user_id The id of the user
+    """
+    if not check_data_versions:
+        return
+    version = get_data_version(db, user_id)[0]
+    if data_versions.get(user_id) != version:
+        activity_cache.invalidate(user_id)
+        week_cache.evict(lambda key: key[0] == user_id)
+        data_versions.put(user_id, version)
 
 def enable_user(db, username):
     """
@@ -275,6 +847,7 @@ def enable_user(db, username):
     @param username The user to enable
     """
     db.execute("UPDATE users SET state=%(state)s WHERE username=%(username)s;", { "state" : User.Enabled, "username" : username })
+    invalidate_user(user_id_cache.load(username, _load_user_id, db, username))
 
 def disable_user(db, username):
     """
@@ -284,6 +857,7 @@ def disable_user(db, username):
     @param username The user to disable
     """
     db.execute("UPDATE users SET state=%(state)s WHERE username=%(username)s;", { "state" : User.Disabled, "username" : username })
+    invalidate_user(user_id_cache.load(username, _load_user_id, db, username))
 
 def delete_user(db, username):
     """
@@ -301,8 +875,14 @@ def delete_user(db, username):
     user_id =  getattr(result[0], "id")
     
     db.execute("DELETE FROM activities WHERE user=%(user)s;", { "user" : user_id })
+    activity_cache.invalidate(user_id)
     db.execute("DELETE FROM sheets WHERE user=%(user)s;", { "user" : user_id })
+    db.execute("DELETE FROM sheet_totals WHERE user=%(user)s;", { "user" : user_id })
+    db.execute("DELETE FROM monthly_totals WHERE user=%(user)s;", { "user" : user_id })
+    db.execute("DELETE FROM yearly_totals WHERE user=%(user)s;", { "user" : user_id })
+    week_cache.evict(lambda key: key[0] == user_id)
     db.execute("DELETE FROM users WHERE id=%(user)s;", { "user" : user_id })
+    invalidate_user(user_id, username)
 
 def signup_user(db, email, code, ip):
     """
@@ -314,12 +894,9 @@ def signup_user(db, email, code, ip):
     @param ip The IP address that requested the sign up
     @return True on success, else False 
     """
-    result = db.query_rowcount("UPDATE signups SET activation_code=%(code)s WHERE username=%(email)s;",
-        { "email" : email, "code" : code, "ip" : ip })
-    if result == 0:
-        result = db.execute("INSERT INTO signups (username, activation_code, ip) VALUES(%(email)s, %(code)s, %(ip)s);",
-            { "email" : email, "code" : code, "ip" : ip })
-    return result
+    db.upsert("signups", ("username",), ("activation_code", "ip"),
+        { "username" : email, "activation_code" : code, "ip" : ip })
+    return True
 
 def username_for_activation_code(db, code):
     """
@@ -382,18 +959,18 @@ def reset_password(db, reset_code, new_password):
     @param db The database connection to use
     @param reset_code The unique reset code
     @param new_password The password to set (will not be hashed)
-    @return True on success, else False
+    @return The username of the account on success, else None
     """
     try:
         users = db.query("SELECT username FROM users WHERE reset_code=%(code)s;", { "code" : reset_code })
         if len(users) == 1:
             db.execute("UPDATE users SET password=%(newpass)s WHERE reset_code=%(code)s;", { "code" : reset_code, "newpass" : new_password })
             db.execute("UPDATE users SET reset_code='' WHERE reset_code=%(code)s;", { "code" : reset_code })
-            return True
+            return users[0].username
         else:
-            return False
+            return None
     except:
-        return False
+        return None
 
 def change_password(db, username, new_password):
     """
@@ -434,31 +1011,63 @@ def authenticate_user(db, username, password):
         users = db.query("SELECT id, username, type, state FROM users WHERE username=%(username)s AND password=%(password)s;",
             { "username" : username, "password" : password })
         if len(users) == 1:
-            return users[0]
+            return users[0]._asdict()
         else:
             return None
     except:
         return None
 
+def get_credentials(db, username):
+    """
+    Get the stored password hash of the given user, to be verified by the caller
+
+    @param db The database connection to use
+    @param username The username to get the credentials for
+    @return A tuple of the user object (except the password), the password hash and the salt, or None
+    """
+    users = db.query("SELECT id, username, type, state, password, salt FROM users WHERE username=%(username)s;",
+        { "username" : username })
+    if len(users) != 1:
+        return None
+    user = users[0]
+    return { "id" : user.id, "username" : user.username, "type" : user.type, "state" : user.state }, user.password, user.salt
+
+def upgrade_password(db, user_id, old_password, new_password):
+    """
+    Replace a user's password hash, unless the password was changed meanwhile
+
+    @param db The database connection to use
+    @param user_id The id of the user to update
+    @param old_password The password hash that was verified
+    @param new_password The password hash to store instead
+    @return True if the hash was replaced, else False
+    """
+    return db.query_rowcount("UPDATE users SET password=%(new)s WHERE id=%(user)s AND password=%(old)s;",
+        { "new" : new_password, "old" : old_password, "user" : user_id }) == 1
+
 #
 # Activities
 #
-def _create_list_of_activities(raw_list):
+def _create_list_of_activities(rows):
     """
-    Create a list of Activity objects based on the raw database rows
+    Create a list of Activity objects based on the raw database rows, the rows must
+    contain the columns id, title, color and state in that order
     """
-    if not raw_list:
-        return []
+    return [Activity(id = activity_id, color = Color(color), title = title, state = state)
+        for activity_id, title, color, state in rows]
+
+def _load_activities(db, user_id):
+    return tuple(_create_list_of_activities(
+        db.query_tuples("SELECT id, title, color, state FROM activities WHERE user=%(user)s;", { "user" : user_id })))
 
-    activities = []
-    for activity in raw_list:
-        a = Activity(
-            id = activity["id"],
-            color = Color(activity["color"]),
-            title = activity["title"],
-            state = activity["state"])
-        activities.append(a)
-    return activities
+def _cached_activities(db, user_id):
+    """
+    Get copies of the user's activities from the activity cache, so callers may change
+    them without changing the cached ones. Any change to the user's activities must
+    invalidate the cache.
+    """
+    check_cached_data(db, user_id)
+    return [activity.copy() for activity in activity_cache.load(user_id, _load_activities, db, user_id)]
 
 def get_activities(db, user_id):
     """
@@ -467,8 +1076,17 @@ def get_activities(db, user_id):
     @param db The database connection to use
     @param user_id The id of the authenticated username to retrieve activities for
     """
-    activities = db.query("SELECT id, title, color, state FROM activities WHERE user=%(user)s;", { "user" : user_id })
-    return _create_list_of_activities(activities)
+    return _cached_activities(db, user_id)
+
+def get_activity_dict(db, user_id):
+    """
+    Get all activities for the given user keyed on id
+
+    @param db The database connection to use
+    @param user_id The id of the authenticated username to retrieve activities for
+    @return An ActivityDict
+    """
+    return ActivityDict(_cached_activities(db, user_id))
 
 def get_enabled_activities(db, user_id):
     """
@@ -477,8 +1095,7 @@ def get_enabled_activities(db, user_id):
     @param db The database connection to use
     @param user_id The id of the authenticated username to retrieve activities for
     """
-    activities = db.query("SELECT id, title, color, state FROM activities WHERE user=%(user)s AND state = 1;", { "user" : user_id })
-    return _create_list_of_activities(activities)
+    return [a for a in _cached_activities(db, user_id) if a.enabled()]
 
 def get_disabled_activities(db, user_id):
     """
@@ -487,8 +1104,7 @@ def get_disabled_activities(db, user_id):
     @param db The database connection to use
     @param user_id The id of the authenticated username to retrieve activities for
     """
-    activities = db.query("SELECT id, title, color, state FROM activities WHERE user=%(user)s AND state = 0;", { "user" : user_id })
-    return _create_list_of_activities(activities)
+    return [a for a in _cached_activities(db, user_id) if a.disabled()]
 
 def add_activity(db, user_id, activity):
     """
@@ -500,6 +1116,8 @@ def add_activity(db, user_id, activity):
     """
     activity_id = db.execute("INSERT INTO activities (user, title, color) VALUES(%(id)s, %(title)s, %(color)s);",
         { "id" : user_id, "title" : activity.title, "color" : activity.color.hex() })
+    activity_cache.invalidate(user_id)
+    _cached_data_changed(user_id, _data_changed(db, user_id))
     activity.id = activity_id
     return activity
 
@@ -512,7 +1130,7 @@ def get_activity(db, user_id, activity_id):
     @param activity_id The id of the activity to retrieve
     @return The Activity or None if activity was not found
     """
-    activities = db.query("SELECT id, title, color, state FROM activities WHERE user=%(user)s AND id=%(activity_id)s;",
+    activities = db.query_tuples("SELECT id, title, color, state FROM activities WHERE user=%(user)s AND id=%(activity_id)s;",
         { "user" : user_id, "activity_id" : activity_id })
     if activities and len(activities) == 1:
         return _create_list_of_activities(activities)[0]
@@ -526,8 +1144,11 @@ def update_activity(db, user_id, activity):
     @param user_id The id of the authenticated user to associate the activity with
     @param activity The activity to update
     """
-    return db.execute("UPDATE activities SET title=%(title)s, color=%(color)s, state = %(state)s WHERE user=%(user)s AND id=%(activity_id)s;",
+    result = db.execute("UPDATE activities SET title=%(title)s, color=%(color)s, state = %(state)s WHERE user=%(user)s AND id=%(activity_id)s;",
         { "title" : activity.title, "color" : activity.color.hex(), "state" : activity.state, "user" : user_id, "activity_id" : activity.id})
+    activity_cache.invalidate(user_id)
+    _cached_data_changed(user_id, _data_changed(db, user_id))
+    return result
 
 def delete_activity(db, user_id, activity):
     """Deletes a given activity
@@ -536,27 +1157,126 @@ def delete_activity(db, user_id, activity):
     @param user_id The id of the authenticated user the activity is associated with
     @param activity The of the activity to delete
     """
-    return db.execute("DELETE FROM activities WHERE user=%(user)s AND id=%(activity)s;", {'user': user_id, 'activity': activity.id})
+    result = db.execute("DELETE FROM activities WHERE user=%(user)s AND id=%(activity)s;", {'user': user_id, 'activity': activity.id})
+    activity_cache.invalidate(user_id)
+    # The weeks using the activity are not known without reading the sheets
+    week_cache.evict(lambda key: key[0] == user_id)
+    _cached_data_changed(user_id, _data_changed(db, user_id))
+    return result
 
 #
 # Sheet functions
 # 
+def _sheets_changed(user_id, dates):
+    """
+    Remove the weeks containing the given dates from the report week cache
+    """
+    for date in dates:
+        if isinstance(date, basestring):
+            date = extract_date(date)
+        if date:
+            week_cache.invalidate((user_id,) + date.isocalendar()[:2])
+
+def _write_sheet_totals(db, user_id, sheets, rollups = True):
+    """
+    Replace the per activity totals of the given sheets and apply the differences to the
+    monthly and yearly rollups, call within the transaction writing the sheets
+
+    @param sheets A list of (date, quarters) tuples
+    @param rollups False to leave the rollups as they are
+    """
+    changes = {}
+    if rollups:
+        dates = set(str(date) for date, quarters in sheets)
+        previous = db.query_tuples("SELECT date, activity, quarters FROM sheet_totals "
+            "WHERE user=%(user)s AND date BETWEEN %(first)s AND %(last)s;",
+            { "user" : user_id, "first" : min(dates), "last" : max(dates) })
+        for date, activity_id, count in previous:
+            if str(date) in dates:
+                key = (_year_month(date), activity_id)
+                changes[key] = changes.get(key, 0) - count
+
+    db.executemany("DELETE FROM sheet_totals WHERE user=%(user)s AND date=%(date)s;",
+        [{ "user" : user_id, "date" : date } for date, quarters in sheets])
+    totals = [{ "user" : user_id, "date" : date, "activity" : activity_id, "quarters" : count }
+        for date, quarters in sheets for activity_id, count in summarize(quarters)]
+    if totals:
+        db.executemany("INSERT INTO sheet_totals (user, date, activity, quarters) "
+            "VALUES(%(user)s, %(date)s, %(activity)s, %(quarters)s);", totals)
+
+    if rollups:
+        for total in totals:
+            key = (_year_month(total["date"]), total["activity"])
+            changes[key] = changes.get(key, 0) + total["quarters"]
+        _update_rollups(db, user_id, changes)
+
+def _year_month(date):
+    date = str(date)
+    return int(date[:4]), int(date[5:7])
+
+def _update_rollups(db, user_id, changes):
+    """
+    Add the changed number of quarters to the monthly and yearly rollups
+
+    @param changes A dict of the change in quarters keyed on ((year, month), activity id)
+    """
+    monthly = []
+    yearly = {}
+    for ((year, month), activity_id), change in changes.iteritems():
+        if change:
+            monthly.append({ "user" : user_id, "year" : year, "month" : month,
+                "activity" : activity_id, "quarters" : change })
+            yearly[(year, activity_id)] = yearly.get((year, activity_id), 0) + change
+    if not monthly:
+        return
+
+    db.upsert_many("monthly_totals", ("user", "year", "month", "activity"), ("quarters",),
+        monthly, increment = True)
+    db.upsert_many("yearly_totals", ("user", "year", "activity"), ("quarters",),
+        [{ "user" : user_id, "year" : year, "activity" : activity_id, "quarters" : change }
+            for (year, activity_id), change in yearly.iteritems() if change], increment = True)
+    if any(row["quarters"] < 0 for row in monthly):
+        db.execute("DELETE FROM monthly_totals WHERE user=%(user)s AND quarters=0;", { "user" : user_id })
+        db.execute("DELETE FROM yearly_totals WHERE user=%(user)s AND quarters=0;", { "user" : user_id })
+
 def update_sheet(db, user_id, date, quarters):
     """
     Inserts the given time sheet for the given date. If a record exist for this
     date it will be replaced, if nothing exists a new record will be created.
+    The sheet's totals per activity are replaced in the same transaction.
 
     @param db The database connection to use
     @param user_id The id of the authenticated user the activity is associated with
     @param date The time sheets date, must be in the format YYYY-MM-DD
-    @param quarters the time sheets list of quarters
+    @param quarters the time sheets list of 96 activity ids
     """
-    result = db.query_rowcount("UPDATE sheets SET quarters=%(quarters)s WHERE user=%(user)s and date=%(date)s",
-        { "quarters" : quarters, "user" : user_id, "date" : date })
-    if result == 0:
-        result = db.execute("INSERT INTO sheets (user, date, quarters) VALUES(%(user)s, %(date)s, %(quarters)s);",
-            { "quarters" : quarters, "user" : user_id, "date" : date })
-    return result
+    with db.transaction() as connection:
+        connection.upsert("sheets", ("user", "date"), ("quarters",),
+            { "user" : user_id, "date" : date, "quarters" : connection.binary(codec.encode(quarters)) })
+        _write_sheet_totals(connection, user_id, [(date, quarters)])
+        version = _data_changed(connection, user_id)
+    _sheets_changed(user_id, [date])
+    _cached_data_changed(user_id, version)
+
+def update_sheets(db, user_id, sheets):
+    """
+    Inserts or replaces the time sheets for several dates in a single transaction,
+    using one batched upsert statement.
+
+    @param db The database connection to use
+    @param user_id The id of the authenticated user the sheets belong to
+    @param sheets A dict of lists of 96 activity ids keyed on date in the format YYYY-MM-DD
+    """
+    if not sheets:
+        return
+    with db.transaction() as connection:
+        connection.upsert_many("sheets", ("user", "date"), ("quarters",),
+            [{ "user" : user_id, "date" : date, "quarters" : connection.binary(codec.encode(quarters)) }
+                for date, quarters in sorted(sheets.items())])
+        _write_sheet_totals(connection, user_id, sorted(sheets.items()))
+        version = _data_changed(connection, user_id)
+    _sheets_changed(user_id, sheets.keys())
+    _cached_data_changed(user_id, version)
 
 def get_sheet(db, user_id, date):
     """
@@ -565,14 +1285,126 @@ def get_sheet(db, user_id, date):
     @param db The database connection to use
     @param user_id The id of the authenticated user the activity is associated with
     @param date The time sheets date, must be in the format YYYY-MM-DD
-    @return The sheet containing the quarters or None if no sheet found
+    @return The sheet's list of activity ids (empty if no activity that day) or None if no sheet found
     """
     sheets = db.query("SELECT quarters FROM sheets WHERE user=%(user)s and date=%(date)s", { "user" : user_id, "date" : date })
     if sheets and len(sheets) == 1:
-        return sheets[0]["quarters"]
+        return codec.decode(sheets[0]["quarters"])
     else:
         return None
 
+def get_sheet_totals(db, user_id, start, end):
+    """
+    Get the number of quarters spent on each activity per day within a date range, read
+    from the pre-aggregated totals without decoding any sheet
+
+    @param db The database connection to use
+    @param user_id The id of the authenticated user the sheets belong to
+    @param start The first date of the range (inclusive)
+    @param end The last date of the range (inclusive)
+    @return A dict of lists of (activity id, number of quarters) tuples, sorted on activity id,
+        keyed on date in the format YYYY-MM-DD. Days without activities are left out.
+    """
+    rows = db.query_tuples("SELECT date, activity, quarters FROM sheet_totals "
+        "WHERE user=%(user)s AND date BETWEEN %(start)s AND %(end)s ORDER BY date, activity;",
+        { "user" : user_id, "start" : start, "end" : end })
+    totals = {}
+    for date, activity_id, count in rows:
+        totals.setdefault(str(date), []).append((int(activity_id), int(count)))
+    return totals
+
+def get_quarter_count(db):
+    """
+    Get the number of quarters reported on any activity by all users
+
+    @param db The database connection to use
+    @return The number of quarters
+    """
+    result = db.query_tuples("SELECT SUM(quarters) FROM sheet_totals;")
+    if result and result[0][0]:
+        return int(result[0][0])
+    return 0
+
+def backfill_sheet_totals(db, batch_size = 500):
+    """
+    Rebuild the per activity totals of all stored sheets, for sheets stored before the
+    totals were maintained or after sheets were changed outside quarterapp. The rollups
+    are left as they are, rebuild them using rebuild_rollups afterwards.
+
+    @param db The database connection to use
+    @param batch_size The number of sheets rebuilt in each transaction
+    @return The number of sheets rebuilt
+    """
+    last_id = 0
+    count = 0
+    while True:
+        sheets = db.query("SELECT id, user, date, quarters FROM sheets WHERE id > %(id)s ORDER BY id LIMIT %(count)s;",
+            { "id" : last_id, "count" : batch_size })
+        if not sheets:
+            break
+        by_user = {}
+        for sheet in sheets:
+            by_user.setdefault(sheet.user, []).append((sheet.date, codec.decode(sheet.quarters)))
+        with db.transaction() as connection:
+            for user_id, user_sheets in by_user.iteritems():
+                _write_sheet_totals(connection, user_id, user_sheets, rollups = False)
+        count += len(sheets)
+        last_id = sheets[-1].id
+    week_cache.clear()
+    return count
+
+_MONTHLY_ROLLUP = {
+    "mysql" : "INSERT INTO monthly_totals (user, year, month, activity, quarters) "
+        "SELECT user, YEAR(date), MONTH(date), activity, SUM(quarters) FROM sheet_totals "
+        "GROUP BY user, YEAR(date), MONTH(date), activity;",
+    "sqlite" : "INSERT INTO monthly_totals (user, year, month, activity, quarters) "
+        "SELECT user, CAST(strftime('%Y', date) AS INTEGER), CAST(strftime('%m', date) AS INTEGER), "
+        "activity, SUM(quarters) FROM sheet_totals GROUP BY 1, 2, 3, 4;"
+}
+
+def rebuild_rollups(db):
+    """
+    Rebuild the monthly and yearly rollups from the per day totals
+
+    @param db The database connection to use
+    """
+    with db.transaction() as connection:
+        connection.execute("DELETE FROM monthly_totals;")
+        connection.execute("DELETE FROM yearly_totals;")
+        connection.execute(_MONTHLY_ROLLUP[connection.dialect])
+        connection.execute("INSERT INTO yearly_totals (user, year, activity, quarters) "
+            "SELECT user, year, activity, SUM(quarters) FROM monthly_totals GROUP BY user, year, activity;")
+
+def get_monthly_totals(db, user_id, start_year, end_year):
+    """
+    Get the number of quarters spent on each activity per month, read from the rollups
+
+    @param db The database connection to use
+    @param user_id The id of the authenticated user
+    @param start_year The first year to get (inclusive)
+    @param end_year The last year to get (inclusive)
+    @return A list of (year, month, activity id, number of quarters) tuples
+    """
+    return [tuple(int(value) for value in row) for row in db.query_tuples(
+        "SELECT year, month, activity, quarters FROM monthly_totals "
+        "WHERE user=%(user)s AND year BETWEEN %(start)s AND %(end)s ORDER BY year, month, activity;",
+        { "user" : user_id, "start" : start_year, "end" : end_year })]
+
+def get_yearly_totals(db, user_id, start_year, end_year):
+    """
+    Get the number of quarters spent on each activity per year, read from the rollups
+
+    @param db The database connection to use
+    @param user_id The id of the authenticated user
+    @param start_year The first year to get (inclusive)
+    @param end_year The last year to get (inclusive)
+    @return A list of (year, activity id, number of quarters) tuples
+    """
+    return [tuple(int(value) for value in row) for row in db.query_tuples(
+        "SELECT year, activity, quarters FROM yearly_totals "
+        "WHERE user=%(user)s AND year BETWEEN %(start)s AND %(end)s ORDER BY year, activity;",
+        { "user" : user_id, "start" : start_year, "end" : end_year })]
+
 def get_sheet_count(db, user_id):
     """
     Get the number of sheets reported by the user
@@ -0,0 +1,83 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import time
+
+from quarterapp.cache import LRUCache
+
+class TestLRUCache(unittest.TestCase):
+    def test_get_put(self):
+        cache = LRUCache(max_size = 10)
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", 1)
+        self.assertEqual(1, cache.get("a"))
+        self.assertEqual(2, cache.get("b", 2))
+
+    def test_least_recently_used_is_evicted(self):
+        cache = LRUCache(max_size = 2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        self.assertEqual(2, len(cache))
+        self.assertEqual(1, cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+
+    def test_expired_entries(self):
+        cache = LRUCache(max_size = 2, ttl = 0.01)
+        cache.put("a", 1)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("a"))
+
+    def test_load(self):
+        cache = LRUCache()
+        loaded = []
+        loader = lambda key: loaded.append(key) or key.upper()
+        self.assertEqual("A", cache.load("a", loader, "a"))
+        self.assertEqual("A", cache.load("a", loader, "a"))
+        self.assertEqual(["a"], loaded)
+
+    def test_none_is_not_cached(self):
+        cache = LRUCache()
+        cache.load("a", lambda: None)
+        self.assertEqual(0, len(cache))
+
+    def test_load_racing_invalidation_is_not_cached(self):
+        cache = LRUCache()
+        def loader():
+            cache.invalidate("a")
+            return "stale"
+        self.assertEqual("stale", cache.load("a", loader))
+        self.assertIsNone(cache.get("a"))
+
+    def test_invalidate_and_evict(self):
+        cache = LRUCache()
+        for key in [(1, "a"), (1, "b"), (2, "a")]:
+            cache.put(key, True)
+        cache.invalidate((1, "a"))
+        self.assertIsNone(cache.get((1, "a")))
+        cache.evict(lambda key: key[0] == 1)
+        self.assertIsNone(cache.get((1, "b")))
+        self.assertTrue(cache.get((2, "a")))
+
+    def test_evict_values(self):
+        cache = LRUCache()
+        for key, value in [("a", 1), ("b", 2), ("c", 1)]:
+            cache.put(key, value)
+        cache.evict_values(lambda value: value == 1)
+        self.assertEqual(1, len(cache))
+        self.assertEqual(2, cache.get("b"))
@@ -0,0 +1,77 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from nose.tools import raises
+
+from quarterapp.codec import *
+
+empty_day = [-1] * 96
+
+# Activity 3 : 0.75 h
+# Activity 7:  5 h
+# Activity 390000: 1.5 h
+busy_day = [-1] * 3 + [3] * 3 + [-1] * 24 + [7] * 20 + [-1] * 12 + [390000] * 6 + [-1] * 28
+
+class TestCodec(unittest.TestCase):
+    def test_empty_day_is_empty(self):
+        self.assertEqual("", encode(empty_day))
+        self.assertEqual([], decode(""))
+        self.assertEqual([], decode(None))
+
+    def test_round_trip(self):
+        self.assertEqual(busy_day, decode(encode(busy_day)))
+
+    def test_encoded_size(self):
+        # Header, three activity ids and one byte per quarter
+        self.assertEqual(2 + 3 * 4 + 96, len(encode(busy_day)))
+
+    def test_encode_strings(self):
+        self.assertEqual(busy_day, decode(encode([str(q) for q in busy_day])))
+
+    def test_decode_buffer(self):
+        self.assertEqual(busy_day, decode(buffer(encode(busy_day))))
+
+    def test_decode_legacy_format(self):
+        self.assertEqual(busy_day, decode(",".join(str(q) for q in busy_day)))
+
+    def test_parse(self):
+        self.assertEqual([3, -1, 7], parse("3,-1,7"))
+
+    @raises(ValueError)
+    def test_parse_invalid(self):
+        parse("3,x,7")
+
+    @raises(ValueError)
+    def test_parse_negative_id(self):
+        parse("3,-2,7")
+
+    @raises(ValueError)
+    def test_parse_too_large_id(self):
+        parse("3,%d,7" % 2 ** 31)
+
+    @raises(ValueError)
+    def test_encode_too_large_id(self):
+        encode([2 ** 31] + [-1] * 95)
+
+    def test_largest_id(self):
+        day = [MAX_ACTIVITY_ID] + [-1] * 95
+        self.assertEqual(day, decode(encode(day)))
+
+    @raises(ValueError)
+    def test_encode_not_full_day(self):
+        encode([1, 2, 3])
@@ -20,6 +20,7 @@ import datetime
 from nose.tools import raises
 
 from quarterapp.domain import *
+from quarterapp.codec import MAX_ACTIVITY_ID
 
 # Activity 3 : 0.75 h
 a3_075h = ["-1","-1","-1","3","3","3","-1","-1","-1","-1",
@@ -89,6 +90,14 @@ class TestColor(unittest.TestCase):
         self.assertEqual("#ffdb4e", c3.hex())
         self.assertEqual("#56a8ff", c4.hex())
 
+    def test_colors_are_interned(self):
+        self.assertIs(Color("#fcaf3e"), Color("#fcaf3e"))
+        self.assertIsNot(Color("#fcaf3e"), Color("#FCAF3E"))
+
+    def test_luminance_color_is_computed_once(self):
+        color = Color("#3465a4")
+        self.assertIs(color.luminance_color(-0.2), color.luminance_color(-0.2))
+
 class TestActivity(unittest.TestCase):
     def test_empty_activity(self):
         activity = Activity(1)
@@ -185,13 +194,27 @@ class TestTimesheet(unittest.TestCase):
         idx = 0
         for activity in sheet.activities:
             if idx == 0:
-                self.assertEquals("3", activity.id)
+                self.assertEquals(3, activity.id)
             elif idx == 1:
-                self.assertEquals("7", activity.id)
+                self.assertEquals(7, activity.id)
             elif idx == 2:
-                self.assertEquals("39", activity.id)
+                self.assertEquals(39, activity.id)
             idx += 1
 
+    def test_sheet_quarters_are_integers(self):
+        sheet = Timesheet(datetime.today(), a3_075h)
+        self.assertEquals(3, sheet.quarters[3])
+        self.assertEquals(NO_ACTIVITY, Timesheet(datetime.today()).quarters[0])
+
+    def test_summarize(self):
+        expected = [(3, 3), (7, 20), (39, 6)]
+        self.assertEquals(expected, summarize(a3_075h_a7_5h_a39_15h))
+        self.assertEquals(expected, summarize([int(q) for q in a3_075h_a7_5h_a39_15h]))
+        self.assertEquals([], summarize(["-1"] * 96))
+
+    def test_summarize_largest_id(self):
+        self.assertEquals([(MAX_ACTIVITY_ID, 96)], summarize([MAX_ACTIVITY_ID] * 96))
+
 class TestWeek(unittest.TestCase):
     def test_week(self):
         week8 = Week(2013, 8)
@@ -220,4 +243,29 @@ class TestWeek(unittest.TestCase):
         unique_activities = week10.get_weeks_activities()
         self.assertEquals(5, len(unique_activities))
 
+    def test_week_dates(self):
+        week1 = Week(2013, 1)
+        self.assertEquals(date(2012, 12, 31), week1.first_date)
+        self.assertEquals(date(2013, 1, 6), week1.last_date())
+        self.assertEquals(date(2013, 1, 2), week1.sheet(2).date)
+
+    def test_empty_days_share_quarters(self):
+        week8 = Week(2013, 8)
+        self.assertIs(EMPTY_DAY, week8.sheet(0).quarters)
+        self.assertIs(week8.sheet(0).quarters, week8.sheet(6).quarters)
+        self.assertEquals([], list(week8.sheet(3)))
+
+    def test_week_activities_are_summed(self):
+        week10 = Week(2013, 10)
+        week10.update_sheet(Timesheet(date(2013, 03, 4), a3_075h_a7_5h_a39_15h))
+        self.assertEquals(7.25, week10.total())
+
+        week10.update_sheet(Timesheet(date(2013, 03, 5), a3_075h))
+        activities = week10.get_weeks_activities()
+        self.assertEquals([3, 7, 39], [a.id for a in activities])
+        self.assertEquals(1.5, activities[0].amount)
+        self.assertEquals(8.0, week10.total())
+        self.assertEquals(0.75, week10.sheets[1].time(3))
+        self.assertEquals(0, week10.sheets[1].time(7))
+
 
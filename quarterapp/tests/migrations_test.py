@@ -0,0 +1,77 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import os
+import tempfile
+
+import quarterapp.storage
+import quarterapp.migrations
+import quarterapp.codec
+from quarterapp.tests.storage_test import setup_sqlite
+
+LEGACY_SHEET = ",".join(["5"] * 8 + ["-1"] * 88)
+
+class TestMigrations(unittest.TestCase):
+    def setUp(self):
+        fd, self.temp_name = tempfile.mkstemp()
+        os.close(fd)
+        self.db = quarterapp.storage.DbConnection(setup_sqlite(self.temp_name))
+
+    def tearDown(self):
+        self.db.close()
+        os.remove(self.temp_name)
+
+    def test_unmigrated_database(self):
+        self.assertEqual(0, quarterapp.migrations.current_version(self.db))
+        self.assertEqual(len(quarterapp.migrations.MIGRATIONS), len(quarterapp.migrations.pending_migrations(self.db)))
+
+    def test_migrate(self):
+        version = quarterapp.migrations.migrate(self.db)
+        self.assertEqual(quarterapp.migrations.latest_version(), version)
+        self.assertEqual(version, quarterapp.migrations.current_version(self.db))
+        self.assertEqual([], quarterapp.migrations.pending_migrations(self.db))
+
+    def test_migrate_twice(self):
+        quarterapp.migrations.migrate(self.db)
+        version = quarterapp.migrations.migrate(self.db)
+        self.assertEqual(quarterapp.migrations.latest_version(), version)
+
+    def test_indexes_are_created(self):
+        quarterapp.migrations.migrate(self.db)
+        indexes = [row.name for row in self.db.query("SELECT name FROM sqlite_master WHERE type='index';")]
+        self.assertIn("sheets_user_date", indexes)
+        self.assertIn("users_username", indexes)
+        self.assertIn("signups_activation_code", indexes)
+
+    def test_legacy_sheets_are_encoded(self):
+        self.db.execute("INSERT INTO sheets (user, date, quarters) VALUES(1, '2013-03-04', %(quarters)s);", { "quarters" : LEGACY_SHEET })
+        quarterapp.migrations.migrate(self.db)
+
+        raw = self.db.query("SELECT quarters FROM sheets;")[0].quarters
+        self.assertFalse(quarterapp.codec.is_legacy(raw))
+        self.assertEqual([5] * 8 + [-1] * 88, quarterapp.storage.get_sheet(self.db, 1, "2013-03-04"))
+
+    def test_sheet_totals_are_backfilled(self):
+        self.db.execute("INSERT INTO sheets (user, date, quarters) VALUES(1, '2013-03-04', %(quarters)s);", { "quarters" : LEGACY_SHEET })
+        quarterapp.migrations.migrate(self.db)
+        self.assertEqual(8, quarterapp.storage.get_quarter_count(self.db))
+
+    def test_rollups_are_rebuilt(self):
+        self.db.execute("INSERT INTO sheets (user, date, quarters) VALUES(1, '2013-03-04', %(quarters)s);", { "quarters" : LEGACY_SHEET })
+        quarterapp.migrations.migrate(self.db)
+        self.assertEqual([(2013, 3, 5, 8)], quarterapp.storage.get_monthly_totals(self.db, 1, 2013, 2013))
+        self.assertEqual([(2013, 5, 8)], quarterapp.storage.get_yearly_totals(self.db, 1, 2013, 2013))
@@ -0,0 +1,63 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import socket
+import tempfile
+
+import tornado.testing
+
+from quarterapp.notify import Notifier
+
+class TestNotifier(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super(TestNotifier, self).setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestNotifier, self).tearDown()
+
+    def notifier(self, name):
+        notifier = Notifier(self.directory, io_loop = self.io_loop)
+        notifier.path = os.path.join(self.directory, name) # One process, unique sockets
+        notifier.start()
+        self.addCleanup(notifier.stop)
+        return notifier
+
+    def test_publish(self):
+        sender = self.notifier("1.sock")
+        receiver = self.notifier("2.sock")
+        received = []
+        def on_settings():
+            received.append("settings")
+            self.stop()
+        receiver.subscribe("settings", on_settings)
+        sender.subscribe("settings", lambda: received.append("self"))
+
+        sender.publish("settings")
+        self.wait()
+        self.assertEqual(["settings"], received)
+
+    def test_stale_socket_is_removed(self):
+        stale = os.path.join(self.directory, "3.sock")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(stale)
+        sock.close()
+
+        self.notifier("1.sock").publish("settings")
+        self.assertFalse(os.path.exists(stale))
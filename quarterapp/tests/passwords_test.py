@@ -0,0 +1,64 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+
+from quarterapp import passwords
+from quarterapp.quarter_utils import hash_password
+
+class TestPasswords(unittest.TestCase):
+    def test_make_hash(self):
+        stored = passwords.make_hash("secret", iterations = 10)
+        algorithm, iterations, salt, digest = stored.split("$")
+        self.assertEqual("pbkdf2_sha256", algorithm)
+        self.assertEqual("10", iterations)
+        self.assertEqual(stored, passwords.make_hash("secret", 10, salt))
+        self.assertNotEqual(stored, passwords.make_hash("secret", 10))
+
+    def test_check(self):
+        stored = passwords.make_hash(u"s\xe4kert", iterations = 10)
+        self.assertTrue(passwords.check(u"s\xe4kert", stored))
+        self.assertFalse(passwords.check(u"sakert", stored))
+        self.assertFalse(passwords.check("secret", ""))
+
+    def test_check_legacy(self):
+        stored = hash_password("secret", "bob@example.com")
+        self.assertTrue(passwords.check("secret", stored, "bob@example.com"))
+        self.assertTrue(passwords.check(u"secret", stored, u"bob@example.com"))
+        self.assertFalse(passwords.check("secret", stored, "bobby@example.com"))
+        self.assertFalse(passwords.check("secret", stored))
+
+    def test_needs_upgrade(self):
+        self.assertTrue(passwords.needs_upgrade(hash_password("secret", "salt"), 10))
+        self.assertTrue(passwords.needs_upgrade(passwords.make_hash("secret", 5), 10))
+        self.assertFalse(passwords.needs_upgrade(passwords.make_hash("secret", 10), 10))
+
+class TestPasswordHasher(unittest.TestCase):
+    def setUp(self):
+        self.hasher = passwords.PasswordHasher(max_workers = 1, iterations = 10)
+
+    def tearDown(self):
+        self.hasher.shutdown()
+
+    def test_hash_and_verify(self):
+        stored = self.hasher.hash("secret").result()
+        self.assertFalse(self.hasher.needs_upgrade(stored))
+        self.assertTrue(self.hasher.verify("secret", stored).result())
+        self.assertFalse(self.hasher.verify("wrong", stored).result())
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, passwords.PasswordHasher, backend = "gpu")
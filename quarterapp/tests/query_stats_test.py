@@ -0,0 +1,81 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import sqlite3
+
+import quarterapp.storage
+import quarterapp.query_stats
+from quarterapp.query_stats import Histogram, QueryStats, RequestQueries
+from quarterapp.tests.storage_test import setup_sqlite
+
+class TestHistogram(unittest.TestCase):
+    def test_empty(self):
+        histogram = Histogram()
+        self.assertEqual(0, histogram.count)
+        self.assertEqual(0.0, histogram.mean())
+        self.assertEqual(0.0, histogram.percentile(95))
+
+    def test_add(self):
+        histogram = Histogram()
+        for elapsed in [0.5, 1.5, 3, 4, 40]:
+            histogram.add(elapsed, 2)
+        self.assertEqual(5, histogram.count)
+        self.assertEqual(10, histogram.rows)
+        self.assertEqual(40, histogram.max)
+        self.assertAlmostEqual(9.8, histogram.mean())
+        self.assertEqual(5, histogram.percentile(50))
+        self.assertEqual(40, histogram.percentile(95))
+
+    def test_unbounded_bucket(self):
+        histogram = Histogram()
+        histogram.add(12000, 0)
+        self.assertEqual(12000, histogram.percentile(50))
+
+class TestQueryStats(unittest.TestCase):
+    def setUp(self):
+        self.db = quarterapp.storage.DbConnection(setup_sqlite(":memory:"))
+        quarterapp.query_stats.stats.reset()
+
+    def test_queries_are_keyed_on_storage_function(self):
+        quarterapp.storage.get_sheet(self.db, 1, "2013-02-05")
+        quarterapp.storage.get_sheet(self.db, 1, "2013-02-06")
+        quarterapp.storage.get_user_count(self.db)
+
+        histograms = dict(quarterapp.query_stats.stats.histograms())
+        self.assertEqual(2, histograms["storage.get_sheet"].count)
+        self.assertEqual(1, histograms["storage.get_user_count"].count)
+
+    def test_request_queries(self):
+        queries = RequestQueries()
+        self.db.request_queries = queries
+        quarterapp.storage.get_user_count(self.db)
+        quarterapp.storage.get_activities(self.db, 1)
+        self.assertEqual(2, queries.count)
+        self.assertEqual(1, queries.rows)
+
+    def test_slow_query_threshold(self):
+        logged = []
+        stats = QueryStats(slow_threshold = 100)
+        original = quarterapp.query_stats.logging.warning
+        quarterapp.query_stats.logging.warning = lambda *args: logged.append(args)
+        try:
+            stats.record("storage.get_sheet", "SELECT *\n    FROM sheets WHERE id=%(id)s;", 50, 1, 1)
+            stats.record("storage.get_sheet", "SELECT *\n    FROM sheets WHERE id=%(id)s;", 150, 1, 1)
+        finally:
+            quarterapp.query_stats.logging.warning = original
+        self.assertEqual(1, len(logged))
+        self.assertEqual("SELECT * FROM sheets WHERE id=%(id)s;", logged[0][-1])
@@ -0,0 +1,106 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+import datetime
+import os
+import sqlite3
+import tempfile
+import threading
+
+import quarterapp.storage
+from quarterapp.report_jobs import ReportJob, ReportJobs
+from quarterapp.tests.storage_test import setup_sqlite
+
+BOB_THE_USER = 1
+
+class TestReportJobs(unittest.TestCase):
+    def setUp(self):
+        fd, self.temp_name = tempfile.mkstemp()
+        os.close(fd)
+        setup_sqlite(self.temp_name).close()
+        self.pool = quarterapp.storage.ConnectionPool(min_size = 0, max_size = 2,
+            connection_factory = lambda: quarterapp.storage.DbConnection(
+                sqlite3.connect(self.temp_name, check_same_thread = False)))
+        self.jobs = ReportJobs(self.pool, max_workers = 1, max_user_jobs = 1)
+        quarterapp.storage.update_sheet(self.pool, BOB_THE_USER, "2013-01-07", [3] * 4 + [-1] * 92)
+        quarterapp.storage.update_sheet(self.pool, BOB_THE_USER, "2013-06-03", [3] * 2 + [-1] * 94)
+
+    def tearDown(self):
+        self.jobs.shutdown()
+        os.remove(self.temp_name)
+
+    def test_job_is_run_in_chunks(self):
+        job = self.jobs.submit(BOB_THE_USER, datetime.date(2013, 1, 1), datetime.date(2013, 12, 31), "week", 1)
+        self.assertIs(job, job.future.result(timeout = 5))
+        self.assertEqual(ReportJob.Done, job.state)
+        self.assertEqual(7, job.total())
+        self.assertEqual(1.0, job.progress())
+        self.assertEqual(53, len(job.periods))
+        self.assertEqual(("2013-W02", [(3, 4)]), job.periods[1])
+        self.assertEqual(("2013-W23", [(3, 2)]), job.periods[22])
+        self.assertIs(job, self.jobs.get(job.id))
+
+    def test_identical_jobs_are_shared(self):
+        job = self.jobs.submit(BOB_THE_USER, datetime.date(2013, 1, 1), datetime.date(2013, 12, 31), "month", 1)
+        self.assertIs(job, self.jobs.submit(BOB_THE_USER, datetime.date(2013, 1, 1), datetime.date(2013, 12, 31), "month", 1))
+        job.future.result(timeout = 5)
+        self.assertIs(job, self.jobs.submit(BOB_THE_USER, datetime.date(2013, 1, 1), datetime.date(2013, 12, 31), "month", 1))
+
+        changed = self.jobs.submit(BOB_THE_USER, datetime.date(2013, 1, 1), datetime.date(2013, 12, 31), "month", 2)
+        self.assertIsNot(job, changed)
+        self.assertEqual(job.periods, changed.future.result(timeout = 5).periods)
+
+    def test_jobs_per_user_are_limited(self):
+        blocked = threading.Event()
+        self.jobs.executor.submit(blocked.wait)
+        job = self.jobs.submit(BOB_THE_USER, datetime.date(2013, 1, 1), datetime.date(2013, 12, 31), "day", 1)
+        self.assertEqual(ReportJob.Pending, job.state)
+        self.assertEqual(None, self.jobs.submit(BOB_THE_USER, datetime.date(2013, 1, 1), datetime.date(2013, 1, 2), "day", 1))
+        self.assertNotEqual(None, self.jobs.submit(2, datetime.date(2013, 1, 1), datetime.date(2013, 1, 2), "day", 1))
+
+        blocked.set()
+        job.future.result(timeout = 5)
+        self.assertNotEqual(None, self.jobs.submit(BOB_THE_USER, datetime.date(2013, 1, 1), datetime.date(2013, 1, 2), "day", 1))
+
+    def test_jobs_shared_in_database(self):
+        fd, path = tempfile.mkstemp(suffix = ".db")
+        os.close(fd)
+        try:
+            first = ReportJobs(self.pool, database = path)
+            second = ReportJobs(self.pool, database = path)
+            job = first.submit(BOB_THE_USER, datetime.date(2013, 1, 1), datetime.date(2013, 12, 31), "month", 1)
+            job.future.result(timeout = 5)
+
+            polled = second.get(job.id)
+            self.assertEqual(ReportJob.Done, polled.state)
+            self.assertEqual(job.total(), polled.total())
+            self.assertEqual(job.periods, polled.periods)
+            self.assertEqual(job.id, second.submit(BOB_THE_USER, datetime.date(2013, 1, 1), datetime.date(2013, 12, 31), "month", 1).id)
+
+            second.ttl = -1
+            self.assertEqual(None, second.get(job.id))
+            second.purge()
+            self.assertEqual(None, first.get("unknown"))
+            first.shutdown()
+            second.shutdown()
+        finally:
+            os.remove(path)
+
+    def test_unknown_job(self):
+        self.assertEqual(None, self.jobs.get("0123"))
+        self.assertEqual(None, self.jobs.get(None))
@@ -0,0 +1,157 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import datetime
+
+import quarterapp.storage
+import quarterapp.query_stats
+from quarterapp.reports import build_weeks, iso_weeks, report_weeks, report_chunks, period_chunks, period_totals, within_limit
+from quarterapp.domain import Activity, Color
+from quarterapp.tests.storage_test import setup_sqlite
+
+BOB_THE_USER = 1
+
+def sheet_queries():
+    histograms = dict(quarterapp.query_stats.stats.histograms())
+    if "storage.get_sheet_totals" in histograms:
+        return histograms["storage.get_sheet_totals"].count
+    return 0
+
+class TestReportWeeks(unittest.TestCase):
+    def test_weeks_across_years(self):
+        weeks = list(iso_weeks(datetime.date(2012, 12, 20), datetime.date(2013, 1, 10)))
+        self.assertEqual([(2012, 51), (2012, 52), (2013, 1), (2013, 2)], weeks)
+
+    def test_week_one_starting_in_december(self):
+        weeks = report_weeks(datetime.date(2014, 12, 24), datetime.date(2015, 1, 2))
+        self.assertEqual([52, 1], [week.week_of_year() for week in weeks])
+        self.assertEqual(datetime.date(2014, 12, 29), weeks[1].first_date)
+
+    def test_weeks_up_to_last_date(self):
+        weeks = list(iso_weeks(datetime.date(9999, 12, 13), datetime.date.max))
+        self.assertEqual([(9999, 50), (9999, 51), (9999, 52)], weeks)
+
+    def test_chunks_up_to_last_date(self):
+        chunks = list(report_chunks(datetime.date(9999, 12, 1), datetime.date.max, weeks = 2))
+        self.assertEqual([
+            (datetime.date(9999, 11, 29), datetime.date(9999, 12, 12)),
+            (datetime.date(9999, 12, 13), datetime.date(9999, 12, 26)),
+            (datetime.date(9999, 12, 27), datetime.date.max)], chunks)
+
+    def test_report_chunks(self):
+        chunks = list(report_chunks(datetime.date(2013, 3, 6), datetime.date(2013, 4, 10), weeks = 2))
+        self.assertEqual([
+            (datetime.date(2013, 3, 4), datetime.date(2013, 3, 17)),
+            (datetime.date(2013, 3, 18), datetime.date(2013, 3, 31)),
+            (datetime.date(2013, 4, 1), datetime.date(2013, 4, 10))], chunks)
+
+    def test_period_chunks(self):
+        chunks = period_chunks(datetime.date(2013, 3, 6), datetime.date(2013, 3, 20), "day", weeks = 2)
+        self.assertEqual([
+            (datetime.date(2013, 3, 6), datetime.date(2013, 3, 17)),
+            (datetime.date(2013, 3, 18), datetime.date(2013, 3, 20))], chunks)
+        chunks = period_chunks(datetime.date(2012, 11, 6), datetime.date(2013, 3, 20), "month")
+        self.assertEqual([
+            (datetime.date(2012, 11, 6), datetime.date(2012, 12, 31)),
+            (datetime.date(2013, 1, 1), datetime.date(2013, 3, 20))], chunks)
+
+class TestBuildWeeks(unittest.TestCase):
+    def setUp(self):
+        self.db = quarterapp.storage.DbConnection(setup_sqlite(":memory:"))
+        quarterapp.storage.week_cache.clear()
+        quarterapp.query_stats.stats.reset()
+
+    def tearDown(self):
+        quarterapp.storage.week_cache.clear()
+        quarterapp.storage.data_versions.clear()
+        quarterapp.storage.check_data_versions = False
+
+    def test_weeks_are_filled(self):
+        quarterapp.storage.update_sheet(self.db, BOB_THE_USER, "2013-03-05", [3] * 96)
+        weeks = build_weeks(self.db, BOB_THE_USER, datetime.date(2013, 3, 4), datetime.date(2013, 3, 17))
+        self.assertEqual([10, 11], [week.week_of_year() for week in weeks])
+        self.assertEqual(24, weeks[0].total())
+        self.assertEqual(0, weeks[1].total())
+
+    def test_weeks_are_cached(self):
+        build_weeks(self.db, BOB_THE_USER, datetime.date(2013, 3, 4), datetime.date(2013, 3, 17))
+        weeks = build_weeks(self.db, BOB_THE_USER, datetime.date(2013, 3, 4), datetime.date(2013, 3, 17))
+        self.assertEqual(2, len(weeks))
+        self.assertEqual(1, sheet_queries())
+
+    def test_only_changed_week_is_rebuilt(self):
+        first = build_weeks(self.db, BOB_THE_USER, datetime.date(2013, 3, 4), datetime.date(2013, 3, 17))
+        quarterapp.storage.update_sheet(self.db, BOB_THE_USER, "2013-03-12", [3] * 96)
+
+        second = build_weeks(self.db, BOB_THE_USER, datetime.date(2013, 3, 4), datetime.date(2013, 3, 17))
+        self.assertIs(first[0], second[0])
+        self.assertIsNot(first[1], second[1])
+        self.assertEqual(24, second[1].total())
+        self.assertEqual(2, sheet_queries())
+
+    def test_activity_deletion_evicts_users_weeks(self):
+        activity = quarterapp.storage.add_activity(self.db, BOB_THE_USER, Activity(title="Work", color=Color("#ccc")))
+        build_weeks(self.db, BOB_THE_USER, datetime.date(2013, 3, 4), datetime.date(2013, 3, 10))
+        quarterapp.storage.delete_activity(self.db, BOB_THE_USER, activity)
+        self.assertEqual(0, len(quarterapp.storage.week_cache))
+
+    def test_weeks_changed_by_other_process(self):
+        quarterapp.storage.check_data_versions = True
+        quarterapp.storage.add_user(self.db, "bob@example.com", "secretpassword", "salt")
+        quarterapp.storage.update_sheet(self.db, BOB_THE_USER, "2013-03-05", [3] * 96)
+        first = build_weeks(self.db, BOB_THE_USER, datetime.date(2013, 3, 4), datetime.date(2013, 3, 17))
+        quarterapp.storage.update_sheet(self.db, BOB_THE_USER, "2013-03-12", [3] * 96)
+        second = build_weeks(self.db, BOB_THE_USER, datetime.date(2013, 3, 4), datetime.date(2013, 3, 17))
+        self.assertIs(first[0], second[0])
+
+        self.db.execute("UPDATE users SET data_version=data_version+1;")
+        third = build_weeks(self.db, BOB_THE_USER, datetime.date(2013, 3, 4), datetime.date(2013, 3, 17))
+        self.assertIsNot(second[0], third[0])
+        self.assertEqual(24, third[0].total())
+
+class TestPeriodTotals(unittest.TestCase):
+    def setUp(self):
+        self.db = quarterapp.storage.DbConnection(setup_sqlite(":memory:"))
+        quarterapp.storage.update_sheet(self.db, BOB_THE_USER, "2012-12-31", [3] * 4 + [-1] * 92)
+        quarterapp.storage.update_sheet(self.db, BOB_THE_USER, "2013-01-06", [3] * 2 + [5] * 2 + [-1] * 92)
+        quarterapp.storage.update_sheet(self.db, BOB_THE_USER, "2013-03-05", [5] * 8 + [-1] * 88)
+
+    def test_days(self):
+        periods = period_totals(self.db, BOB_THE_USER, datetime.date(2013, 1, 5), datetime.date(2013, 1, 7), "day")
+        self.assertEqual([("2013-01-05", []), ("2013-01-06", [(3, 2), (5, 2)]), ("2013-01-07", [])], periods)
+
+    def test_weeks_are_widened(self):
+        periods = period_totals(self.db, BOB_THE_USER, datetime.date(2013, 1, 2), datetime.date(2013, 1, 9), "week")
+        self.assertEqual([("2013-W01", [(3, 6), (5, 2)]), ("2013-W02", [])], periods)
+
+    def test_months(self):
+        periods = period_totals(self.db, BOB_THE_USER, datetime.date(2012, 12, 20), datetime.date(2013, 3, 1), "month")
+        self.assertEqual([("2012-12", [(3, 4)]), ("2013-01", [(3, 2), (5, 2)]), ("2013-02", []),
+            ("2013-03", [(5, 8)])], periods)
+
+    def test_years(self):
+        periods = period_totals(self.db, BOB_THE_USER, datetime.date(2012, 6, 1), datetime.date(2013, 1, 1), "year")
+        self.assertEqual([("2012", [(3, 4)]), ("2013", [(3, 2), (5, 10)])], periods)
+
+    def test_weeks_up_to_last_date(self):
+        periods = period_totals(self.db, BOB_THE_USER, datetime.date(9999, 12, 20), datetime.date.max, "week")
+        self.assertEqual([("9999-W51", []), ("9999-W52", [])], periods)
+
+    def test_within_limit(self):
+        self.assertTrue(within_limit(datetime.date(2013, 1, 1), datetime.date(2013, 12, 31), "day"))
+        self.assertFalse(within_limit(datetime.date(2013, 1, 1), datetime.date(2014, 12, 31), "day"))
+        self.assertTrue(within_limit(datetime.date(1, 1, 1), datetime.date(9998, 12, 31), "year"))
@@ -0,0 +1,120 @@
+#
+#  Copyright (c) 2013 Markus Eliasson, http://www.quarterapp.com/
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+# 
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+# 
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from quarterapp.sessions import SessionStore
+
+class TestSessionStore(unittest.TestCase):
+    def setUp(self):
+        self.user = { "id" : 1, "username" : "bob@example.com", "type" : 0, "state" : 1 }
+
+    def test_create_get_delete(self):
+        sessions = SessionStore()
+        token = sessions.create(self.user)
+        self.assertEqual(32, len(token))
+        self.assertIs(self.user, sessions.get(token))
+        self.assertIsNone(sessions.get("unknown"))
+        self.assertIsNone(sessions.get(None))
+        # Without a database a lookup never blocks
+        self.assertTrue(sessions.cached("unknown"))
+        sessions.delete(token)
+        self.assertIsNone(sessions.get(token))
+
+    def test_expired_session(self):
+        sessions = SessionStore(ttl = -1)
+        token = sessions.create(self.user)
+        self.assertIsNone(sessions.get(token))
+
+    def test_persisted_sessions(self):
+        fd, path = tempfile.mkstemp(suffix = ".db")
+        os.close(fd)
+        try:
+            sessions = SessionStore(database = path)
+            token = sessions.create(self.user)
+            other = SessionStore(database = path)
+            self.assertTrue(sessions.cached(token))
+            self.assertFalse(other.cached(token))
+            self.assertEqual(self.user, other.get(token))
+            self.assertTrue(other.cached(token))
+
+            other.delete(token)
+            sessions.cache.clear()
+            self.assertIsNone(sessions.get(token))
+
+            sessions.ttl = -1
+            expired = sessions.create(self.user)
+            sessions.purge()
+            sessions.cache.clear()
+            self.assertIsNone(sessions.get(expired))
+            sessions.close()
+            other.close()
+        finally:
+            os.remove(path)
+
+    def test_revoke(self):
+        sessions = SessionStore()
+        first = sessions.create(self.user)
+        second = sessions.create(self.user)
+        other = sessions.create({ "id" : 2, "username" : "alice@example.com" })
+        sessions.revoke("bob@example.com")
+        self.assertIsNone(sessions.get(first))
+        self.assertIsNone(sessions.get(second))
+        self.assertIsNotNone(sessions.get(other))
+
+    def test_ended_in_other_process(self):
+        fd, path = tempfile.mkstemp(suffix = ".db")
+        os.close(fd)
+        try:
+            sessions = SessionStore(database = path, cache_ttl = 0)
+            token = sessions.create(self.user)
+            other = SessionStore(database = path, cache_ttl = 0)
+            self.assertEqual(self.user, other.get(token))
+
+            sessions.delete(token)
+            self.assertIsNone(other.get(token))
+
+            token = sessions.create(self.user)
+            self.assertEqual(self.user, other.get(token))
+            sessions.revoke("bob@example.com")
+            self.assertIsNone(other.get(token))
+            sessions.close()
+            other.close()
+        finally:
+            os.remove(path)
+
+    def test_sessions_stored_before_revoke(self):
+        fd, path = tempfile.mkstemp(suffix = ".db")
+        os.close(fd)
+        try:
+            db = sqlite3.connect(path)
+            db.execute("CREATE TABLE sessions (token VARCHAR(32) PRIMARY KEY, user TEXT NOT NULL, expires INTEGER NOT NULL);")
+            db.execute("INSERT INTO sessions VALUES('abc', '{\"id\": 1, \"username\": \"bob@example.com\"}', 2000000000);")
+            db.commit()
+            db.close()
+
+            sessions = SessionStore(database = path)
+            self.assertEqual(1, sessions.get("abc")["id"])
+            sessions.revoke("bob@example.com")
+            sessions.cache.clear()
+            self.assertIsNone(sessions.get("abc"))
+            sessions.close()
+        finally:
+            os.remove(path)
@@ -55,9 +55,36 @@ CREATE TABLE `sheets` (
     `id` INTEGER PRIMARY KEY AUTOINCREMENT,
     `user` INT(11) NOT NULL,
     `date` DATE NOT NULL,
-    `quarters` TEXT NOT NULL
+    `quarters` BLOB NOT NULL
 ) ;
 
+CREATE UNIQUE INDEX sheets_user_date ON sheets (user, date);
+
+CREATE TABLE `sheet_totals` (
+    `user` INT(11) NOT NULL,
+    `date` DATE NOT NULL,
+    `activity` INT(11) NOT NULL,
+    `quarters` SMALLINT NOT NULL,
+    PRIMARY KEY (`user`, `date`, `activity`)
+);
+
+CREATE TABLE `monthly_totals` (
+    `user` INT(11) NOT NULL,
+    `year` SMALLINT NOT NULL,
+    `month` TINYINT NOT NULL,
+    `activity` INT(11) NOT NULL,
+    `quarters` INT(11) NOT NULL,
+    PRIMARY KEY (`user`, `year`, `month`, `activity`)
+);
+
+CREATE TABLE `yearly_totals` (
+    `user` INT(11) NOT NULL,
+    `year` SMALLINT NOT NULL,
+    `activity` INT(11) NOT NULL,
+    `quarters` INT(11) NOT NULL,
+    PRIMARY KEY (`user`, `year`, `activity`)
+);
+
 CREATE TABLE `settings` (
     `id` INTEGER PRIMARY KEY AUTOINCREMENT,
     `name` VARCHAR(64) NOT NULL UNIQUE,
@@ -72,7 +99,9 @@ CREATE TABLE `users` (
     `type` TINYINT NOT NULL DEFAULT '0',
     `state`  TINYINT NOT NULL DEFAULT '0',
     `last_login` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    `reset_code` VARCHAR(64)
+    `reset_code` VARCHAR(64),
+    `data_version` INTEGER NOT NULL DEFAULT '0',
+    `data_modified` INTEGER NOT NULL DEFAULT '0'
 ) ;
 
 CREATE TABLE `signups` (
@@ -83,9 +112,17 @@ CREATE TABLE `signups` (
     `signup_time` TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+CREATE UNIQUE INDEX signups_username ON signups (username);
+
+
+CREATE TABLE `versions` (
+    `name` VARCHAR(64) PRIMARY KEY,
+    `version` INTEGER NOT NULL DEFAULT '0'
+);
 
 INSERT INTO settings (`name`, `value`) VALUES("allow-signups", "1");
 INSERT INTO settings (`name`, `value`) VALUES("allow-activations", "1");
+INSERT INTO versions (`name`, `version`) VALUES("settings", 0);
 
 INSERT INTO users (`username`, `password`, `type`, `state`) VALUES("admin", "", 1, 1);"""
     cur = conn.cursor()
@@ -112,21 +149,30 @@ class TestStorage(unittest.TestCase):
     def setUpClass(cls):
         if USE_MYSQL:
             import MySQLdb
-            cls.db = MySQLdb.connect(host = MYSQL_TEST_CONFIG["host"], port =  MYSQL_TEST_CONFIG["port"],
-                db = MYSQL_TEST_CONFIG["database"], user = MYSQL_TEST_CONFIG["user"], passwd = MYSQL_TEST_CONFIG["password"])
+            cls.db = quarterapp.storage.DbConnection(MySQLdb.connect(host = MYSQL_TEST_CONFIG["host"], port =  MYSQL_TEST_CONFIG["port"],
+                db = MYSQL_TEST_CONFIG["database"], user = MYSQL_TEST_CONFIG["user"], passwd = MYSQL_TEST_CONFIG["password"]))
         else:
             fd, temp_name = tempfile.mkstemp()
             os.close(fd) #Don't need the fd
-            cls.db = setup_sqlite(temp_name)
+            cls.db = quarterapp.storage.DbConnection(setup_sqlite(temp_name))
 
     @classmethod
     def tearDownClass(cls):
         cls.db.close()
 
     def tearDown(self):
-        quarterapp.storage._exec(self.db, "DELETE FROM activities")
-        quarterapp.storage._exec(self.db, "DELETE FROM users")
-        quarterapp.storage._exec(self.db, "DELETE FROM sheets")
+        self.db.execute("DELETE FROM activities")
+        self.db.execute("DELETE FROM users")
+        self.db.execute("DELETE FROM sheets")
+        self.db.execute("DELETE FROM sheet_totals")
+        self.db.execute("DELETE FROM monthly_totals")
+        self.db.execute("DELETE FROM yearly_totals")
+        quarterapp.storage.activity_cache.clear()
+        quarterapp.storage.role_cache.clear()
+        quarterapp.storage.user_id_cache.clear()
+        quarterapp.storage.week_cache.clear()
+        quarterapp.storage.data_versions.clear()
+        quarterapp.storage.check_data_versions = False
 
     ## Activities test
 
@@ -202,6 +248,54 @@ class TestStorage(unittest.TestCase):
         activity = quarterapp.storage.get_activity(self.db, BOB_THE_USER, activity.id)
         self.assertTrue(activity.disabled())
 
+    def test_activities_are_cached(self):
+        a1 = Activity(title="Activity 5", color=Color("#ccc"))
+        quarterapp.storage.add_activity(self.db, BOB_THE_USER, a1)
+        self.assertEqual(1, len(quarterapp.storage.get_activities(self.db, BOB_THE_USER)))
+
+        # Not seen until the cache is invalidated
+        self.db.execute("DELETE FROM activities")
+        self.assertEqual(1, len(quarterapp.storage.get_activities(self.db, BOB_THE_USER)))
+        self.assertIn(a1.id, quarterapp.storage.get_activity_dict(self.db, BOB_THE_USER))
+
+        a2 = Activity(title="Activity 6", color=Color("#ccc"))
+        quarterapp.storage.add_activity(self.db, BOB_THE_USER, a2)
+        self.assertEqual([a2.id], [a.id for a in quarterapp.storage.get_activities(self.db, BOB_THE_USER)])
+
+        a2.disable()
+        quarterapp.storage.update_activity(self.db, BOB_THE_USER, a2)
+        self.assertEqual(0, len(quarterapp.storage.get_enabled_activities(self.db, BOB_THE_USER)))
+        self.assertEqual(1, len(quarterapp.storage.get_disabled_activities(self.db, BOB_THE_USER)))
+
+        quarterapp.storage.delete_activity(self.db, BOB_THE_USER, a2)
+        self.assertEqual({}, quarterapp.storage.get_activity_dict(self.db, BOB_THE_USER))
+
+    def test_activities_changed_by_other_process(self):
+        quarterapp.storage.check_data_versions = True
+        quarterapp.storage.add_user(self.db, "bob@example.com", "secretpassword", "salt")
+        user_id = self.db.query("SELECT id FROM users WHERE username='bob@example.com';")[0].id
+        quarterapp.storage.add_activity(self.db, user_id, Activity(title="Activity 5", color=Color("#ccc")))
+        self.assertEqual("Activity 5", quarterapp.storage.get_activities(self.db, user_id)[0].title)
+
+        # Changes made by this process keep the cached activities
+        self.db.execute("UPDATE activities SET title='Activity 6';")
+        quarterapp.storage.update_sheet(self.db, user_id, "2013-04-01", default_sheet())
+        self.assertEqual("Activity 5", quarterapp.storage.get_activities(self.db, user_id)[0].title)
+
+        # Another process changing the data also increases the version
+        self.db.execute("UPDATE users SET data_version=data_version+1;")
+        self.assertEqual("Activity 6", quarterapp.storage.get_activities(self.db, user_id)[0].title)
+
+    def test_cached_activities_are_copies(self):
+        quarterapp.storage.add_activity(self.db, BOB_THE_USER, Activity(title="Activity 5", color=Color("#ccc")))
+        activity = quarterapp.storage.get_activities(self.db, BOB_THE_USER)[0]
+        activity.title = "Changed"
+        quarterapp.storage.get_activity_dict(self.db, BOB_THE_USER)[activity.id].disable()
+
+        cached = quarterapp.storage.get_activity_dict(self.db, BOB_THE_USER)[activity.id]
+        self.assertEqual("Activity 5", cached.title)
+        self.assertTrue(cached.enabled())
+
     ## Sheet test
 
     def test_get_empty_sheet(self):
@@ -212,11 +306,96 @@ class TestStorage(unittest.TestCase):
         sheet = quarterapp.storage.get_sheet(self.db, BOB_THE_USER, "2013-02-05")
         self.assertIsNone(sheet)
 
-        quarterapp.storage.update_sheet(self.db, BOB_THE_USER, "2012-02-05", str(default_sheet()))
+        quarterapp.storage.update_sheet(self.db, BOB_THE_USER, "2012-02-05", default_sheet())
         sheet = quarterapp.storage.get_sheet(self.db, BOB_THE_USER, "2012-02-05")
         
         self.assertIsNotNone(sheet)
 
+    def test_sheet_totals(self):
+        quarterapp.storage.update_sheet(self.db, BOB_THE_USER, "2013-03-04", [3] * 8 + [5] * 4 + [-1] * 84)
+        quarterapp.storage.update_sheet(self.db, BOB_THE_USER, "2013-03-05", [3] * 96)
+        quarterapp.storage.update_sheet(self.db, BOB_THE_USER, "2013-03-05", [5] * 2 + [-1] * 94)
+        quarterapp.storage.update_sheets(self.db, BOB_THE_USER, { "2013-03-06" : default_sheet() })
+
+        totals = quarterapp.storage.get_sheet_totals(self.db, BOB_THE_USER, "2013-03-04", "2013-03-10")
+        self.assertEqual({ "2013-03-04" : [(3, 8), (5, 4)], "2013-03-05" : [(5, 2)] }, totals)
+        self.assertEqual(14, quarterapp.storage.get_quarter_count(self.db))
+
+    def test_backfill_sheet_totals(self):
+        quarterapp.storage.update_sheet(self.db, BOB_THE_USER, "2013-03-04", [3] * 8 + [-1] * 88)
+        self.db.execute("DELETE FROM sheet_totals")
+        self.assertEqual(0, quarterapp.storage.get_quarter_count(self.db))
+
+        self.assertEqual(1, quarterapp.storage.backfill_sheet_totals(self.db))
+        self.assertEqual({ "2013-03-04" : [(3, 8)] },
+            quarterapp.storage.get_sheet_totals(self.db, BOB_THE_USER, "2013-03-04", "2013-03-04"))
+
+    def test_rollups(self):
+        quarterapp.storage.update_sheet(self.db, BOB_THE_USER, "2013-03-04", [3] * 8 + [5] * 4 + [-1] * 84)
+        quarterapp.storage.update_sheets(self.db, BOB_THE_USER, {
+            "2013-03-05" : [3] * 96, "2013-04-01" : [5] * 2 + [-1] * 94 })
+        quarterapp.storage.update_sheet(self.db, BOB_THE_USER, "2013-03-05", [5] * 2 + [-1] * 94)
+
+        self.assertEqual([(2013, 3, 3, 8), (2013, 3, 5, 6), (2013, 4, 5, 2)],
+            quarterapp.storage.get_monthly_totals(self.db, BOB_THE_USER, 2013, 2013))
+        self.assertEqual([(2013, 3, 8), (2013, 5, 8)],
+            quarterapp.storage.get_yearly_totals(self.db, BOB_THE_USER, 2013, 2013))
+
+        quarterapp.storage.update_sheet(self.db, BOB_THE_USER, "2013-03-04", default_sheet())
+        self.assertEqual([(2013, 3, 5, 2), (2013, 4, 5, 2)],
+            quarterapp.storage.get_monthly_totals(self.db, BOB_THE_USER, 2013, 2013))
+        self.assertEqual([(2013, 5, 4)], quarterapp.storage.get_yearly_totals(self.db, BOB_THE_USER, 2013, 2013))
+        self.assertEqual([], quarterapp.storage.get_yearly_totals(self.db, BOB_THE_USER, 2014, 2014))
+
+    def test_rebuild_rollups(self):
+        quarterapp.storage.update_sheet(self.db, BOB_THE_USER, "2013-03-04", [3] * 8 + [-1] * 88)
+        quarterapp.storage.update_sheet(self.db, BOB_THE_USER, "2014-01-02", [3] * 4 + [-1] * 92)
+        self.db.execute("DELETE FROM monthly_totals")
+        self.db.execute("UPDATE yearly_totals SET quarters=100")
+
+        quarterapp.storage.rebuild_rollups(self.db)
+        self.assertEqual([(2013, 3, 3, 8), (2014, 1, 3, 4)],
+            quarterapp.storage.get_monthly_totals(self.db, BOB_THE_USER, 2013, 2014))
+        self.assertEqual([(2013, 3, 8), (2014, 3, 4)],
+            quarterapp.storage.get_yearly_totals(self.db, BOB_THE_USER, 2013, 2014))
+
+    def test_data_version(self):
+        quarterapp.storage.add_user(self.db, "bob@example.com", "secretpassword", "salt")
+        user_id = self.db.query("SELECT id FROM users WHERE username='bob@example.com';")[0].id
+        self.assertEqual((0, 0), quarterapp.storage.get_data_version(self.db, user_id))
+
+        quarterapp.storage.update_sheet(self.db, user_id, "2013-04-01", default_sheet())
+        version, modified = quarterapp.storage.get_data_version(self.db, user_id)
+        self.assertEqual(1, version)
+        self.assertTrue(modified > 0)
+
+        quarterapp.storage.update_sheets(self.db, user_id, { "2013-04-02" : default_sheet() })
+        activity = quarterapp.storage.add_activity(self.db, user_id, Activity(title="Activity 7", color=Color("#ccc")))
+        quarterapp.storage.update_activity(self.db, user_id, activity)
+        quarterapp.storage.delete_activity(self.db, user_id, activity)
+        self.assertEqual(5, quarterapp.storage.get_data_version(self.db, user_id)[0])
+
+    def test_update_sheets(self):
+        quarterapp.storage.update_sheet(self.db, BOB_THE_USER, "2013-04-01", default_sheet())
+        busy = [3] * 96
+
+        quarterapp.storage.update_sheets(self.db, BOB_THE_USER,
+            { "2013-04-01" : busy, "2013-04-02" : busy, "2013-04-03" : default_sheet() })
+
+        self.assertEqual(busy, quarterapp.storage.get_sheet(self.db, BOB_THE_USER, "2013-04-01"))
+        self.assertEqual(busy, quarterapp.storage.get_sheet(self.db, BOB_THE_USER, "2013-04-02"))
+        self.assertEqual([], quarterapp.storage.get_sheet(self.db, BOB_THE_USER, "2013-04-03"))
+        self.assertIsNone(quarterapp.storage.get_sheet(self.db, BOB_THE_USER, "2013-04-04"))
+
+    def test_transaction_rolls_back_on_error(self):
+        try:
+            with self.db.transaction() as connection:
+                quarterapp.storage.update_sheet(connection, BOB_THE_USER, "2013-04-05", default_sheet())
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertIsNone(quarterapp.storage.get_sheet(self.db, BOB_THE_USER, "2013-04-05"))
+
 
     ## Signup tests
 
@@ -309,6 +488,24 @@ class TestStorage(unittest.TestCase):
         result = quarterapp.storage.authenticate_user(self.db, "bobby@example.com", "iamahacker")
         self.assertIsNone(result)        
 
+    def test_get_credentials(self):
+        quarterapp.storage.add_user(self.db, "bob@example.com", "secretpassword", "salt")
+
+        user, password, salt = quarterapp.storage.get_credentials(self.db, "bob@example.com")
+        self.assertEqual("bob@example.com", user["username"])
+        self.assertNotIn("password", user)
+        self.assertEqual("secretpassword", password)
+        self.assertEqual("salt", salt)
+        self.assertIsNone(quarterapp.storage.get_credentials(self.db, "bobby@example.com"))
+
+    def test_upgrade_password(self):
+        quarterapp.storage.add_user(self.db, "bob@example.com", "secretpassword", "salt")
+        user_id = quarterapp.storage.get_credentials(self.db, "bob@example.com")[0]["id"]
+
+        self.assertFalse(quarterapp.storage.upgrade_password(self.db, user_id, "changed", "upgraded"))
+        self.assertTrue(quarterapp.storage.upgrade_password(self.db, user_id, "secretpassword", "upgraded"))
+        self.assertEqual("upgraded", quarterapp.storage.get_credentials(self.db, "bob@example.com")[1])
+
     def test_reset_user_password(self):
         quarterapp.storage.add_user(self.db, "bob@example.com", "secretpassword", "salt")
         quarterapp.storage.add_user(self.db, "bobby@example.com", "secretpassword", "salt")
@@ -320,7 +517,7 @@ class TestStorage(unittest.TestCase):
         self.assertFalse(result)
 
         result = quarterapp.storage.reset_password(self.db, "okay", "anothersecret")
-        self.assertTrue(result)
+        self.assertEqual("bobby@example.com", result)
 
     def test_reset_does_not_affect_password(self):
         quarterapp.storage.add_user(self.db, "bob@example.com", "secretpassword", "salt")
@@ -415,6 +612,25 @@ class TestStorage(unittest.TestCase):
         result = quarterapp.storage.is_admin(self.db, "notadmin@example.com")
         self.assertFalse(result)
 
+    def test_user_role_is_cached(self):
+        quarterapp.storage.add_user(self.db, "admin@example.com", "secretpassword", "salt", quarterapp.storage.User.Administrator)
+        user_id = self.db.query("SELECT id FROM users WHERE username='admin@example.com';")[0].id
+        role = (quarterapp.storage.User.Administrator, quarterapp.storage.User.Enabled)
+        self.assertEqual(role, quarterapp.storage.get_user_role(self.db, user_id))
+
+        # Not seen until the user is invalidated
+        self.db.execute("UPDATE users SET type=0;")
+        self.assertTrue(quarterapp.storage.is_admin(self.db, "admin@example.com"))
+        quarterapp.storage.invalidate_user(user_id)
+        self.assertFalse(quarterapp.storage.is_admin(self.db, "admin@example.com"))
+
+        quarterapp.storage.disable_user(self.db, "admin@example.com")
+        self.assertFalse(quarterapp.storage.enabled_user(self.db, "admin@example.com"))
+
+        quarterapp.storage.delete_user(self.db, "admin@example.com")
+        self.assertIsNone(quarterapp.storage.get_user_role(self.db, user_id))
+        self.assertFalse(quarterapp.storage.enabled_user(self.db, "admin@example.com"))
+
     def test_change_password(self):
         quarterapp.storage.add_user(self.db, "bob@example.com", "secretpassword", "salt")
         quarterapp.storage.add_user(self.db, "bobby@example.com", "secretpassword", "salt")
@@ -442,8 +658,11 @@ class TestStorage(unittest.TestCase):
         settings = QuarterSettings(self.db)
         self.assertEqual("1", settings.get_value("allow-signups"))
 
+        previous = settings.settings
         settings.put_value("allow-signups", "0")
         self.assertEqual("0", settings.get_value("allow-signups"))
+        # Replaced rather than changed, readers holding the old dict are unaffected
+        self.assertEqual("1", previous["allow-signups"])
 
         # Restore
         settings.put_value("allow-signups", "1")
@@ -468,7 +687,118 @@ class TestStorage(unittest.TestCase):
         self.assertEqual("0", quarterapp.storage.get_setting(self.db, "allow-signups"))
         settings.put_value("allow-signups", "1")
         
+    def test_settings_version(self):
+        version = quarterapp.storage.get_settings_version(self.db)
+        quarterapp.storage.put_setting(self.db, "allow-signups", "0")
+        self.assertEqual(version + 1, quarterapp.storage.get_settings_version(self.db))
+        quarterapp.storage.put_setting(self.db, "allow-signups", "1")
+
+    def test_refresh_settings(self):
+        settings = QuarterSettings(self.db)
+        quarterapp.storage.put_setting(self.db, "allow-signups", "0")
+        settings.refresh()
+        self.assertEqual("0", settings.get_value("allow-signups"))
+
+        # Restore
+        quarterapp.storage.put_setting(self.db, "allow-signups", "1")
+
     def test_settings_db(self):
         quarterapp.storage.put_setting(self.db, "allow-signups", "w")
         self.assertEqual("w", quarterapp.storage.get_setting(self.db, "allow-signups"))
         quarterapp.storage.put_setting(self.db, "allow-signups", "1")
+
+
+def sqlite_memory_connection():
+    return quarterapp.storage.DbConnection(sqlite3.connect(":memory:", check_same_thread = False))
+
+class TestConnectionPool(unittest.TestCase):
+    def test_warm_up(self):
+        pool = quarterapp.storage.ConnectionPool(min_size = 2, max_size = 4, connection_factory = sqlite_memory_connection)
+        pool.warm_up()
+        self.assertEqual(2, pool.size())
+        self.assertEqual(2, pool.idle())
+
+    def test_connection_is_reused(self):
+        pool = quarterapp.storage.ConnectionPool(min_size = 0, max_size = 2, connection_factory = sqlite_memory_connection)
+        first = pool.checkout()
+        pool.checkin(first)
+        second = pool.checkout()
+        self.assertIs(first, second)
+        self.assertEqual(1, pool.size())
+
+    def test_exhausted_pool_times_out(self):
+        pool = quarterapp.storage.ConnectionPool(min_size = 0, max_size = 1, timeout = 0.01, connection_factory = sqlite_memory_connection)
+        pool.checkout()
+        self.assertRaises(quarterapp.storage.PoolTimeoutError, pool.checkout)
+
+    def test_dead_connection_is_replaced(self):
+        pool = quarterapp.storage.ConnectionPool(min_size = 0, max_size = 1, ping_interval = 0, connection_factory = sqlite_memory_connection)
+        first = pool.checkout()
+        first.db.close()
+        pool.checkin(first)
+
+        second = pool.checkout()
+        self.assertIsNot(first, second)
+        self.assertEqual(1, len(second.query("SELECT 1 AS one;")))
+
+    def test_maintain_closes_idle_connections(self):
+        pool = quarterapp.storage.ConnectionPool(min_size = 1, max_size = 3, idle_timeout = 0, connection_factory = sqlite_memory_connection)
+        connections = [pool.checkout() for i in range(3)]
+        for connection in connections:
+            pool.checkin(connection)
+        self.assertEqual(3, pool.size())
+
+        pool.maintain()
+        self.assertEqual(1, pool.size())
+        self.assertEqual(1, pool.idle())
+
+class TestTranslateSql(unittest.TestCase):
+    def test_mysql_is_unchanged(self):
+        sql = "SELECT * FROM users WHERE id=%(id)s;"
+        self.assertIs(sql, quarterapp.storage.translate_sql(sql, "mysql"))
+
+    def test_sqlite_placeholders(self):
+        self.assertEqual("SELECT * FROM users WHERE id=:id AND type=?;",
+            quarterapp.storage.translate_sql("SELECT * FROM users WHERE id=%(id)s AND type=%s;", "sqlite"))
+
+    def test_translation_is_cached(self):
+        first = quarterapp.storage.translate_sql("SELECT * FROM sheets WHERE user=%(user)s;", "sqlite")
+        second = quarterapp.storage.translate_sql("SELECT * FROM sheets WHERE user=%(user)s;", "sqlite")
+        self.assertIs(first, second)
+
+class TestUpsertSql(unittest.TestCase):
+    def test_mysql(self):
+        self.assertEqual("INSERT INTO sheets (user, date, quarters) VALUES(%(user)s, %(date)s, %(quarters)s) "
+            "ON DUPLICATE KEY UPDATE quarters=VALUES(quarters);",
+            quarterapp.storage.upsert_sql("sheets", ("user", "date"), ("quarters",), "mysql"))
+
+    def test_sqlite(self):
+        self.assertEqual("INSERT INTO sheets (user, date, quarters) VALUES(%(user)s, %(date)s, %(quarters)s) "
+            "ON CONFLICT (user, date) DO UPDATE SET quarters=excluded.quarters;",
+            quarterapp.storage.upsert_sql("sheets", ("user", "date"), ("quarters",), "sqlite"))
+
+class TestRow(unittest.TestCase):
+    def setUp(self):
+        self.db = sqlite_memory_connection()
+
+    def test_access_by_position_and_name(self):
+        row = self.db.query("SELECT 1 AS id, 'bobby' AS username;")[0]
+        self.assertEqual((1, "bobby"), tuple(row))
+        self.assertEqual("bobby", row[1])
+        self.assertEqual("bobby", row["username"])
+        self.assertEqual(1, row.id)
+        self.assertEqual({ "id" : 1, "username" : "bobby" }, row._asdict())
+
+    def test_unknown_column(self):
+        row = self.db.query("SELECT 1 AS id;")[0]
+        self.assertRaises(AttributeError, getattr, row, "username")
+        self.assertRaises(KeyError, lambda: row["username"])
+
+    def test_row_class_is_shared(self):
+        first = self.db.query("SELECT 1 AS id;")[0]
+        second = self.db.query("SELECT 2 AS id;")[0]
+        self.assertIs(type(first), type(second))
+        self.assertFalse(hasattr(first, "__dict__"))
+
+    def test_query_tuples(self):
+        self.assertEqual([(1, "bobby")], self.db.query_tuples("SELECT 1, 'bobby';"))
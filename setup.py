@@ -19,7 +19,8 @@ setup(
     license="GPLv3 license",
     description='Personal time management',
     install_requires=[
-        "tornado >= 2.4.0"
+        "tornado >= 3.1.0",
+        "futures >= 2.1.3"
     ],
     entry_points = {
     'console_scripts': [